@@ -20,28 +20,28 @@ from variation import (SNPS_PER_CHUNK, STATS_DEPTHS, MAX_DEPTH,
                        MAX_N_ALLELES, MAX_ALLELE_COUNTS,
                        MANHATTAN_WINDOW_SIZE, DEF_MIN_DEPTH)
 from variation.plot import (plot_barplot, plot_hist2d, manhattan_plot,
-                            plot_distrib, plot_boxplot_from_distribs,
+                            plot_histogram, plot_boxplot_from_distribs,
     plot_boxplot_from_distribs_series)
-from variation.matrix.methods import  is_dataset
-from variation.variations.index import MIN_NUM_GENOTYPES_FOR_POP_STAT
-from variation.variations.stats import (calc_maf, histogram_for_chunks,
-                                        histogram, PositionalStatsCalculator,
+from variation.matrix.methods import  is_dataset, calc_min_max
+from variation.variations.stats import (calc_maf, histogram,
+                                        PositionalStatsCalculator,
                                         calc_maf_depth_distribs_per_sample,
                                         calc_missing_gt, calc_obs_het,
-                                        calc_obs_het_by_sample,
+                                        calc_called_gt,
                                         calc_snp_density, DP_FIELD,
-                                        calc_field_distribs_per_sample,
                                         calc_cum_distrib, call_is_hom,
                                         call_is_het, GT_FIELD,
                                         calc_gt_type_stats,
                                         calc_called_gts_distrib_per_depth,
                                         call_is_hom_ref, call_is_hom_alt,
                                         hist2d_allele_observations,
-                                        hist2d_gq_allele_observations,
                                         calc_inbreeding_coef, GQ_FIELD,
                                         calc_hwe_chi2_test, calc_expected_het,
-                                        CHROM_FIELD, POS_FIELD,
-    calc_r2_windows)
+                                        CHROM_FIELD, POS_FIELD, AO_FIELD,
+                                        RO_FIELD, ALT_FIELD,
+    calc_r2_windows, histograms_per_sample)
+from variation.variations.stats_scanner import (StatsScanner, ConcatStat,
+                                                SumStat, HistogramStat)
 
 
 def _setup_argparse(**kwargs):
@@ -89,18 +89,21 @@ def _setup_argparse(**kwargs):
     help_msg = 'Calculate genome-wise statistics and plots'
     parser.add_argument('-g', '--calc_genome_wise', default=False,
                         help=help_msg, action='store_true')
+    help_msg = 'Number of processes used to calculate the stats'
+    parser.add_argument('-p', '--n_workers', default=None, help=help_msg,
+                        type=int)
     return parser
 
 
-def _parse_args(parser):
-    parsed_args = parser.parse_args()
+def _parse_args(parser, argv=None):
+    parsed_args = parser.parse_args(argv)
     args = {}
     args['in_fpath'] = parsed_args.input
     args['out_prefix'] = parsed_args.output_prefix
     if parsed_args.chunk_size == 'None':
         args['chunk_size'] = None
     else:
-        args['chunk_size'] = parsed_args.chunk_size
+        args['chunk_size'] = int(parsed_args.chunk_size)
 
     if ':' in parsed_args.depths:
         start, stop = [int(x) for x in parsed_args.depths.split(':')]
@@ -117,6 +120,7 @@ def _parse_args(parser):
     args['max_allele_counts'] = parsed_args.max_allele_counts
     args['write_bedgraph'] = parsed_args.write_bedgraph
     args['calc_genome_wise'] = parsed_args.calc_genome_wise
+    args['n_workers'] = parsed_args.n_workers
     return args
 
 
@@ -126,7 +130,6 @@ def _log_info(logging, msg, print_time=True):
     logging.info(msg)
     
 
-
 def create_plots():
     description = 'Calculates basic stats of a HDF5 file'
     parser = _setup_argparse(description=description)
@@ -141,78 +144,84 @@ def create_plots():
     h5 = VariationsH5(args['in_fpath'], mode='r',
                       vars_in_chunk=args['chunk_size'])
     
-    chunk_size = args['chunk_size']
     manhattan_ws = args['manhattan_ws']
-    min_num_genotypes = args['min_num_genotypes']
     write_bg = args['write_bedgraph']
     calc_genome_wise = args['calc_genome_wise']
-    
+
+    _log_info(logging, 'Calculating the stats')
+    stats = calc_stats(h5, args)
+    samples = h5.samples
+    chrom, pos = stats[CHROM_FIELD], stats[POS_FIELD]
+
     _log_info(logging, 'Plotting MAF Distribution')
-    plot_maf(h5, data_dir, chunk_size=chunk_size, window_size=manhattan_ws,
-             min_num_genotypes=min_num_genotypes, write_bg=write_bg,
-             calc_genome_wise=calc_genome_wise)
+    plot_maf(stats['maf'], chrom, pos, data_dir, window_size=manhattan_ws,
+             write_bg=write_bg, calc_genome_wise=calc_genome_wise)
         
     _log_info(logging, 'Plotting Depth based MAF per Sample Distributions')
-    plot_maf_depth(h5, data_dir, min_depth=args['min_depth'],
-                   chunk_size=chunk_size)
+    plot_maf_depth(stats['maf_depth'], samples, data_dir)
           
     _log_info(logging, 'Plotting Missing Genotype rate per SNP')
-    plot_missing_gt_rate_per_snp(h5, data_dir, chunk_size)
+    plot_missing_gt_rate_per_snp(stats['missing_gt_rate'], data_dir)
           
     _log_info(logging, 'Plotting Observed Heterozygosity')
-    plot_obs_het(h5, data_dir, chunk_size=chunk_size,
-                 min_num_genotypes=min_num_genotypes)
+    plot_obs_het(stats['obs_het'], stats['obs_het_by_sample'], data_dir)
           
     _log_info(logging, 'Plotting SNP Density Distribution')
-    plot_snp_dens_distrib(h5, args['window_size'], data_dir, write_bg=write_bg)
+    plot_snp_dens_distrib(chrom, pos, args['window_size'], data_dir,
+                          write_bg=write_bg)
           
     _log_info(logging, 'Plotting Depth Distribution')
-    plot_call_field_distribs_per_gt_type(h5, field=DP_FIELD,
-                                         max_value=args['max_depth'],
-                                         data_dir=data_dir,
-                                         chunk_size=chunk_size)
+    plot_call_field_distribs_per_gt_type(_get_distribs_per_gt_type(stats,
+                                                                   DP_FIELD),
+                                         DP_FIELD, samples, data_dir)
           
     _log_info(logging, 'Plotting Genotypes Quality Distribution')
-    plot_call_field_distribs_per_gt_type(h5, field=GQ_FIELD,
-                                         max_value=args['max_gq'],
-                                         data_dir=data_dir,
-                                         chunk_size=chunk_size)
+    plot_call_field_distribs_per_gt_type(_get_distribs_per_gt_type(stats,
+                                                                   GQ_FIELD),
+                                         GQ_FIELD, samples, data_dir)
           
     _log_info(logging, 'Plotting Genotypes Statistics per Sample')
-    plot_gt_stats_per_sample(h5, data_dir, chunk_size=chunk_size)
+    plot_gt_stats_per_sample(stats['gt_types'], samples, data_dir)
            
     _log_info(logging, 'Plotting number of Samples with higher Depth Distribution')
-    plot_called_gts_distrib_per_depth(h5, args['depths'], data_dir,
-                                      chunk_size=SNPS_PER_CHUNK)
+    plot_called_gts_distrib_per_depth(stats['called_gts_per_depth'],
+                                      args['depths'], data_dir)
            
     _log_info(logging, 'Plotting Hardy-Weinberg Equilibrium')
-    plot_hwe(h5, args['max_num_alleles'], data_dir, ploidy=2,
-             min_num_genotypes=min_num_genotypes, chunk_size=chunk_size)
-          
-         
+    hwe_distribs = [stats[_HWE_STAT.format(num_allele)]
+                    for num_allele in range(2, args['max_num_alleles'] + 1)]
+    plot_hwe(hwe_distribs, data_dir, ploidy=2)
+
     if calc_genome_wise:
         _log_info(logging, 'Plotting Nucleotide Diversity Measures')
-        plot_nucleotide_diversity_measures(h5, args['max_num_alleles'],
-                                           args['manhattan_ws'],
-                                           data_dir, chunk_size=chunk_size,
-                                           write_bg=write_bg,
-                                           min_num_genotypes=min_num_genotypes)
+        n_seqs = h5[GT_FIELD].shape[1] * h5[GT_FIELD].shape[2]
+        plot_nucleotide_diversity_measures(chrom, pos, stats['exp_het'],
+                                           n_seqs, manhattan_ws, data_dir,
+                                           write_bg=write_bg)
         
         _log_info(logging, 'Plotting LD r2')
-        plot_r2(h5, manhattan_ws, data_dir, write_bg=write_bg)
+        plot_r2(h5, manhattan_ws, data_dir, write_bg=write_bg,
+                n_workers=args['n_workers'])
             
     _log_info(logging, 'Plotting Allele Observations Distribution 2 Dimensions')
-    plot_allele_obs_distrib_2D(h5, data_dir, args['max_allele_counts'],
-                               chunk_size=chunk_size)
+    plot_allele_obs_distrib_2D(stats, data_dir)
          
     _log_info(logging, 'Plotting Inbreeding Coefficient')
-    plot_inbreeding_coefficient(h5, args['max_num_alleles'],
-                                data_dir, window_size=args['manhattan_ws'],
-                                chunk_size=chunk_size,
-                                min_num_genotypes=min_num_genotypes,
-                                write_bg=write_bg,
+    plot_inbreeding_coefficient(stats['inbreeding_coef'], chrom, pos,
+                                data_dir, write_bg=write_bg,
                                 calc_genome_wise=calc_genome_wise)
 
+
+_GT_TYPE_MASKS = [('Heterozygous', call_is_het), ('Homozygous', call_is_hom)]
+_ALLELE_OBS_MASKS = [('Heterozygous', call_is_het),
+                     ('Alt Homozygous', call_is_hom_alt),
+                     ('Ref Homozygous', call_is_hom_ref)]
+_FIELD_DISTRIB_STAT = '{}_distribs'
+_HWE_STAT = 'hwe_chi2_{}_alleles'
+_ALLELE_OBS_STAT = 'allele_obs_{}'
+_ALLELE_OBS_GQ_STAT = 'allele_obs_gq_{}'
+
+
 def _load_matrix(variations, path):
     matrix = variations[path]
     if is_dataset(matrix):
@@ -220,16 +229,140 @@ def _load_matrix(variations, path):
     return matrix
 
 
-def plot_maf(variations, data_dir, chunk_size=SNPS_PER_CHUNK, window_size=None,
-             min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT, write_bg=False,
+def _count_het_and_called_gts_by_sample(variations):
+    gts = variations[GT_FIELD]
+    return numpy.array([numpy.sum(call_is_het(gts), axis=0),
+                        calc_called_gt(variations, rates=False, axis=0)])
+
+
+def _calc_rates_from_counts(counts):
+    with numpy.errstate(invalid='ignore'):
+        return counts[0] / counts[1]
+
+
+def _count_field_values_per_gt_type(variations, field, max_value):
+    '''It bins the values of every sample, for every genotype type at once
+
+    There is one bin per integer value up to max_value, the last one includes
+    it, as it would do a histogram. The float values are binned with their
+    integer part.
+    '''
+    gts = variations[GT_FIELD]
+    gt_type_classes = numpy.full(gts.shape[:2], -1, dtype=numpy.int8)
+    for gt_type_idx, (_, mask_func) in enumerate(_GT_TYPE_MASKS):
+        gt_type_classes[mask_func(gts)] = gt_type_idx
+    return histograms_per_sample(variations[field], n_bins=max_value,
+                                 range_=(0, max_value),
+                                 classes=gt_type_classes,
+                                 n_classes=len(_GT_TYPE_MASKS))[0]
+
+
+def _calc_distribs_per_gt_type(counts, max_value):
+    bins = numpy.linspace(0, max_value, max_value + 1)
+    return [(gt_type_counts, bins) for gt_type_counts in counts]
+
+
+def _calc_hwe_chi2(variations, num_allele, min_num_genotypes):
+    hwe_test = calc_hwe_chi2_test(variations, num_allele=num_allele,
+                                  min_num_genotypes=min_num_genotypes,
+                                  chunk_size=None)
+    if hwe_test.ndim == 1:
+        return hwe_test
+    return hwe_test[:, 0]
+
+
+def calc_stats(variations, args):
+    'It calculates all the stats required by the plots reading the file once'
+    min_num_genotypes = args['min_num_genotypes']
+    scanner = StatsScanner()
+
+    for field in (CHROM_FIELD, POS_FIELD):
+        scanner.add(field, ConcatStat(partial(_load_matrix, path=field),
+                                      [field]))
+    scanner.add('maf', ConcatStat(partial(calc_maf,
+                                          min_num_genotypes=min_num_genotypes,
+                                          chunk_size=None),
+                                  [GT_FIELD]))
+    scanner.add('maf_depth',
+                SumStat(partial(calc_maf_depth_distribs_per_sample,
+                                min_depth=args['min_depth'], n_bins=100,
+                                chunk_size=None),
+                        [AO_FIELD, RO_FIELD]))
+    scanner.add('missing_gt_rate',
+                HistogramStat(partial(calc_missing_gt, rates=True, axis=1),
+                              [GT_FIELD], n_bins=20, range_=(0, 1)))
+    scanner.add('obs_het',
+                HistogramStat(partial(calc_obs_het,
+                                      min_num_genotypes=min_num_genotypes),
+                              [GT_FIELD], n_bins=25, range_=(0, 1)))
+    scanner.add('obs_het_by_sample',
+                SumStat(_count_het_and_called_gts_by_sample, [GT_FIELD],
+                        finish_funct=_calc_rates_from_counts))
+
+    max_values = {DP_FIELD: args['max_depth'], GQ_FIELD: args['max_gq']}
+    for field in (DP_FIELD, GQ_FIELD):
+        max_value = max_values[field]
+        if max_value is None:
+            # one bin for every integer value found
+            max_value = max(int(calc_min_max(variations[field])[1]), 0) + 1
+        count_values = partial(_count_field_values_per_gt_type, field=field,
+                               max_value=max_value)
+        finish_funct = partial(_calc_distribs_per_gt_type, max_value=max_value)
+        scanner.add(_FIELD_DISTRIB_STAT.format(field),
+                    SumStat(count_values, [field, GT_FIELD],
+                            finish_funct=finish_funct))
+
+    scanner.add('gt_types', SumStat(calc_gt_type_stats, [GT_FIELD]))
+    scanner.add('called_gts_per_depth',
+                SumStat(partial(calc_called_gts_distrib_per_depth,
+                                depths=args['depths'], chunk_size=None),
+                        [DP_FIELD, GT_FIELD]))
+
+    for num_allele in range(2, args['max_num_alleles'] + 1):
+        calc_hwe_chi2 = partial(_calc_hwe_chi2, num_allele=num_allele,
+                                min_num_genotypes=min_num_genotypes)
+        scanner.add(_HWE_STAT.format(num_allele),
+                    HistogramStat(calc_hwe_chi2, [GT_FIELD, ALT_FIELD],
+                                  n_bins=50))
+
+    max_allele_counts = args['max_allele_counts']
+    counts_range = [[0, max_allele_counts], [0, max_allele_counts]]
+    allele_obs_fields = [RO_FIELD, AO_FIELD, GT_FIELD]
+    for name, mask_func in _ALLELE_OBS_MASKS:
+        calc_hist2d = partial(hist2d_allele_observations,
+                              n_bins=max_allele_counts, range_=counts_range,
+                              mask_func=mask_func, chunk_size=None)
+        scanner.add(_ALLELE_OBS_STAT.format(name),
+                    SumStat(calc_hist2d, allele_obs_fields))
+        scanner.add(_ALLELE_OBS_GQ_STAT.format(name),
+                    SumStat(partial(calc_hist2d, weights_field=GQ_FIELD),
+                            allele_obs_fields + [GQ_FIELD]))
+
+    scanner.add('inbreeding_coef',
+                ConcatStat(partial(calc_inbreeding_coef, chunk_size=None,
+                                   min_num_genotypes=min_num_genotypes),
+                           [GT_FIELD, ALT_FIELD]))
+    if args['calc_genome_wise']:
+        scanner.add('exp_het',
+                    ConcatStat(partial(calc_expected_het,
+                                       min_num_genotypes=min_num_genotypes),
+                               [GT_FIELD]))
+    return scanner.run(variations, chunk_size=args['chunk_size'],
+                       n_workers=args.get('n_workers'))
+
+
+def _get_distribs_per_gt_type(stats, field):
+    return stats[_FIELD_DISTRIB_STAT.format(field)]
+
+
+def plot_maf(mafs, chrom, pos, data_dir, window_size=None, write_bg=False,
              calc_genome_wise=False):
-    # Calculate and plot MAF distribution
-    mafs = calc_maf(variations, min_num_genotypes, chunk_size)
+    # Plot MAF distribution
     maf_distrib, bins = histogram(mafs, n_bins=25, range_=(0, 1))
     
     fpath = join(data_dir, 'mafs.png')
     title = 'Maximum allele frequency (MAF) distribution'
-    plot_distrib(maf_distrib, bins=bins, fhand=open(fpath, 'w'), color='c',
+    plot_histogram(maf_distrib, bins, fhand=open(fpath, 'w'),
                    mpl_params={'set_xlabel': {'args': ['MAF'], 'kwargs': {}},
                                'set_ylabel': {'args': ['SNP number'],
                                               'kwargs': {}},
@@ -237,8 +370,6 @@ def plot_maf(variations, data_dir, chunk_size=SNPS_PER_CHUNK, window_size=None,
 
     # Write bedgraph file
     if calc_genome_wise:
-        chrom = _load_matrix(variations, CHROM_FIELD)
-        pos = _load_matrix(variations, POS_FIELD) 
         bg_fhand = open(join(data_dir, 'maf.bg'), 'w')
         pos_maf = PositionalStatsCalculator(chrom, pos, mafs,
                                             window_size=window_size,
@@ -262,20 +393,13 @@ def plot_maf(variations, data_dir, chunk_size=SNPS_PER_CHUNK, window_size=None,
                        fhand=fhand, figsize=(15, 7.5))
     
 
-def plot_maf_depth(variations, data_dir, min_depth=DEF_MIN_DEPTH,
-                chunk_size=SNPS_PER_CHUNK):
-    
-    maf_dp_distribs = calc_maf_depth_distribs_per_sample(variations,
-                                                         min_depth=min_depth,
-                                                         n_bins=100,
-                                                         chunk_size=SNPS_PER_CHUNK)
+def plot_maf_depth(maf_dp_distribs, samples, data_dir):
     maf_dp_distribs, bins = maf_dp_distribs
 
     maf_dp_dir = os.path.join(data_dir, 'maf_depth')
     if not os.path.exists(maf_dp_dir):
         os.mkdir(maf_dp_dir)
     
-    samples = variations.samples
     if samples is None:
         samples = range(maf_dp_distribs.shape[0])
     
@@ -287,41 +411,25 @@ def plot_maf_depth(variations, data_dir, min_depth=DEF_MIN_DEPTH,
                       'set_ylabel': {'args': ['SNPs number'], 'kwargs': {}},
                       'set_title': {'args': [title], 'kwargs': {}},
                       'set_yscale': {'args': ['log'], 'kwargs': {}}}
-        plot_distrib(distrib, bins, fhand=open(fpath, 'w'), figsize=(10, 10),
-                     mpl_params=mpl_params, n_ticks=10)
+        plot_histogram(distrib, bins, fhand=open(fpath, 'w'),
+                       figsize=(10, 10), mpl_params=mpl_params)
 
 
-def plot_missing_gt_rate_per_snp(variations, data_dir,
-                                 chunk_size=SNPS_PER_CHUNK):
-    _calc_missing_gt = partial(calc_missing_gt, rates=True, axis=1)
-    distrib, bins = histogram_for_chunks(variations,
-                                         calc_funct=_calc_missing_gt,
-                                         range_=(0, 1), n_bins=20,
-                                         chunk_size=chunk_size) 
+def plot_missing_gt_rate_per_snp(missing_gt_rate_distrib, data_dir):
+    distrib, bins = missing_gt_rate_distrib
     
     fpath = join(data_dir, 'missing_gt_rate.png')
     title = 'Missing Genotype rates per SNP distribution'
-    plot_distrib(distrib, bins, fhand=open(fpath, 'w'), color='c',
-                 mpl_params={'set_xlabel': {'args': ['Missing GT rate'],
-                                            'kwargs': {}},
-                             'set_ylabel': {'args': ['SNP number'],
-                                            'kwargs': {}},
-                             'set_title': {'args': [title], 'kwargs': {}}})
-
-
-def plot_obs_het(variations, data_dir, chunk_size=SNPS_PER_CHUNK,
-                 min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT):
-    # Calculate observed heterozygosity distribution by snp
-    _calc_obs_het_by_var = partial(calc_obs_het,
-                                   min_num_genotypes=min_num_genotypes)
-    distrib = histogram_for_chunks(variations, calc_funct=_calc_obs_het_by_var,
-                                   n_bins=25, range_=(0, 1),
-                                   chunk_size=chunk_size)
-    obs_het_var_distrib, bins1 = distrib
-    
-    # Calculate observed heterozygosity distribution by sample
-    obs_het_by_sample = calc_obs_het_by_sample(variations,
-                                               chunk_size=chunk_size)
+    plot_histogram(distrib, bins, fhand=open(fpath, 'w'),
+                   mpl_params={'set_xlabel': {'args': ['Missing GT rate'],
+                                              'kwargs': {}},
+                               'set_ylabel': {'args': ['SNP number'],
+                                              'kwargs': {}},
+                               'set_title': {'args': [title], 'kwargs': {}}})
+
+
+def plot_obs_het(obs_het_var_distrib, obs_het_by_sample, data_dir):
+    obs_het_var_distrib, bins1 = obs_het_var_distrib
     obs_het_sample_distrib, bins2 = histogram(obs_het_by_sample, n_bins=25,
                                               range_=(0, 1))
     
@@ -332,45 +440,44 @@ def plot_obs_het(variations, data_dir, chunk_size=SNPS_PER_CHUNK,
     canvas = FigureCanvas(fig)
     axes = fig.add_subplot(211)
     title = 'SNP observed Heterozygosity distribution'
-    plot_distrib(obs_het_var_distrib, bins=bins1, fhand=open(fpath, 'w'),
-                 mpl_params={'set_xlabel': {'args': ['Heterozygosity'],
-                                            'kwargs': {}},
-                             'set_ylabel': {'args': ['SNP number'], 'kwargs': {}},
-                             'set_title': {'args': [title], 'kwargs': {}},
-                             'set_yscale': {'args': ['log'], 'kwargs': {}}},
-                 axes=axes, color='c')
+    plot_histogram(obs_het_var_distrib, bins1, fhand=open(fpath, 'w'),
+                   mpl_params={'set_xlabel': {'args': ['Heterozygosity'],
+                                              'kwargs': {}},
+                               'set_ylabel': {'args': ['SNP number'], 'kwargs': {}},
+                               'set_title': {'args': [title], 'kwargs': {}},
+                               'set_yscale': {'args': ['log'], 'kwargs': {}}},
+                   axes=axes)
     axes = fig.add_subplot(212)
     title = 'Sample observed Heterozygosity distribution'
-    plot_distrib(obs_het_sample_distrib, bins=bins2, fhand=open(fpath, 'w'),
-                 mpl_params={'set_xlabel': {'args': ['Heterozygosity'],
-                                            'kwargs': {}},
-                             'set_ylabel': {'args': ['Sample number'],
-                                            'kwargs': {}},
-                             'set_title': {'args': [title], 'kwargs': {}}},
-                 axes=axes, color='c')
+    plot_histogram(obs_het_sample_distrib, bins2, fhand=open(fpath, 'w'),
+                   mpl_params={'set_xlabel': {'args': ['Heterozygosity'],
+                                              'kwargs': {}},
+                               'set_ylabel': {'args': ['Sample number'],
+                                              'kwargs': {}},
+                               'set_title': {'args': [title], 'kwargs': {}}},
+                   axes=axes)
     canvas.print_figure(fhand)
 
 
-def plot_snp_dens_distrib(variations, window_size, data_dir, write_bg=False):
+def plot_snp_dens_distrib(chrom, pos, window_size, data_dir, write_bg=False):
     # Calculate and plot variations density distribution
-    density = calc_snp_density(variations, window_size)
+    density = calc_snp_density({CHROM_FIELD: chrom, POS_FIELD: pos},
+                               window_size)
     density_distrib, bins = histogram(density, 20)
     fpath = join(data_dir, 'snps_density.png')
     title = 'SNP density distribution per {} bp windows'.format(window_size)
-    plot_distrib(density_distrib, bins, fhand=open(fpath, 'w'), color='c',
-                 mpl_params={'set_xlabel': {'args': ['SNP density'],
-                                            'kwargs': {}},
-                             'set_ylabel': {'args': ['SNP number'],
-                                            'kwargs': {}},
-                             'set_title': {'args': [title], 'kwargs': {}},
-                             'set_yscale': {'args': ['log'], 'kwargs': {}}})
+    plot_histogram(density_distrib, bins, fhand=open(fpath, 'w'),
+                   mpl_params={'set_xlabel': {'args': ['SNP density'],
+                                              'kwargs': {}},
+                               'set_ylabel': {'args': ['SNP number'],
+                                              'kwargs': {}},
+                               'set_title': {'args': [title], 'kwargs': {}},
+                               'set_yscale': {'args': ['log'], 'kwargs': {}}})
 
     # Manhattan plot for SNP density
     fpath = join(data_dir, 'snps_density_manhattan.png')
     fhand = open(fpath, 'w')
     title = 'SNP denisity along the genome'
-    chrom = _load_matrix(variations, CHROM_FIELD)
-    pos = _load_matrix(variations, POS_FIELD)
     manhattan_plot(chrom, pos, density,
                    mpl_params={'set_xlabel': {'args': ['Chromosome'],
                                               'kwargs': {}},
@@ -388,34 +495,25 @@ def plot_snp_dens_distrib(variations, window_size, data_dir, write_bg=False):
                        track_type='bedgraph')
 
 
-def plot_call_field_distribs_per_gt_type(variations, field, max_value,
-                                         data_dir, chunk_size=SNPS_PER_CHUNK):
+def plot_call_field_distribs_per_gt_type(distribs_per_gt_type, field, samples,
+                                         data_dir):
     # Field distribution per sample
     field_name = field.split('/')[-1]
     fpath = join(data_dir, '{}_distribution_per_sample.png'.format(field_name))
-    mask_funcs = [call_is_het, call_is_hom]
-    names = ['Heterozygous', 'Homozygous']
-    distribs = []
-    for mask_func in mask_funcs:
-        dp_distribs, bins = calc_field_distribs_per_sample(variations,
-                                                           field=field,
-                                                           range_=(0, max_value),
-                                                           n_bins=max_value,
-                                                           chunk_size=chunk_size,
-                                                           mask_func=mask_func,
-                                                           mask_field=GT_FIELD)
-        distribs.append(dp_distribs)
+    names = [name for name, _ in _GT_TYPE_MASKS]
+    distribs = [distribs for distribs, _ in distribs_per_gt_type]
+    bins = distribs_per_gt_type[0][1]
         
     title = '{} distribution per sample'.format(field_name)
     mpl_params = {'set_xlabel': {'args': ['Samples'], 'kwargs': {}},
                   'set_ylabel': {'args': [field_name], 'kwargs': {}},
                   'set_title': {'args': [title], 'kwargs': {}}}
-    figsize = (variations[GT_FIELD].shape[1], 7)
+    figsize = (distribs[0].shape[0], 7)
     plot_boxplot_from_distribs_series(distribs, fhand=open(fpath, 'w'),
                                       mpl_params=mpl_params, figsize=figsize,
                                       colors=['pink', 'tan'],
                                       labels=names,
-                                      xticklabels=variations.samples)
+                                      xticklabels=samples)
     
     # Overall field distributions
     fpath = join(data_dir, '{}_distribution.png'.format(field_name))
@@ -423,36 +521,35 @@ def plot_call_field_distribs_per_gt_type(variations, field, max_value,
     fig = Figure(figsize=(20, 15))
     canvas = FigureCanvas(fig)
     i = 1
-    for distrib, name in zip(distribs, names):
-        distrib = numpy.sum(dp_distribs, axis=0)
+    for (distribs, bins), name in zip(distribs_per_gt_type, names):
+        distrib = numpy.sum(distribs, axis=0)
         distrib_cum = calc_cum_distrib(distrib)
         axes = fig.add_subplot(len(names) * 100 + 20 + i)
         i += 1
         title = '{} distribution all samples {}'.format(field_name, name)
-        plot_distrib(distrib, bins, axes=axes,
-                     mpl_params={'set_xlabel': {'args': [field_name],
-                                                'kwargs': {}},
-                                 'set_ylabel': {'args': ['Number of GTs'],
-                                                'kwargs': {}},
-                                 'set_title': {'args': [title], 'kwargs': {}}})
+        plot_histogram(distrib, bins, axes=axes,
+                       mpl_params={'set_xlabel': {'args': [field_name],
+                                                  'kwargs': {}},
+                                   'set_ylabel': {'args': ['Number of GTs'],
+                                                  'kwargs': {}},
+                                   'set_title': {'args': [title], 'kwargs': {}}})
         distrib_cum = distrib_cum/distrib_cum[0] * 100
         axes = fig.add_subplot(len(names) * 100 + 20 + i)
         i += 1
         title = '{} cumulative distribution all samples {}'.format(field_name,
                                                                    name)
-        plot_distrib(distrib_cum, bins, axes=axes,
-                     mpl_params={'set_xlabel': {'args': [field_name],
-                                                'kwargs': {}},
-                                 'set_ylabel': {'args': ['% calls > Depth '],
-                                                'kwargs': {}},
-                                 'set_title': {'args': [title], 'kwargs': {}}})
+        plot_histogram(distrib_cum, bins, axes=axes,
+                       mpl_params={'set_xlabel': {'args': [field_name],
+                                                  'kwargs': {}},
+                                   'set_ylabel': {'args': ['% calls > Depth '],
+                                                  'kwargs': {}},
+                                   'set_title': {'args': [title], 'kwargs': {}}})
     canvas.print_figure(fhand)
 
 
-def plot_gt_stats_per_sample(variations, data_dir, chunk_size=SNPS_PER_CHUNK):
-    gt_stats = calc_gt_type_stats(variations, chunk_size=chunk_size)
+def plot_gt_stats_per_sample(gt_stats, samples, data_dir):
     gt_stats = gt_stats.transpose()
-    figsize = (variations[GT_FIELD].shape[1], 7)
+    figsize = (gt_stats.shape[0], 7)
     
     # All genotypes classes per sample
     fpath = join(data_dir, 'genotype_counts_per_sample.png')
@@ -460,7 +557,6 @@ def plot_gt_stats_per_sample(variations, data_dir, chunk_size=SNPS_PER_CHUNK):
     mpl_params = {'set_xlabel': {'args': ['Samples'], 'kwargs': {}},
                   'set_ylabel': {'args': ['Number of GTs'], 'kwargs': {}},
                   'set_title': {'args': [title], 'kwargs': {}}}
-    samples = variations.samples
     if samples is not None:
         mpl_params['set_xticklabels'] = {'args': [samples], 'kwargs': {}}
     plot_barplot(gt_stats, ['Ref Homozygous', 'Heterozygous', 'Alt Homozygous',
@@ -495,12 +591,10 @@ def plot_gt_stats_per_sample(variations, data_dir, chunk_size=SNPS_PER_CHUNK):
                  mpl_params=mpl_params, fpath=fpath, figsize=figsize)
 
 
-def plot_called_gts_distrib_per_depth(h5, depths, data_dir,
-                                      chunk_size=SNPS_PER_CHUNK):
+def plot_called_gts_distrib_per_depth(called_gts_distrib, depths, data_dir):
     # Distribution of the number of samples with a depth higher than
     # given values
-    distribs, _ = calc_called_gts_distrib_per_depth(h5, depths=depths,
-                                                    chunk_size=chunk_size)
+    distribs, _ = called_gts_distrib
     
     fpath = join(data_dir, 'gts_distribution_per_depth.png')
     title = 'Distribution of the number of samples with a depth higher than'
@@ -515,31 +609,22 @@ def plot_called_gts_distrib_per_depth(h5, depths, data_dir,
                                color='tan')
 
 
-def plot_allele_obs_distrib_2D(variations, data_dir, max_allele_counts,
-                               chunk_size=SNPS_PER_CHUNK):
+def plot_allele_obs_distrib_2D(stats, data_dir):
     # Allele observation distribution 2D
-    masks = [call_is_het, call_is_hom_alt, call_is_hom_ref]
-    names = ['Heterozygous', 'Alt Homozygous', 'Ref Homozygous']
-    
     fig = Figure(figsize=(22, 25))
     canvas = FigureCanvas(fig)
     gs = gridspec.GridSpec(3, 2)
     fpath = join(data_dir, 'allele_obs_distrib_per_gt.png')
     fhand = open(fpath, 'w')
     
-    counts_range = [[0, max_allele_counts], [0, max_allele_counts]]
-    
-    for i, (mask_func, name) in enumerate(zip(masks, names)):
-        hist2d = hist2d_allele_observations(variations,
-                                            n_bins=max_allele_counts,
-                                            range_=counts_range,
-                                            mask_func=mask_func,
-                                            chunk_size=chunk_size)
-        counts_distrib2d, xbins, ybins = hist2d
+    for i, (name, _) in enumerate(_ALLELE_OBS_MASKS):
+        counts_distrib2d, xbins, ybins = stats[_ALLELE_OBS_STAT.format(name)]
         
         axes = fig.add_subplot(gs[i, 0])
         title = 'Allele counts distribution 2D {}'.format(name)
-        plot_hist2d(numpy.log10(counts_distrib2d), xbins, ybins, axes=axes,
+        with numpy.errstate(divide='ignore'):
+            log_counts_distrib2d = numpy.log10(counts_distrib2d)
+        plot_hist2d(log_counts_distrib2d, xbins, ybins, axes=axes,
                     mpl_params={'set_xlabel': {'args': ['Alt allele counts'],
                                                'kwargs': {}},
                                 'set_ylabel': {'args': ['Ref allele counts'],
@@ -547,13 +632,11 @@ def plot_allele_obs_distrib_2D(variations, data_dir, max_allele_counts,
                                 'set_title': {'args': [title], 'kwargs': {}}},
                     colorbar_label='log10(counts)', fig=fig)
 
-        hist2d = hist2d_gq_allele_observations(variations,
-                                               n_bins=max_allele_counts,
-                                               range_=counts_range,
-                                               mask_func=mask_func,
-                                               chunk_size=chunk_size,
-                                               hist_counts=counts_distrib2d)
-        gq_distrib2d, xbins, ybins = hist2d
+        # The mean GQ of the calls in each bin
+        gq_sums2d = stats[_ALLELE_OBS_GQ_STAT.format(name)][0]
+        with numpy.errstate(invalid='ignore'):
+            gq_distrib2d = gq_sums2d / counts_distrib2d
+        gq_distrib2d[numpy.isnan(gq_distrib2d)] = 0
         
         axes = fig.add_subplot(gs[i, 1])
         title = 'Allele counts GQ distribution 2D {}'.format(name)
@@ -568,31 +651,25 @@ def plot_allele_obs_distrib_2D(variations, data_dir, max_allele_counts,
     canvas.print_figure(fhand)
 
 
-def plot_inbreeding_coefficient(variations, max_num_allele,  data_dir,
-                                window_size, chunk_size=SNPS_PER_CHUNK,
-                                min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT,
+def plot_inbreeding_coefficient(inbreed_coef, chrom, pos, data_dir,
                                 write_bg=False, calc_genome_wise=False):
-    # Calculate Inbreeding coefficient distribution
-    inbreed_coef = calc_inbreeding_coef(variations, chunk_size=chunk_size,
-                                        min_num_genotypes=min_num_genotypes)
+    # Plot Inbreeding coefficient distribution
     ic_distrib, bins = histogram(inbreed_coef, 50, range_=(-1, 1))
       
     fpath = join(data_dir, 'inbreeding_coef_distribution.png')
     fhand = open(fpath, 'w')
     title = 'Inbreeding coefficient distribution all samples'
-    plot_distrib(ic_distrib, bins, fhand=fhand,
-                 mpl_params={'set_xlabel': {'args': ['Inbreeding coefficient'],
-                                            'kwargs': {}},
-                             'set_ylabel': {'args': ['Number of SNPs'],
-                                            'kwargs': {}},
-                             'set_title': {'args': [title], 'kwargs': {}},
-                             'set_xlim': {'args': [-1, 1], 'kwargs': {}}})
+    plot_histogram(ic_distrib, bins, fhand=fhand,
+                   mpl_params={'set_xlabel': {'args': ['Inbreeding coefficient'],
+                                              'kwargs': {}},
+                               'set_ylabel': {'args': ['Number of SNPs'],
+                                              'kwargs': {}},
+                               'set_title': {'args': [title], 'kwargs': {}},
+                               'set_xlim': {'args': [-1, 1], 'kwargs': {}}})
     
     # Save in bedgraph file
     if calc_genome_wise:
         bg_fhand = open(join(data_dir, 'ic.bg'), 'w')
-        chrom = _load_matrix(variations, CHROM_FIELD)
-        pos = _load_matrix(variations, POS_FIELD)
         pos_ic = PositionalStatsCalculator(chrom, pos, inbreed_coef)
         if write_bg:
             pos_ic.write(bg_fhand, 'IC', 'Inbreeding coefficient',
@@ -613,25 +690,17 @@ def plot_inbreeding_coefficient(variations, max_num_allele,  data_dir,
                                  'set_title': {'args': [title], 'kwargs': {}}})
     
 
-def plot_hwe(variations, max_num_alleles, data_dir, ploidy=2,
-             min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT,
-             chunk_size=SNPS_PER_CHUNK):
+def plot_hwe(hwe_chi2_distribs, data_dir, ploidy=2):
     fpath = join(data_dir, 'hwe_chi2_distrib.png')
     fhand = open(fpath, 'w')
     fig = Figure(figsize=(10, 20))
     canvas = FigureCanvas(fig)
     
-    num_alleles = range(2, max_num_alleles + 1)
-    gs = gridspec.GridSpec(len(num_alleles), 1)
-    for i, num_allele in enumerate(num_alleles):
+    gs = gridspec.GridSpec(len(hwe_chi2_distribs), 1)
+    for i, (hwe_chi2_distrib, bins) in enumerate(hwe_chi2_distribs):
+        num_allele = i + 2
         df = len(list(combinations_with_replacement(range(num_allele),
                                                     ploidy))) - num_allele
-                                                    
-        hwe_test =  calc_hwe_chi2_test(variations, num_allele=num_allele,
-                                       min_num_genotypes=min_num_genotypes,
-                                       chunk_size=chunk_size)
-        hwe_chi2 = hwe_test[:, 0]
-        hwe_chi2_distrib, bins = histogram(hwe_chi2, n_bins=50)
         
         # Plot observed distribution
         axes = fig.add_subplot(gs[i, 0])
@@ -639,27 +708,23 @@ def plot_hwe(variations, max_num_alleles, data_dir, ploidy=2,
         mpl_params = {'set_xlabel': {'args': ['Chi2 statistic'], 'kwargs': {}},
                       'set_ylabel': {'args': ['SNP number'], 'kwargs': {}},
                       'set_title': {'args': [title], 'kwargs': {}}}
-        plot_distrib(hwe_chi2_distrib, bins, axes=axes, mpl_params=mpl_params)
+        plot_histogram(hwe_chi2_distrib, bins, axes=axes,
+                       mpl_params=mpl_params)
         
         # Plot expected chi2 distribution
         axes = axes.twinx()
         rv = chi2(df)
-        x = numpy.linspace(0, max(hwe_chi2), 1000)
+        x = numpy.linspace(0, bins[-1], 1000)
         axes.plot(x, rv.pdf(x), color='b', lw=2, label='Expected Chi2')
         axes.set_ylabel('Expected Chi2 density')
     canvas.print_figure(fhand)
 
 
-def plot_nucleotide_diversity_measures(variations, max_num_alleles,
-                                       window_size, data_dir,
-                                       chunk_size=SNPS_PER_CHUNK,
-                                       write_bg=False,
-                                       min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT):
+def plot_nucleotide_diversity_measures(chrom, pos, exp_het, n_seqs,
+                                       window_size, data_dir, write_bg=False):
     fig = Figure(figsize=(20, 20))
     canvas = FigureCanvas(fig)
     marker = 'k'
-    chrom = _load_matrix(variations, CHROM_FIELD)
-    pos = _load_matrix(variations, POS_FIELD)
 
     # Number of variable positions per bp
     snp_density = PositionalStatsCalculator(chrom, pos,
@@ -684,7 +749,6 @@ def plot_nucleotide_diversity_measures(variations, max_num_alleles,
                    marker=marker)
 
     # Watterson estimator of nucleotide diversity
-    n_seqs = variations[GT_FIELD].shape[1] * variations[GT_FIELD].shape[2]
     correction_factor = numpy.sum(1 / numpy.arange(1, n_seqs))
     watterson = snp_density
     watterson.stat = watterson.stat / correction_factor
@@ -701,8 +765,6 @@ def plot_nucleotide_diversity_measures(variations, max_num_alleles,
                    marker=marker)
 
     # Expected heterozygosity (Pi)
-    exp_het = calc_expected_het(variations, chunk_size=chunk_size,
-                                min_num_genotypes=min_num_genotypes)
     pi = PositionalStatsCalculator(chrom, pos, exp_het,
                                    window_size=window_size, step=window_size)
     pi = pi.calc_window_stat()
@@ -720,10 +782,12 @@ def plot_nucleotide_diversity_measures(variations, max_num_alleles,
     canvas.print_figure(open(join(data_dir, 'nucleotide_diversity.png'), 'w'))
 
 
-def plot_r2(variations, window_size, data_dir, write_bg=False):
+def plot_r2(variations, window_size, data_dir, write_bg=False,
+            n_workers=None):
     
     # Calculate LD r2 parameter in windows
-    chrom, pos, r2 = calc_r2_windows(variations, window_size=window_size)
+    chrom, pos, r2 = calc_r2_windows(variations, window_size=window_size,
+                                     n_workers=n_workers)
     
     # Plot r2 distribution
     fpath = os.path.join(data_dir, 'r2_distrib.png')
@@ -732,8 +796,8 @@ def plot_r2(variations, window_size, data_dir, write_bg=False):
     mpl_params={'set_xlabel': {'args': ['r2'], 'kwargs': {}},
                 'set_ylabel': {'args': ['Number of windows'], 'kwargs': {}},
                 'set_title': {'args': [title], 'kwargs': {}}}
-    plot_distrib(distrib, bins, fhand=open(fpath, 'w'), figsize=(7, 7),
-                 mpl_params=mpl_params)
+    plot_histogram(distrib, bins, fhand=open(fpath, 'w'), figsize=(7, 7),
+                   mpl_params=mpl_params)
     
     # Manhattan plot
     mask = numpy.logical_not(numpy.isnan(r2))
@@ -30,6 +30,8 @@ def _setup_argparse(**kwargs):
     parser.add_argument('-if', '--ignored_fields', default=None,
                         action='append',
                         help='Fields to avoid writing to HDF5 file (None)')
+    parser.add_argument('-t', '--n_threads', default=None, type=int,
+                        help='Threads used to compress the HDF5 chunks')
     return parser
 
 
@@ -49,6 +51,7 @@ def _parse_args(parser):
     args['ignore_alt'] = parsed_args.ignore_alt
     args['kept_fields'] = parsed_args.kept_fields
     args['ignored_fields'] = parsed_args.ignored_fields
+    args['n_threads'] = parsed_args.n_threads
     return args
 
 
@@ -67,8 +70,10 @@ def main():
                            kept_fields=args['kept_fields'],
                            max_field_lens={'CALLS': {b'AO': args['alt_gt_num']},
                                            'alt': args['alt_gt_num']})
-    h5 = VariationsH5(args['out_fpath'], mode='w')
+    h5 = VariationsH5(args['out_fpath'], mode='w',
+                      n_threads=args['n_threads'])
     h5.put_vars(vcf_parser)
+    h5.close()
 
 
 if __name__ == '__main__':
@@ -39,11 +39,15 @@ from variation.variations.filters import (MinCalledGTsFilter, FLT_VARS, COUNTS,
                                           AlleleObservationBasedMafFilter,
                                           VarsSamplingFilter,
                                           VarsSamplingFilter2,
-                                          VariableAndNotAllMissing)
-from variation.variations.stats import calc_depth_mean_by_sample
+                                          VariableAndNotAllMissing,
+                                          ExpressionFilter)
+from variation.variations.stats import (calc_depth_mean_by_sample, calc_maf,
+                                        calc_sample_qc)
+from variation.variations.zone_maps import (MIN, MAX, N_MISSING, N_ROWS,
+                                            ZONE_ALL, ZONE_NONE, ZONE_SOME)
 from variation.iterutils import first
 from variation import (GT_FIELD, CHROM_FIELD, POS_FIELD, GQ_FIELD,
-                       SNPS_PER_CHUNK, ALT_FIELD, REF_FIELD)
+                       SNPS_PER_CHUNK, ALT_FIELD, REF_FIELD, QUAL_FIELD)
 from variation.variations.annotation import IsVariableAnnotator, ANNOTATED_VARS
 
 
@@ -583,6 +587,50 @@ class SNPPosFilterTest(unittest.TestCase):
         filtered = SNPPositionFilter(regions)(variations)
         assert not filtered[FLT_VARS][POS_FIELD].size
 
+    def test_filter_by_many_regions(self):
+        variations = VariationsArrays()
+        pos = numpy.array([1, 5, 10, 15, 20, 25, 30, 2, 12, 40, 3])
+        chrom = numpy.array([b'1'] * 7 + [b'2'] * 3 + [b'3'])
+        variations[POS_FIELD] = pos
+        variations[CHROM_FIELD] = chrom
+        regions = [(b'1', 20, 26), (b'1', 4, 6), (b'1', 5, 11), (b'2', 13, 50),
+                   (b'2', 0, 2), (b'3',), (b'3', 10, 20), (b'4', 0, 10)]
+        result = SNPPositionFilter(regions)(variations)
+        assert list(result[FLT_VARS][POS_FIELD]) == [5, 10, 20, 25, 40, 3]
+
+        random_state = numpy.random.RandomState(1)
+        pos = numpy.sort(random_state.randint(0, 10000, size=2000))
+        chrom = numpy.array([b'1'] * 1000 + [b'2'] * 1000)
+        variations = VariationsArrays()
+        variations[POS_FIELD] = pos
+        variations[CHROM_FIELD] = chrom
+        starts = random_state.randint(0, 10000, size=500)
+        ends = starts + random_state.randint(1, 50, size=500)
+        regions = [(random_state.choice([b'1', b'2']), start, end)
+                   for start, end in zip(starts, ends)]
+        expected = numpy.zeros(pos.shape, dtype=bool)
+        for region_chrom, start, end in regions:
+            expected |= (chrom == region_chrom) & (start <= pos) & (pos < end)
+        result = SNPPositionFilter(regions, report_selection=True)(variations)
+        assert numpy.all(result[SELECTED_VARS] == expected)
+
+    def test_select_zone(self):
+        flt = SNPPositionFilter([(b'1', 10, 20), (b'1', 15, 30), (b'3',)])
+        zone_stats = {CHROM_FIELD: {MIN: b'1', MAX: b'1', N_MISSING: 0},
+                      POS_FIELD: {MIN: 12, MAX: 29, N_MISSING: 0}}
+        assert flt.select_zone(zone_stats) == ZONE_ALL
+        zone_stats[POS_FIELD][MAX] = 30
+        assert flt.select_zone(zone_stats) == ZONE_SOME
+        zone_stats[POS_FIELD][MIN] = 30
+        assert flt.select_zone(zone_stats) == ZONE_NONE
+        zone_stats[CHROM_FIELD][MAX] = b'2'
+        assert flt.select_zone(zone_stats) == ZONE_SOME
+        zone_stats[CHROM_FIELD][MIN] = b'2'
+        assert flt.select_zone(zone_stats) == ZONE_NONE
+        zone_stats[CHROM_FIELD][MIN] = b'3'
+        zone_stats[CHROM_FIELD][MAX] = b'3'
+        assert flt.select_zone(zone_stats) == ZONE_ALL
+
 
 class SamplingFilterTest(unittest.TestCase):
 
@@ -834,6 +882,15 @@ class FilterSamplesTest(unittest.TestCase):
         assert numpy.allclose(res[EDGES], res2[EDGES])
         assert numpy.all(res[COUNTS][:] == res2[COUNTS][:])
 
+        # with the sample stats already calculated
+        sample_qc = calc_sample_qc(variations)
+        new_var3 = VariationsArrays()
+        res3 = filter_samples_by_missing_rate(variations, min_called_rate=0.2,
+                                              out_vars=new_var3,
+                                              sample_qc=sample_qc)
+        assert new_var3.samples == new_var.samples
+        assert numpy.allclose(res3['missing_rates'], res['missing_rates'])
+
 
 class HetDupFilterTest(unittest.TestCase):
 
@@ -942,6 +999,61 @@ class FieldValueFilterTest(unittest.TestCase):
         assert filtered[FLT_STATS][N_FILTERED_OUT] == 810
 
 
+class ExpressionFilterTest(unittest.TestCase):
+
+    def test_expression_filter(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+        variations = VariationsArrays()
+        variations.put_chunks(hdf5.iterate_chunks())
+
+        expression = ("qual > 300 & info/MQM < 44 & "
+                      "(chrom == 'CP4_pseudomolecule01' | maf(GT) > 0.7)")
+        flt = ExpressionFilter(expression, report_selection=True)
+        assert sorted(flt.required_fields) == sorted([QUAL_FIELD, GT_FIELD,
+                                                      '/variations/info/MQM',
+                                                      CHROM_FIELD])
+        result = flt(variations)
+
+        with numpy.errstate(invalid='ignore'):
+            expected = ((variations[QUAL_FIELD] > 300) &
+                        (variations['/variations/info/MQM'] < 44) &
+                        (calc_maf(variations, chunk_size=None) > 0.7))
+        assert 0 < numpy.count_nonzero(expected) < variations.num_variations
+        assert numpy.all(result[SELECTED_VARS] == expected)
+        assert result[FLT_STATS][N_KEPT] == numpy.count_nonzero(expected)
+        assert result[FLT_STATS][TOT] == variations.num_variations
+        assert numpy.all(result[FLT_VARS][POS_FIELD] ==
+                         variations[POS_FIELD][expected])
+
+        result = ExpressionFilter("~(chrom == 'CP4_pseudomolecule00') | "
+                                  "/variations/pos <= 10")(variations)
+        expected = variations[POS_FIELD] <= 10
+        assert result[FLT_STATS][N_KEPT] == numpy.count_nonzero(expected)
+
+        for expression in ['qual >', 'qual > 3 &', '(qual > 3', 'qual $ 3',
+                           'foo(GT) > 3', 'maf(DP) > 3', '3 > 2']:
+            try:
+                ExpressionFilter(expression)
+                self.fail('ValueError expected')
+            except ValueError:
+                pass
+
+    def test_select_zone(self):
+        flt = ExpressionFilter("qual > 30 & (chrom == 'ch1' | maf(GT) > 0.1)")
+        zone_stats = {QUAL_FIELD: {MIN: 40, MAX: 100, N_MISSING: 0,
+                                   N_ROWS: 10},
+                      CHROM_FIELD: {MIN: b'ch1', MAX: b'ch1', N_MISSING: 0,
+                                    N_ROWS: 10}}
+        assert flt.select_zone(zone_stats) == ZONE_ALL
+        zone_stats[CHROM_FIELD][MAX] = b'ch2'
+        assert flt.select_zone(zone_stats) == ZONE_SOME
+        zone_stats[QUAL_FIELD][MAX] = 20
+        zone_stats[QUAL_FIELD][MIN] = 10
+        assert flt.select_zone(zone_stats) == ZONE_NONE
+        zone_stats[QUAL_FIELD][N_MISSING] = 1
+        assert flt.select_zone(zone_stats) == ZONE_SOME
+
+
 if __name__ == "__main__":
     #  import sys;sys.argv = ['', 'MonoBiallelicFilterTest']
     unittest.main()
@@ -37,6 +37,25 @@ class IndexTest(unittest.TestCase):
         assert index.get_chrom_range_pos(1) == (1, 3)
         assert index.covered_length == 10
 
+        # the chroms are not sorted by name
+        snps = VariationsArrays()
+        snps[CHROM_FIELD] = numpy.array([b'chr2', b'chr2', b'chr10',
+                                         b'chr10', b'chr1'])
+        snps[POS_FIELD] = numpy.array([1, 5, 2, 3, 4])
+        index = PosIndex(snps)
+        assert list(index.chroms) == [b'chr2', b'chr10', b'chr1']
+        assert index.get_chrom_range_index(b'chr10') == (2, 3)
+        assert index.index_pos(b'chr10', 3) == 3
+
+        snps = VariationsArrays()
+        snps[CHROM_FIELD] = numpy.array([b'chr2', b'chr1', b'chr2'])
+        snps[POS_FIELD] = numpy.array([1, 5, 2])
+        try:
+            PosIndex(snps)
+            self.fail('RuntimeError expected')
+        except RuntimeError:
+            pass
+
     def test_find(self):
 
         snps = VariationsArrays()
@@ -14,7 +14,8 @@ from variation.variations.vars_matrices import (VariationsH5,
                                                 select_dset_from_chunks)
 from variation.matrix.methods import extend_matrix
 from variation.matrix.stats import (row_value_counter_fact,
-                                    counts_by_row)
+                                    counts_by_row, counts_and_allels_by_row,
+                                    count_gt_classes_by_row)
 from variation.iterutils import first
 from test.test_utils import TEST_DATA_DIR
 from variation.variations.stats import calc_allele_freq_by_depth
@@ -75,6 +76,41 @@ class RowValueCounterTest(unittest.TestCase):
         counts = counts_by_row(gts, missing_value=-1)
         assert numpy.all(counts == [[6, 6]])
 
+        gts = numpy.array([[[0, 2], [-1, -1], [2, 2]],
+                           [[1, 1], [0, -1], [0, 0]]], dtype=numpy.int16)
+        counts, alleles = counts_and_allels_by_row(gts, missing_value=-1)
+        assert alleles == [0, 1, 2]
+        assert numpy.all(counts == [[1, 0, 3], [3, 2, 0]])
+        counts, alleles = counts_and_allels_by_row(gts)
+        assert alleles == [-1, 0, 1, 2]
+        assert numpy.all(counts == [[2, 1, 0, 3], [1, 3, 2, 0]])
+        counts, alleles = counts_and_allels_by_row(gts, missing_value=-1,
+                                                   alleles=[2, -1, 5])
+        assert alleles == [2, 5]
+        assert numpy.all(counts == [[3, 0], [0, 0]])
+        gts = numpy.full((2, 3, 2), -1)
+        assert counts_and_allels_by_row(gts, missing_value=-1) == (None, None)
+
+    def test_count_gt_classes(self):
+        gts = numpy.array([[[0, 2], [-1, -1], [2, 0], [1, 1]],
+                           [[1, 0], [0, -1], [0, 0], [2, 2]]])
+        counts, genotypes = count_gt_classes_by_row(gts)
+        assert genotypes == [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]
+        assert numpy.all(counts == [[0, 0, 2, 1, 0, 0],
+                                    [1, 1, 0, 0, 0, 1]])
+
+        counts, genotypes = count_gt_classes_by_row(gts, n_alleles=2)
+        assert genotypes == [(0, 0), (0, 1), (1, 1)]
+        assert numpy.all(counts == [[0, 0, 1], [1, 1, 0]])
+
+        gts = numpy.array([[[0, 1, 1], [1, 0, 1], [1, 1, 1], [0, 0, 1]]])
+        counts, genotypes = count_gt_classes_by_row(gts)
+        assert genotypes == [(0, 0, 0), (0, 0, 1), (0, 1, 1), (1, 1, 1)]
+        assert numpy.all(counts == [[0, 1, 2, 1]])
+
+        counts, _ = count_gt_classes_by_row(numpy.zeros((0, 3, 2), dtype=int))
+        assert counts.shape == (0, 1)
+
     def test_count_alleles_by_freq(self):
         h5 = VariationsH5(join(TEST_DATA_DIR, 'limon.h5'), mode='r')
         # flt = SampleFilter(['V51'])
@@ -6,12 +6,19 @@
 # Missing docstring
 # pylint: disable=C0111
 
+import os
+import gzip
 import unittest
 from os.path import join
+from tempfile import NamedTemporaryFile
 
 import numpy
 
-from variation.variations.pipeline import Pipeline
+from variation.variations.pipeline import (Pipeline, run_pipelines, PROFILE,
+                                           RUN_PROFILE, N_CHUNKS, BYTES_READ,
+                                           PEAK_CHUNK_BYTES, WALL_TIME,
+                                           READ_TIME, WRITE_TIME, ROWS_IN,
+                                           ROWS_OUT, CPU_TIME, BYTES_IN)
 from variation.variations.filters import (MinCalledGTsFilter, MafFilter,
                                           MacFilter, ObsHetFilter, FLT_VARS,
                                           LowDPGTsToMissingSetter,
@@ -19,9 +26,12 @@ from variation.variations.filters import (MinCalledGTsFilter, MafFilter,
                                           SampleFilter, FieldFilter,
                                           Chi2GtFreqs2SampleSetsFilter, N_KEPT,
                                           FLT_STATS, TOT, N_FILTERED_OUT,
-                                          FieldValueFilter)
+                                          FieldValueFilter,
+                                          SNPPositionFilter, COUNTS, EDGES)
 from variation.variations.vars_matrices import VariationsH5, VariationsArrays
-from variation import GT_FIELD
+from variation import (GT_FIELD, CHROM_FIELD, POS_FIELD, QUAL_FIELD,
+                       DP_FIELD)
+from variation.gt_parsers.vcf import VCFParser
 from test.test_utils import TEST_DATA_DIR
 from variation.variations.annotation import IsVariableAnnotator
 
@@ -263,6 +273,421 @@ class PipelineTest(unittest.TestCase):
         pipeline.run(hdf5, vars_out)
         assert vars_out.num_variations == 484
 
+    def test_zone_maps(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+        snps = VariationsArrays()
+        snps.put_chunks(hdf5.iterate_chunks())
+
+        out_fhand = NamedTemporaryFile(suffix='.hdf5')
+        out_fpath = out_fhand.name
+        out_fhand.close()
+        hdf5_2 = VariationsH5(out_fpath, 'w', vars_in_chunk=100)
+        try:
+            hdf5_2.put_chunks(hdf5.iterate_chunks(chunk_size=150))
+            assert hdf5_2.zone_maps.n_rows == hdf5.num_variations
+
+            chrom = hdf5[CHROM_FIELD][0]
+            read_chunks = []
+            get_chunk = hdf5_2.get_chunk
+
+            def get_chunk_and_count(*args, **kwargs):
+                read_chunks.append(args[0])
+                return get_chunk(*args, **kwargs)
+            hdf5_2.get_chunk = get_chunk_and_count
+
+            for flts in [[SNPPositionFilter([(chrom, 1000000, 2000000)])],
+                         [SNPPositionFilter([(chrom, 1000000, 2000000)],
+                                            reverse=True)],
+                         [SNPQualFilter(min_qual=100),
+                          SNPPositionFilter([(chrom, 1000000, 3000000)]),
+                          MafFilter(min_maf=0.6)],
+                         [FieldValueFilter(CHROM_FIELD, b'no_chrom')]]:
+                results = []
+                vars_outs = []
+                for vars_in in (hdf5_2, snps):
+                    pipeline = Pipeline()
+                    for flt in flts:
+                        pipeline.append(flt)
+                    vars_out = VariationsArrays()
+                    results.append(pipeline.run(vars_in, vars_out,
+                                                chunk_size=100))
+                    vars_outs.append(vars_out)
+                assert results[0] == results[1]
+                assert (vars_outs[0].num_variations ==
+                        vars_outs[1].num_variations)
+                if vars_outs[0].num_variations:
+                    assert numpy.all(vars_outs[0][POS_FIELD] ==
+                                     vars_outs[1][POS_FIELD])
+            # the chunks with no variation in the regions are not read
+            n_chunks = 4 * len(range(0, hdf5.num_variations, 100))
+            assert len(read_chunks) < n_chunks
+        finally:
+            os.remove(out_fpath)
+
+        # a field modified in place
+        n_vars = hdf5.num_variations
+        chunk = hdf5.get_chunk(slice(0, n_vars))
+        chunk[QUAL_FIELD][:] = 0
+        hdf5_2 = VariationsH5(out_fpath, 'w', vars_in_chunk=100)
+        try:
+            hdf5_2.put_chunks([chunk])
+            hdf5_2.close()
+
+            hdf5_2 = VariationsH5(out_fpath, 'r+')
+            hdf5_2[QUAL_FIELD][:] = 1000
+            pipeline = Pipeline()
+            pipeline.append(SNPQualFilter(min_qual=500))
+            result = pipeline.run(hdf5_2)
+            assert result['0'][FLT_STATS][N_KEPT] == n_vars
+
+            # modified after being appended in the same session
+            hdf5_2.put_chunks([chunk])
+            hdf5_2[QUAL_FIELD][n_vars:] = 1000
+            result = pipeline.run(hdf5_2)
+            assert result['0'][FLT_STATS][N_KEPT] == 2 * n_vars
+            hdf5_2[QUAL_FIELD][:n_vars] = 0
+            hdf5_2.close()
+
+            hdf5_2 = VariationsH5(out_fpath, 'r')
+            result = pipeline.run(hdf5_2)
+            assert result['0'][FLT_STATS][N_KEPT] == n_vars
+            hdf5_2.close()
+        finally:
+            os.remove(out_fpath)
+
+    def test_run_in_processes(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+        snps = VariationsArrays()
+        snps.put_chunks(hdf5.iterate_chunks())
+
+        results = []
+        vars_outs = []
+        for n_workers in (None, 3):
+            pipeline = Pipeline()
+            pipeline.append(MinCalledGTsFilter(min_called=0.1,
+                                               range_=(0, 1)))
+            pipeline.append(SNPQualFilter(min_qual=100, do_histogram=True))
+            pipeline.append(MafFilter(max_maf=0.9))
+            vars_out = VariationsArrays()
+            results.append(pipeline.run(snps, vars_out, chunk_size=50,
+                                         n_workers=n_workers))
+            vars_outs.append(vars_out)
+
+        for step_id in ('0', '1', '2'):
+            assert (results[0][step_id][FLT_STATS] ==
+                    results[1][step_id][FLT_STATS])
+        assert numpy.all(results[0]['1']['counts'] ==
+                         results[1]['1']['counts'])
+        # the chunks are written in order
+        assert numpy.all(vars_outs[0][GT_FIELD] == vars_outs[1][GT_FIELD])
+        assert numpy.all(vars_outs[0]['/variations/pos'] ==
+                         vars_outs[1]['/variations/pos'])
+    def test_deferred_filtering(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+
+        results = []
+        vars_outs = []
+        for deferred_filtering in (False, True):
+            snps = VariationsArrays()
+            snps.put_chunks(hdf5.iterate_chunks())
+            pipeline = Pipeline()
+            pipeline.append(MinCalledGTsFilter(min_called=0.1,
+                                               range_=(0, 1)))
+            pipeline.append(LowDPGTsToMissingSetter(min_dp=5))
+            pipeline.append(SNPQualFilter(min_qual=100, do_histogram=True))
+            pipeline.append(MafFilter(max_maf=0.9))
+            pipeline.append(SampleFilter(snps.samples[:10]))
+            pipeline.append(NonBiallelicFilter())
+            vars_out = VariationsArrays()
+            results.append(pipeline.run(snps, vars_out, chunk_size=100,
+                                        deferred_filtering=deferred_filtering))
+            vars_outs.append(vars_out)
+
+        assert str(results[0]) == str(results[1])
+        assert sorted(vars_outs[0].keys()) == sorted(vars_outs[1].keys())
+        assert vars_outs[1].num_variations
+        assert numpy.all(vars_outs[0][GT_FIELD] == vars_outs[1][GT_FIELD])
+        assert vars_outs[0].samples == vars_outs[1].samples
+
+    def test_histogram_with_no_range(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+        snps = VariationsArrays()
+        snps.put_chunks(hdf5.iterate_chunks())
+
+        flt1 = SNPQualFilter(min_qual=100)
+        flt2 = MafFilter(max_maf=0.9, do_histogram=True)
+        pipeline = Pipeline()
+        pipeline.append(flt1)
+        pipeline.append(flt2)
+        for n_workers in (None, 2):
+            result = pipeline.run(snps, chunk_size=100, n_workers=n_workers)
+            assert flt2.range is None
+
+            # the histogram is the one for the values that reached the step
+            result2 = flt2(flt1(snps)[FLT_VARS])
+            assert numpy.all(result['1'][COUNTS] == result2[COUNTS])
+            assert numpy.allclose(result['1'][EDGES], result2[EDGES])
+
+    def test_fields_to_read(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+        snps = VariationsArrays()
+        snps.put_chunks(hdf5.iterate_chunks())
+
+        pipeline = Pipeline()
+        pipeline.append(SNPQualFilter(min_qual=100))
+        pipeline.append(ObsHetFilter(max_het=0.5, min_call_dp=5,
+                                     do_histogram=True, range_=(0, 1)))
+        fields = pipeline._get_fields_to_read(snps, vars_out=None)
+        assert sorted(fields) == sorted([GT_FIELD, QUAL_FIELD, DP_FIELD])
+        # all input fields are required to write them
+        fields = pipeline._get_fields_to_read(snps, VariationsArrays())
+        assert sorted(fields) == sorted(snps.keys())
+        vars_out = VariationsArrays()
+        vars_out.put_chunks([snps.get_chunk(slice(0, 10),
+                                            kept_fields=[POS_FIELD])])
+        fields = pipeline._get_fields_to_read(snps, vars_out)
+        assert sorted(fields) == sorted([GT_FIELD, QUAL_FIELD, DP_FIELD,
+                                         POS_FIELD])
+
+        # steps that require no fields
+        pipeline2 = Pipeline()
+        pipeline2.append(SampleFilter(snps.samples[:2]))
+        assert pipeline2._get_fields_to_read(snps, None) == [POS_FIELD]
+        vars_out = VariationsArrays()
+        pipeline2.run(snps, vars_out=vars_out)
+        assert vars_out.num_variations == snps.num_variations
+        assert vars_out[GT_FIELD].shape[1] == 2
+
+        result = pipeline.run(snps)
+        expected = pipeline.run(snps, kept_fields=snps.keys())
+        assert numpy.all(result['1'][COUNTS] == expected['1'][COUNTS])
+        assert result['1'][FLT_STATS] == expected['1'][FLT_STATS]
+
+        # a step with unknown fields
+        pipeline.append(IsVariableAnnotator(annot_id='test'))
+        pipeline.append(lambda variations: {})
+        assert pipeline._get_fields_to_read(snps, vars_out=None) is None
+
+    def test_run_pipelines(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+        snps = VariationsArrays()
+        snps.put_chunks(hdf5.iterate_chunks())
+
+        def create_pipelines():
+            pipeline1 = Pipeline()
+            pipeline1.append(LowDPGTsToMissingSetter(min_dp=5))
+            pipeline1.append(MafFilter(max_maf=0.8, do_histogram=True))
+            pipeline2 = Pipeline()
+            pipeline2.append(MafFilter(max_maf=0.9, samples=snps.samples[:20],
+                                       do_histogram=True))
+            pipeline2.append(SNPQualFilter(min_qual=100))
+            return pipeline1, pipeline2
+
+        expected_vars_outs = [VariationsArrays(), None]
+        expected = [pipeline.run(snps, vars_out, chunk_size=100)
+                    for pipeline, vars_out in zip(create_pipelines(),
+                                                  expected_vars_outs)]
+
+        gts = snps[GT_FIELD].copy()
+        for n_workers in (None, 2):
+            vars_outs = [VariationsArrays(), None]
+            results = run_pipelines(snps, create_pipelines(), vars_outs,
+                                    chunk_size=100, n_workers=n_workers)
+            # the input is not modified by the pipelines
+            assert numpy.all(snps[GT_FIELD] == gts)
+            for result, expected_result in zip(results, expected):
+                for step_id, step_result in expected_result.items():
+                    if COUNTS in step_result:
+                        assert numpy.all(result[step_id][COUNTS] ==
+                                         step_result[COUNTS])
+                    if FLT_STATS in step_result:
+                        assert (result[step_id][FLT_STATS] ==
+                                step_result[FLT_STATS])
+            assert numpy.all(vars_outs[0][GT_FIELD] ==
+                             expected_vars_outs[0][GT_FIELD])
+
+        try:
+            run_pipelines(snps, create_pipelines(), [None])
+            self.fail('ValueError expected')
+        except ValueError:
+            pass
+
+    def test_profile(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+        snps = VariationsArrays()
+        snps.put_chunks(hdf5.iterate_chunks())
+
+        pipeline = Pipeline()
+        pipeline.append(SNPQualFilter(min_qual=100))
+        pipeline.append(MafFilter(max_maf=0.9))
+
+        profiles = []
+        for n_workers in (None, 2):
+            results_seen = []
+            vars_out = VariationsArrays()
+            result = pipeline.run(snps, vars_out, chunk_size=100,
+                                  n_workers=n_workers,
+                                  profile_callback=results_seen.append)
+            run_profile = result[RUN_PROFILE]
+            assert run_profile[N_CHUNKS] == len(results_seen)
+            assert run_profile[BYTES_READ] == snps.nbytes
+            assert run_profile[PEAK_CHUNK_BYTES] <= run_profile[BYTES_READ]
+            assert run_profile[WALL_TIME] >= run_profile[READ_TIME]
+            assert run_profile[WRITE_TIME] > 0
+            for step_id in ('0', '1'):
+                step_profile = result[step_id][PROFILE]
+                flt_stats = result[step_id][FLT_STATS]
+                assert step_profile[ROWS_IN] == flt_stats[TOT]
+                assert step_profile[ROWS_OUT] == flt_stats[N_KEPT]
+                assert step_profile[WALL_TIME] > 0
+                assert step_profile[CPU_TIME] >= 0
+            profiles.append(result)
+        assert (profiles[0]['1'][PROFILE][BYTES_IN] ==
+                profiles[1]['1'][PROFILE][BYTES_IN])
+
+        # no profile by default
+        result = pipeline.run(snps, chunk_size=100)
+        assert RUN_PROFILE not in result
+        assert PROFILE not in result['0']
+
+    def test_checkpoint(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+        snps = VariationsArrays()
+        snps.put_chunks(hdf5.iterate_chunks())
+
+        class FailingStep:
+            def __init__(self, n_calls_to_fail=None):
+                self.n_calls_to_fail = n_calls_to_fail
+                self.n_calls = 0
+
+            def __call__(self, variations):
+                self.n_calls += 1
+                if self.n_calls == self.n_calls_to_fail:
+                    raise RuntimeError('The node has been preempted')
+                return {}
+
+        def create_pipeline(n_calls_to_fail=None):
+            pipeline = Pipeline()
+            pipeline.append(MafFilter(max_maf=0.9, do_histogram=True))
+            pipeline.append(FailingStep(n_calls_to_fail))
+            pipeline.append(SNPQualFilter(min_qual=100))
+            return pipeline
+
+        expected_vars_out = VariationsArrays()
+        expected = create_pipeline().run(snps, expected_vars_out,
+                                         chunk_size=100)
+
+        out_fhand = NamedTemporaryFile(suffix='.hdf5')
+        out_fpath = out_fhand.name
+        out_fhand.close()
+        checkpoint_fpath = out_fpath + '.checkpoint'
+        try:
+            vars_out = VariationsH5(out_fpath, 'w', vars_in_chunk=100)
+            try:
+                create_pipeline(n_calls_to_fail=4).run(snps, vars_out,
+                                                       chunk_size=100,
+                                                       checkpoint_fpath=checkpoint_fpath,
+                                                       checkpoint_interval=0)
+                self.fail('RuntimeError expected')
+            except RuntimeError:
+                pass
+            assert os.path.exists(checkpoint_fpath)
+            # the rows written after the checkpoint are removed
+            vars_out.put_chunks(snps.iterate_chunks(stop=10))
+            vars_out.close()
+
+            vars_out = VariationsH5(out_fpath, 'r+', vars_in_chunk=100)
+            result = create_pipeline().run(snps, vars_out, chunk_size=100,
+                                           checkpoint_fpath=checkpoint_fpath)
+            assert not os.path.exists(checkpoint_fpath)
+            assert numpy.all(result['0'][COUNTS] == expected['0'][COUNTS])
+            assert result['0'][FLT_STATS] == expected['0'][FLT_STATS]
+            assert result['2'][FLT_STATS] == expected['2'][FLT_STATS]
+            assert numpy.all(vars_out[POS_FIELD][:] ==
+                             expected_vars_out[POS_FIELD])
+            assert vars_out.zone_maps.n_rows == vars_out.num_variations
+            vars_out.close()
+        finally:
+            for fpath in (out_fpath, checkpoint_fpath):
+                if os.path.exists(fpath):
+                    os.remove(fpath)
+
+        try:
+            create_pipeline().run(snps, VariationsArrays(),
+                                  checkpoint_fpath=checkpoint_fpath)
+            self.fail('ValueError expected')
+        except ValueError:
+            pass
+
+    def test_run_from_parser(self):
+        def create_pipeline():
+            pipeline = Pipeline()
+            pipeline.append(MinCalledGTsFilter(min_called=0.1,
+                                               do_histogram=True))
+            pipeline.append(MafFilter(max_maf=0.9, do_histogram=True))
+            return pipeline
+
+        vcf_fpath = join(TEST_DATA_DIR, 'ril.vcf.gz')
+        with gzip.open(vcf_fpath, 'rb') as fhand:
+            snps = VariationsArrays()
+            snps.put_vars(VCFParser(fhand))
+        expected_vars_out = VariationsArrays()
+        expected = create_pipeline().run(snps, expected_vars_out,
+                                         chunk_size=100)
+
+        with gzip.open(vcf_fpath, 'rb') as fhand:
+            vcf_parser = VCFParser(fhand)
+            vars_out = VariationsArrays()
+            result = create_pipeline().run(vcf_parser, vars_out,
+                                           chunk_size=100)
+        for step_id in ('0', '1'):
+            assert result[step_id][FLT_STATS] == expected[step_id][FLT_STATS]
+            assert numpy.all(result[step_id][COUNTS] ==
+                             expected[step_id][COUNTS])
+        assert vars_out.num_variations == expected_vars_out.num_variations
+        assert numpy.all(vars_out[GT_FIELD] == expected_vars_out[GT_FIELD])
+        assert numpy.all(vars_out[POS_FIELD] == expected_vars_out[POS_FIELD])
+
+    def test_shared_intermediates(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+        snps = VariationsArrays()
+        snps.put_chunks(hdf5.iterate_chunks())
+        samples = snps.samples[:20]
+
+        def create_steps():
+            return [MafFilter(max_maf=0.9, samples=samples,
+                              do_histogram=True, range_=(0, 1)),
+                    MacFilter(min_mac=2, samples=samples),
+                    MinCalledGTsFilter(min_called=0.1, range_=(0, 1)),
+                    NonBiallelicFilter(),
+                    ObsHetFilter(max_het=0.5, do_histogram=True,
+                                 range_=(0, 1)),
+                    LowDPGTsToMissingSetter(min_dp=5, range_=(0, 100)),
+                    MafFilter(max_maf=0.9, do_histogram=True,
+                              range_=(0, 1))]
+
+        # the steps are run without the pipeline, no intermediate is shared
+        chunk = snps
+        expected = []
+        for step in create_steps():
+            result = step(chunk)
+            chunk = result.pop(FLT_VARS)
+            expected.append(result)
+
+        pipeline = Pipeline()
+        for step in create_steps():
+            pipeline.append(step)
+        vars_out = VariationsArrays()
+        result = pipeline.run(snps, vars_out,
+                              chunk_size=snps.num_variations)
+        for idx, step_result in enumerate(expected):
+            if COUNTS in step_result:
+                assert numpy.all(result[str(idx)][COUNTS] ==
+                                 step_result[COUNTS])
+            if FLT_STATS in step_result:
+                assert result[str(idx)][FLT_STATS] == step_result[FLT_STATS]
+        assert numpy.all(vars_out[GT_FIELD] == chunk[GT_FIELD])
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'PipelineTest.test_snp_qual']
     unittest.main()
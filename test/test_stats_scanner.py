@@ -0,0 +1,118 @@
+# Method could be a function
+# pylint: disable=R0201
+# Too many public methods
+# pylint: disable=R0904
+# Missing docstring
+# pylint: disable=C0111
+
+import unittest
+import importlib.util
+from functools import partial
+from os.path import join
+from tempfile import TemporaryDirectory
+
+import numpy
+
+from test.test_utils import TEST_DATA_DIR, BIN_DIR
+from variation import GT_FIELD, ALT_FIELD, CHROM_FIELD
+from variation.variations.vars_matrices import VariationsH5
+from variation.variations.stats import (calc_maf, calc_obs_het, histogram,
+                                        calc_gt_type_stats,
+                                        calc_inbreeding_coef,
+                                        histogram_for_chunks)
+from variation.variations.stats_scanner import (StatsScanner, ConcatStat,
+                                                SumStat, HistogramStat)
+
+
+class StatsScannerTest(unittest.TestCase):
+    def test_stats_scanner(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+
+        scanner = StatsScanner()
+        scanner.add('maf', ConcatStat(partial(calc_maf, chunk_size=None),
+                                      [GT_FIELD]))
+        scanner.add('obs_het', HistogramStat(calc_obs_het, [GT_FIELD],
+                                             n_bins=25, range_=(0, 1)))
+        scanner.add('inbreeding', HistogramStat(partial(calc_inbreeding_coef,
+                                                        chunk_size=None),
+                                                [GT_FIELD, ALT_FIELD],
+                                                n_bins=10))
+        scanner.add('gt_types', SumStat(calc_gt_type_stats, [GT_FIELD]))
+        scanner.add('n_vars', SumStat(lambda chunk: chunk.num_variations,
+                                      [GT_FIELD],
+                                      finish_funct=int))
+        try:
+            scanner.add('maf', ConcatStat(calc_maf))
+            self.fail('ValueError expected')
+        except ValueError:
+            pass
+        result = scanner.run(hdf5, chunk_size=200)
+
+        assert numpy.allclose(result['maf'], calc_maf(hdf5), equal_nan=True)
+        counts, edges = histogram(calc_obs_het(hdf5), n_bins=25,
+                                  range_=(0, 1))
+        assert numpy.all(result['obs_het'][0] == counts)
+        assert numpy.allclose(result['obs_het'][1], edges)
+        counts, edges = histogram(calc_inbreeding_coef(hdf5), n_bins=10)
+        assert numpy.all(result['inbreeding'][0] == counts)
+        assert numpy.allclose(result['inbreeding'][1], edges)
+        assert numpy.all(result['gt_types'] == calc_gt_type_stats(hdf5))
+        assert result['n_vars'] == hdf5.num_variations
+
+        counts, _ = histogram_for_chunks(hdf5, calc_obs_het, n_bins=25,
+                                         range_=(0, 1), chunk_size=200)
+        assert numpy.all(result['obs_het'][0] == counts)
+
+    def test_stats_scanner_in_processes(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+
+        scanner = StatsScanner()
+        scanner.add('maf', ConcatStat(partial(calc_maf, chunk_size=None),
+                                      [GT_FIELD]))
+        scanner.add('obs_het', HistogramStat(calc_obs_het, [GT_FIELD]))
+        scanner.add('gt_types', SumStat(calc_gt_type_stats, [GT_FIELD]))
+        result1 = scanner.run(hdf5, chunk_size=200, n_workers=2)
+        result2 = scanner.run(hdf5, chunk_size=200)
+
+        assert numpy.allclose(result1['maf'], result2['maf'], equal_nan=True)
+        assert numpy.all(result1['obs_het'][0] == result2['obs_het'][0])
+        assert numpy.all(result1['gt_types'] == result2['gt_types'])
+
+    def test_sum_arrays_with_different_shapes(self):
+        chunk_results = iter([numpy.array([[1, 2], [3, 4]]),
+                              numpy.array([[1, 1, 1], [1, 1, 1]])])
+        stat = SumStat(lambda chunk: next(chunk_results))
+        result = stat.merge(None, stat.calc(None))
+        result = stat.merge(result, stat.calc(None))
+        assert numpy.all(stat.finish(result) == [[2, 3, 1], [4, 5, 1]])
+
+
+def _load_h5_stats_script():
+    fpath = join(BIN_DIR, 'calculate_h5_stats.py')
+    spec = importlib.util.spec_from_file_location('calculate_h5_stats', fpath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class CalcH5StatsTest(unittest.TestCase):
+    def test_calc_stats(self):
+        h5_stats = _load_h5_stats_script()
+        fpath = join(TEST_DATA_DIR, 'ril.hdf5')
+        hdf5 = VariationsH5(fpath, mode='r')
+        with TemporaryDirectory() as out_dir:
+            args = h5_stats._parse_args(h5_stats._setup_argparse(),
+                                        [fpath, '-o', out_dir, '-g', '-bg',
+                                         '-n', '200'])
+            stats = h5_stats.calc_stats(hdf5, args)
+
+        assert stats[CHROM_FIELD].shape[0] == hdf5.num_variations
+        assert numpy.allclose(stats['maf'], calc_maf(hdf5), equal_nan=True)
+        assert 'exp_het' in stats
+        for num_allele in range(2, args['max_num_alleles'] + 1):
+            counts, edges = stats['hwe_chi2_{}_alleles'.format(num_allele)]
+            assert counts.shape[0] + 1 == edges.shape[0]
+
+
+if __name__ == "__main__":
+    unittest.main()
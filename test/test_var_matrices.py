@@ -14,10 +14,12 @@ import random
 
 import h5py
 import numpy
+from numpy.testing import assert_array_equal
 from scipy.stats import ttest_ind
 
 from variation.variations.vars_matrices import (VariationsArrays,
-                                                VariationsH5)
+                                                VariationsH5,
+                                                LazyRowsVariations)
 from variation.gt_parsers.vcf import VCFParser
 from test.test_utils import TEST_DATA_DIR
 from variation.variations.index import PosIndex
@@ -143,6 +145,95 @@ class VcfH5Test(unittest.TestCase):
         hdf5_3 = VariationsArrays()
         hdf5_3.put_chunks(hdf5.iterate_chunks(random_sample_rate=0.01))
 
+    def test_put_chunks_with_direct_chunk_writes(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+        out_fhand = NamedTemporaryFile(suffix='.hdf5')
+        out_fpath = out_fhand.name
+        out_fhand.close()
+        hdf5_2 = VariationsH5(out_fpath, 'w', n_threads=2)
+        try:
+            # chunks not aligned with the storage chunks
+            hdf5_2.put_chunks(hdf5.iterate_chunks(chunk_size=250))
+            hdf5_2.put_chunks([hdf5.get_chunk(slice(0, 10))])
+            hdf5_2.close()
+
+            hdf5_2 = VariationsH5(out_fpath, 'r')
+            n_vars = hdf5.num_variations
+            assert hdf5_2.num_variations == n_vars + 10
+            for path in hdf5.keys():
+                assert_array_equal(hdf5[path][:], hdf5_2[path][:n_vars])
+                assert_array_equal(hdf5[path][:10], hdf5_2[path][n_vars:])
+            assert hdf5_2['/calls/GT'].fletcher32
+            assert hdf5_2['/calls/GT'].compression == 'gzip'
+        finally:
+            os.remove(out_fpath)
+
+        # the data is available before closing
+        hdf5_2 = VariationsH5(out_fpath, 'w', n_threads=2)
+        try:
+            chunk = hdf5.get_chunk(slice(0, 700))
+            hdf5_2.put_chunks([chunk])
+            hdf5_2.put_chunks([chunk])
+            assert numpy.all(hdf5_2['/calls/GT'][700:] == chunk['/calls/GT'])
+            hdf5_2.close()
+        finally:
+            os.remove(out_fpath)
+
+        # a filter not supported by the direct writes in any dataset
+        chunk = hdf5.get_chunk(slice(0, 700), kept_fields=[GT_FIELD,
+                                                            POS_FIELD])
+        h5 = h5py.File(out_fpath, 'w')
+        for path, compression in ((GT_FIELD, 'gzip'), (POS_FIELD, 'lzf')):
+            mat = chunk[path]
+            h5.create_dataset(path, data=mat, chunks=True,
+                              maxshape=(None,) + mat.shape[1:],
+                              compression=compression)
+        h5.close()
+        hdf5_2 = VariationsH5(out_fpath, 'r+', n_threads=2)
+        try:
+            hdf5_2.put_chunks([chunk])
+            hdf5_2.close()
+            hdf5_2 = VariationsH5(out_fpath, 'r')
+            assert hdf5_2.num_variations == 1400
+            for path in (GT_FIELD, POS_FIELD):
+                assert hdf5_2[path].shape[0] == 1400
+                assert_array_equal(hdf5_2[path][700:], chunk[path])
+            hdf5_2.close()
+        finally:
+            os.remove(out_fpath)
+
+    def test_zone_maps(self):
+        hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+        assert hdf5.zone_maps is None
+        out_fhand = NamedTemporaryFile(suffix='.hdf5')
+        out_fpath = out_fhand.name
+        out_fhand.close()
+        try:
+            hdf5_2 = VariationsH5(out_fpath, 'w', vars_in_chunk=100)
+            hdf5_2.put_chunks(hdf5.iterate_chunks(stop=550, chunk_size=150))
+            assert '/zone_maps/0/min' not in hdf5_2.keys()
+            hdf5_2.close()
+
+            # more variations are added to the last incomplete zone
+            hdf5_2 = VariationsH5(out_fpath, 'r+')
+            assert hdf5_2.zone_maps.n_rows == 550
+            hdf5_2.put_chunks(hdf5.iterate_chunks(start=550, chunk_size=150))
+            hdf5_2.close()
+
+            hdf5_2 = VariationsH5(out_fpath, 'r')
+            zone_maps = hdf5_2.zone_maps
+            assert zone_maps.n_rows == hdf5.num_variations
+            poss = hdf5[POS_FIELD][:]
+            for start, stop in [(0, 100), (500, 600), (150, 420), (900, 943)]:
+                pos_stats = zone_maps.get_zone_stats(start, stop)[POS_FIELD]
+                zone_start = (start // 100) * 100
+                zone_stop = min(((stop - 1) // 100 + 1) * 100, poss.shape[0])
+                assert pos_stats['min'] == poss[zone_start:zone_stop].min()
+                assert pos_stats['max'] == poss[zone_start:zone_stop].max()
+                assert pos_stats['n_rows'] == zone_stop - zone_start
+        finally:
+            os.remove(out_fpath)
+
 
 def _init_var_mat(klass, vars_in_chunk=SNPS_PER_CHUNK):
     if klass is VariationsH5:
@@ -272,6 +363,32 @@ class VarMatsTests(unittest.TestCase):
         hd5_2.put_chunks(wins)
         numpy.all(hd5['/variations/pos'] == hd5_2['/variations/pos'])
 
+    def test_iterate_overlapping_wins(self):
+        fpath = join(TEST_DATA_DIR, 'ril.hdf5')
+        hd5 = VariationsH5(fpath, mode='r')
+        win_size, win_step = 100000, 30000
+        wins = list(hd5.iterate_wins(win_size=win_size, win_step=win_step,
+                                     kept_fields=['/variations/chrom',
+                                                  '/variations/pos',
+                                                  '/calls/GT']))
+
+        chroms = hd5['/variations/chrom'][:]
+        poss = hd5['/variations/pos'][:]
+        gts = hd5['/calls/GT'][:]
+        n_wins = 0
+        for chrom in numpy.unique(chroms):
+            chrom_poss = poss[chroms == chrom]
+            chrom_gts = gts[chroms == chrom]
+            for start in range(chrom_poss[0], chrom_poss[-1] + 1, win_step):
+                in_win = numpy.logical_and(chrom_poss >= start,
+                                           chrom_poss < start + win_size)
+                win = wins[n_wins]
+                assert numpy.all(win['/variations/pos'] == chrom_poss[in_win])
+                assert numpy.all(win['/calls/GT'] == chrom_gts[in_win])
+                assert numpy.all(win['/variations/chrom'] == chrom)
+                n_wins += 1
+        assert len(wins) == n_wins
+
     def test_iterate_chroms(self):
         fpath = join(TEST_DATA_DIR, 'ril.hdf5')
         hd5 = VariationsH5(fpath, mode='r')
@@ -419,13 +536,49 @@ class GenomeChunkTest(unittest.TestCase):
         varis[POS_FIELD] = poss
         varis[CHROM_FIELD] = chroms
 
+        def get_poss(chunk):
+            return list(chunk[POS_FIELD])
+
         # empty before
-        varis.get_genome_chunk('c1', 1, 4)
+        assert get_poss(varis.get_genome_chunk('c1', 1, 4)) == []
         # empy after
+        assert get_poss(varis.get_genome_chunk('c1', 13, 20)) == []
         # before and middle
+        assert get_poss(varis.get_genome_chunk('c1', 1, 8)) == [5, 7]
         # middle and after
+        assert get_poss(varis.get_genome_chunk('c1', 9, 20)) == [10, 11, 12]
         # middle and middle
+        assert get_poss(varis.get_genome_chunk('c1', 6, 11)) == [7, 8, 10]
         # exact or close to
+        assert get_poss(varis.get_genome_chunk('c1', 5, 12)) == [5, 7, 8, 10,
+                                                                 11]
+        # no snps in the chrom
+        assert get_poss(varis.get_genome_chunk('c2', 1, 20)) == []
+
+    def test_genome_regions(self):
+        poss = [5, 7, 8, 10, 11, 12, 1, 2, 3]
+        chroms = ['c1'] * 6 + ['c2'] * 3
+        varis = VariationsArrays()
+        varis[POS_FIELD] = numpy.array(poss)
+        varis[CHROM_FIELD] = numpy.array(chroms)
+
+        regions = [('c2', 3, 4), ('c1', 10, 12), ('c1', 1, 6), ('c1', 5, 8),
+                   ('c3', 1, 10)]
+        for max_gap in (0, 1, 100):
+            chunk = varis.get_genome_regions(regions, max_gap=max_gap)
+            assert list(chunk[POS_FIELD]) == [5, 7, 10, 11, 3]
+            assert list(chunk[CHROM_FIELD]) == ['c1'] * 4 + ['c2']
+
+        chunk = varis.get_genome_regions([('c2',), ('c1', 11, 12)])
+        assert list(chunk[POS_FIELD]) == [11, 1, 2, 3]
+
+        assert not varis.get_genome_regions([('c3', 1, 10)]).num_variations
+
+        try:
+            varis.get_genome_regions([('c1', 1)])
+            self.fail('ValueError expected')
+        except ValueError:
+            pass
 
 
 class ChunkPairsTest(unittest.TestCase):
@@ -448,6 +601,47 @@ class ChunkPairsTest(unittest.TestCase):
         expected = [(5, 5), (5, 8), (5, 11), (8, 8), (8, 11), (11, 11)]
         assert pos_pairs == expected
 
+    def test_chunk_pairs_several_chroms(self):
+        poss = [5, 7, 8, 10, 1, 2, 3, 4]
+        chroms = ['c1'] * 4 + ['c2'] * 4
+        varis = VariationsArrays()
+        varis[POS_FIELD] = numpy.array(poss)
+        varis[CHROM_FIELD] = numpy.array(chroms)
+
+        pairs = list(varis.iterate_chunk_pairs(max_dist=100, chunk_size=2))
+        pos_pairs = [(pair['chunk1'][POS_FIELD][0], pair['chunk2'][POS_FIELD][0]) for pair in pairs]
+        expected = [(5, 5), (5, 8), (8, 8), (1, 1), (1, 3), (3, 3)]
+        assert pos_pairs == expected
+
+
+class LazyRowsTest(unittest.TestCase):
+    def test_lazy_rows(self):
+        varis = VariationsArrays()
+        varis[POS_FIELD] = numpy.array([5, 7, 8, 10, 11, 12])
+        varis[CHROM_FIELD] = numpy.array(['c1'] * 6)
+        varis[GT_FIELD] = numpy.arange(24).reshape((6, 2, 2))
+
+        lazy = LazyRowsVariations(varis)
+        assert lazy.num_variations == 6
+        lazy = lazy.get_chunk(numpy.array([True, False, True, True, False,
+                                           True]))
+        lazy = lazy.get_chunk(slice(1, None), ignored_fields=[CHROM_FIELD])
+        assert lazy.num_variations == 3
+        assert sorted(lazy.keys()) == [GT_FIELD, POS_FIELD]
+        # no field has been copied
+        assert not lazy._hArrays
+        assert list(lazy[POS_FIELD]) == [8, 10, 12]
+
+        del lazy[POS_FIELD]
+        lazy[POS_FIELD] = numpy.array([1, 2, 3])
+        lazy = lazy.get_chunk(numpy.array([False, True, True]))
+        chunk = lazy.materialize()
+        assert isinstance(chunk, VariationsArrays)
+        assert list(chunk[POS_FIELD]) == [2, 3]
+        assert numpy.all(chunk[GT_FIELD] == varis[GT_FIELD][[3, 5]])
+        # the original chunk is not modified
+        assert list(varis[POS_FIELD]) == [5, 7, 8, 10, 11, 12]
+
 
 class GetHaploidTest(unittest.TestCase):
 
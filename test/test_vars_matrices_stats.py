@@ -10,13 +10,14 @@ from os.path import join
 from functools import partial
 from io import StringIO
 import math
+from unittest.mock import patch
 
 import numpy
 
 from variation import AD_FIELD
 from variation.variations.vars_matrices import VariationsH5, VariationsArrays
 from variation.variations.stats import (calc_maf, calc_mac, histogram,
-                                        histogram_for_chunks,
+                                        histogram_for_chunks, HistogramSketch,
                                         _calc_maf_depth,
                                         calc_missing_gt, calc_obs_het,
                                         calc_obs_het_by_sample,
@@ -38,13 +39,15 @@ from variation.variations.stats import (calc_maf, calc_mac, histogram,
                                         calc_call_dp_distrib_for_a_sample,
                                         calc_depth_mean_by_sample,
                                         calc_stats_by_sample,
+                                        calc_sample_qc,
                                         histograms_for_columns,
+                                        histograms_per_sample,
                                         write_stats_by_sample,
                                         calc_expected_het,
                                         calc_unbias_expected_het,
                                         calc_allele_observation_based_maf,
                                         _calc_a1, calc_tajima_d_and_pi)
-from variation import DP_FIELD
+from variation import DP_FIELD, CHROM_FIELD, POS_FIELD
 from test.test_utils import TEST_DATA_DIR
 
 
@@ -163,6 +166,27 @@ class StatsTest(unittest.TestCase):
         assert numpy.allclose(bins, bins_expected)
         assert numpy.allclose(distrib, dist_expected)
 
+    def test_histogram_sketch(self):
+        values = numpy.random.normal(size=1000)
+        values[::10] = numpy.nan
+        sketch1 = HistogramSketch()
+        sketch1.add(values[:500])
+        sketch2 = HistogramSketch()
+        sketch2.add(values[500:])
+        sketch1.merge(sketch2)
+        counts, edges = sketch1.calc_histogram(n_bins=10)
+        expected = histogram(values, n_bins=10)
+        assert numpy.all(counts == expected[0])
+        assert numpy.allclose(edges, expected[1])
+
+        # with more distinct values than allowed they are rounded
+        sketch = HistogramSketch(max_distinct_values=100)
+        sketch.add(values)
+        counts, edges = sketch.calc_histogram(n_bins=10)
+        assert sketch.num_values == 900
+        assert numpy.allclose(edges, expected[1])
+        assert numpy.abs(counts - expected[0]).sum() < 100
+
     def test_calculate_maf_depth(self):
         variations = {'/calls/AO': numpy.array([[[0, 0], [5, 0], [-1, -1],
                                                  [0, -1], [0, 0], [0, 10],
@@ -270,9 +294,17 @@ class StatsTest(unittest.TestCase):
         hdf5 = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
         snps = VariationsArrays()
         snps.put_chunks(hdf5.iterate_chunks())
-        density_h5 = list(calc_snp_density(hdf5, 1000))
+        density = calc_snp_density(hdf5, 1000)
+        assert isinstance(density, numpy.ndarray)
+        assert density.dtype == numpy.int32
+        assert density.shape == (hdf5.num_variations,)
+        density_h5 = list(density)
         density_array = list(calc_snp_density(snps, 1000))
         assert density_array == density_h5
+        chroms, poss = snps[CHROM_FIELD], snps[POS_FIELD]
+        expected = [numpy.sum((chroms == chrom) & (abs(poss - pos) <= 499.5))
+                    for chrom, pos in zip(chroms, poss)]
+        assert density_array == expected
         var = {'/variations/chrom': numpy.array(['ch', 'ch', 'ch', 'ch', 'ch',
                                                  'ch', 'ch', 'ch', 'ch', 'ch',
                                                  'ch', 'ch', 'ch', 'ch']),
@@ -290,6 +322,9 @@ class StatsTest(unittest.TestCase):
         dens_var = list(calc_snp_density(var, 11))
         expected = [3, 3, 3, 4, 4, 4, 4, 1, 1, 1, 1, 1, 1, 1]
         assert dens_var == expected
+        for chunk_size in (1, 3, 4, None):
+            dens_var = list(calc_snp_density(var, 11, chunk_size=chunk_size))
+            assert dens_var == expected
 
         var = {'/variations/chrom': numpy.array(['c1', 'c4', 'c5', 'c2', 'c2',
                                                  'c2', 'c2', 'c2', 'c2', 'c2',
@@ -302,8 +337,9 @@ class StatsTest(unittest.TestCase):
 
         var = {'/variations/chrom': numpy.array([]),
                '/variations/pos': numpy.array([])}
-        dens_var = list(calc_snp_density(var, 11))
-        assert dens_var == []
+        dens_var = calc_snp_density(var, 11)
+        assert dens_var.dtype == numpy.int32
+        assert dens_var.shape == (0,)
 
         var = {'/variations/chrom': numpy.array([1]),
                '/variations/pos': numpy.array([1])}
@@ -437,6 +473,14 @@ class StatsTest(unittest.TestCase):
                                     chunk_size=None)
         assert result.shape[0] == 0
 
+        # more alleles than the ones found in the variations
+        variations = VariationsArrays()
+        variations['/calls/GT'] = numpy.array([[[0, 0], [0, 1], [1, 1]]])
+        variations['/variations/alt'] = numpy.array([[b'T', b'G']])
+        result = calc_hwe_chi2_test(variations, num_allele=3,
+                                    min_num_genotypes=0, chunk_size=None)
+        assert result.shape == (0, 2)
+
         variations = VariationsArrays()
         gts = numpy.array([[[0, 0], [0, 1], [0, 1], [0, 0], [0, 1], [0, 0],
                             [0, 0], [0, 1], [1, 1], [0, 0]],
@@ -590,6 +634,22 @@ class StatsTest(unittest.TestCase):
         for line, exp in zip(pos_stats.to_bedGraph(), bg_lines[1:]):
             assert line.strip() == exp
 
+        # Overlapping windows, the chroms are not sorted
+        chrom = numpy.array(['chr2', 'chr1', 'chr2', 'chr1', 'chr1', 'chr2'])
+        pos = numpy.array([1, 10, 3, 12, 20, 4])
+        stat = numpy.array([1, 2, 3, 4, numpy.nan, 6])
+        pos_stats = PositionalStatsCalculator(chrom, pos, stat, window_size=4,
+                                              step=2)
+        windows = pos_stats.calc_window_stat()
+        assert list(windows.chrom) == ['chr1', 'chr2', 'chr2']
+        assert list(windows.pos) == [10, 1, 3]
+        assert numpy.allclose(windows.stat, [6 / 4, 10 / 4, 9 / 4])
+        pos_stats = PositionalStatsCalculator(chrom, pos, stat, window_size=4,
+                                              step=1)
+        windows = pos_stats.calc_window_stat()
+        assert list(windows.pos) == [10, 11, 1, 2, 3]
+        assert numpy.allclose(windows.stat, numpy.array([6, 4, 10, 9, 9]) / 4)
+
     def test_calc_r2_windows(self):
         variations = VariationsArrays()
         chrom = numpy.array([b'chr1'] * 4)
@@ -609,6 +669,45 @@ class StatsTest(unittest.TestCase):
                               equal_nan=True)
         assert numpy.all(chrom == b'chr1')
 
+        variations = VariationsArrays()
+        variations['/variations/chrom'] = numpy.array([b'chr1'] * 3 +
+                                                      [b'chr2'] * 3)
+        variations['/variations/pos'] = numpy.array([1, 4, 6, 1, 3, 5])
+        variations['/calls/GT'] = numpy.concatenate([gts[:3], gts[:3]])
+        chrom, pos, r2 = calc_r2_windows(variations, 4, step=2)
+        assert list(chrom) == [b'chr1', b'chr1', b'chr1', b'chr2', b'chr2']
+        assert list(pos) == [1, 3, 5, 1, 3]
+        assert numpy.allclose(r2, [numpy.nan, 1, numpy.nan, 1, numpy.nan],
+                              equal_nan=True)
+        res = calc_r2_windows(variations, 4, step=2, n_workers=2)
+        assert numpy.all(res[0] == chrom)
+        assert numpy.all(res[1] == pos)
+        assert numpy.allclose(res[2], r2, equal_nan=True)
+
+        # the chromosomes are not sorted by name
+        variations = VariationsArrays()
+        variations['/variations/chrom'] = numpy.array([b'chr10'] * 3 +
+                                                      [b'chr2'] * 3)
+        variations['/variations/pos'] = numpy.array([1, 4, 6, 1, 3, 5])
+        variations['/calls/GT'] = numpy.concatenate([gts[:3], gts[:3]])
+        for n_workers in (None, 2):
+            res = calc_r2_windows(variations, 4, step=2, n_workers=n_workers)
+            assert list(res[0]) == [b'chr10'] * 3 + [b'chr2'] * 2
+            assert numpy.all(res[1] == pos)
+            assert numpy.allclose(res[2], r2, equal_nan=True)
+
+        # the variations of a chromosome are not together
+        variations = VariationsArrays()
+        variations['/variations/chrom'] = numpy.array([b'chr1', b'chr2',
+                                                       b'chr1'])
+        variations['/variations/pos'] = numpy.array([1, 4, 6])
+        variations['/calls/GT'] = gts[:3]
+        try:
+            calc_r2_windows(variations, 4, step=2)
+            self.fail('RuntimeError expected')
+        except RuntimeError:
+            pass
+
 
 class SampleStatsTest(unittest.TestCase):
     def test_calc_maf_depth_distribs_per_sample(self):
@@ -699,7 +798,6 @@ class SampleStatsTest(unittest.TestCase):
                                                     n_bins=15)
         assert cnts['hom'].shape == (15,)
         assert cnts['het'].shape == (15,)
-        return
         cnts2, _ = calc_call_dp_distrib_for_a_sample(hdf5, sample='1_17_1_gbs',
                                                      n_bins=15,
                                                      chunk_size=None)
@@ -882,6 +980,52 @@ class SampleStatsTest(unittest.TestCase):
         lines = fhand.getvalue().splitlines()
         assert 'sample\tcall_rate\theterozygosity\tmean_dp' in lines[0]
 
+    def test_calc_sample_qc(self):
+        gts = numpy.array([[[0, 0], [0, 1], [0, -1], [-1, -1]],
+                           [[0, 0], [0, 0], [2, 2], [-1, -1]],
+                           [[1, 1], [0, 0], [0, 0], [-1, -1]]])
+        dps = numpy.array([[4, 5, 1, -1],
+                           [4, 5, 1, 0],
+                           [3, 3, 1, -1]])
+        varis = {'/calls/GT': gts, DP_FIELD: dps}
+        qc = calc_sample_qc(varis, chunk_size=None, dp_n_bins=5)
+        assert qc['n_vars'] == 3
+        assert numpy.all(qc['called_gts'] == [3, 3, 2, 0])
+        assert numpy.all(qc['het'] == [0, 1, 0, 0])
+        assert numpy.all(qc['singletons'] == [1, 1, 1, 0])
+        assert numpy.allclose(qc['called_gt_rate'], [1, 1, 2 / 3, 0])
+        assert numpy.allclose(qc['obs_het'][:3], [0, 1 / 3, 0])
+        assert numpy.allclose(qc['mean_dp'], [11 / 3, 13 / 3, 1, 0])
+        dp_hists = qc['dp_hists']
+        assert numpy.allclose(dp_hists['bin_edges'], [0, 1, 2, 3, 4, 5])
+        assert numpy.all(dp_hists['dp_het_counts'][1] == [0, 0, 0, 0, 1])
+        assert numpy.all(dp_hists['dp_hom_counts'][2] == [0, 2, 0, 0, 0])
+        assert numpy.all(dp_hists['dp_missing_counts'][2] == [0, 1, 0, 0, 0])
+
+        res = calc_stats_by_sample(varis, sample_qc=qc)
+        assert numpy.allclose(res['called_gt_rate'], qc['called_gt_rate'])
+
+        varis = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+        qc1 = calc_sample_qc(varis, chunk_size=None)
+        qc2 = calc_sample_qc(varis, chunk_size=100)
+        for key in ['called_gts', 'het', 'hom', 'singletons', 'mean_dp']:
+            assert numpy.allclose(qc1[key], qc2[key])
+        for key in qc1['dp_hists']:
+            assert numpy.all(qc1['dp_hists'][key] == qc2['dp_hists'][key])
+
+        # the integer depths are binned at the end, without a previous
+        # pass to look for their range
+        with patch('variation.variations.stats.calc_min_max') as min_max:
+            qc3 = calc_sample_qc(varis, chunk_size=100, n_workers=2)
+            assert not min_max.called
+        for key in qc1['dp_hists']:
+            assert numpy.all(qc1['dp_hists'][key] == qc3['dp_hists'][key])
+
+        varis = {'/calls/GT': gts, DP_FIELD: dps.astype(float)}
+        qc2 = calc_sample_qc(varis, chunk_size=None, dp_n_bins=5)
+        for key in qc['dp_hists']:
+            assert numpy.allclose(qc['dp_hists'][key], qc2['dp_hists'][key])
+
     def test_hist_for_cols(self):
         data = [[1, 1, 1, 1],
                 [2, 2, 1, 1],
@@ -894,6 +1038,79 @@ class SampleStatsTest(unittest.TestCase):
         assert numpy.allclose(expected_cnts, counts)
         assert numpy.allclose(expected_edges, edges)
 
+    def test_hists_per_sample(self):
+        data = numpy.array([[1, 2, -1],
+                            [2, 4, 3],
+                            [4, 4, 5]])
+        counts, edges = histograms_per_sample(data, n_bins=2, range_=(1, 4))
+        assert numpy.all(counts == [[2, 1], [1, 2], [0, 1]])
+        assert numpy.allclose(edges, [1, 2.5, 4])
+
+        mask = data != 4
+        counts, _ = histograms_per_sample(data, n_bins=2, range_=(1, 4),
+                                          mask=mask)
+        assert numpy.all(counts == [[2, 0], [1, 0], [0, 1]])
+
+        classes = numpy.array([[0, 1, 0],
+                               [1, 1, -1],
+                               [0, 0, 1]])
+        counts, _ = histograms_per_sample(data, n_bins=2, range_=(1, 4),
+                                          classes=classes, n_classes=2)
+        assert numpy.all(counts[0] == [[1, 1], [0, 1], [0, 0]])
+        assert numpy.all(counts[1] == [[1, 0], [1, 1], [0, 0]])
+
+
+class ParallelStatsTest(unittest.TestCase):
+    def test_calc_stats_in_processes(self):
+        varis = VariationsH5(join(TEST_DATA_DIR, 'ril.hdf5'), mode='r')
+        calc_in_processes = partial(calc_maf, chunk_size=200, n_workers=2)
+        assert numpy.allclose(calc_in_processes(varis), calc_maf(varis),
+                              equal_nan=True)
+
+        calc_in_processes = partial(calc_inbreeding_coef, chunk_size=200,
+                                    n_workers=2)
+        assert numpy.allclose(calc_in_processes(varis),
+                              calc_inbreeding_coef(varis), equal_nan=True)
+
+        calc_in_processes = partial(calc_obs_het_by_sample, chunk_size=200,
+                                    n_workers=2)
+        assert numpy.allclose(calc_in_processes(varis),
+                              calc_obs_het_by_sample(varis), equal_nan=True)
+
+        assert numpy.all(calc_gt_type_stats(varis, chunk_size=200,
+                                            n_workers=2) ==
+                         calc_gt_type_stats(varis))
+
+        res1 = calc_stats_by_sample(varis, chunk_size=200, n_workers=2)
+        res2 = calc_stats_by_sample(varis)
+        assert numpy.allclose(res1['obs_het'], res2['obs_het'],
+                              equal_nan=True)
+        assert numpy.allclose(res1['dp_hists']['dp_het_counts'],
+                              res2['dp_hists']['dp_het_counts'])
+
+        distribs1, _ = calc_called_gts_distrib_per_depth(varis, depths=[1, 5],
+                                                         chunk_size=200,
+                                                         n_workers=2)
+        distribs2, _ = calc_called_gts_distrib_per_depth(varis, depths=[1, 5])
+        assert numpy.all(distribs1 == distribs2)
+
+        hist1, xbins1, _ = hist2d_allele_observations(varis, chunk_size=200,
+                                                      n_workers=2)
+        hist2, xbins2, _ = hist2d_allele_observations(varis)
+        assert numpy.all(hist1 == hist2)
+        assert numpy.allclose(xbins1, xbins2)
+
+        distribs1, _ = calc_maf_depth_distribs_per_sample(varis,
+                                                          chunk_size=200,
+                                                          n_workers=2)
+        distribs2, _ = calc_maf_depth_distribs_per_sample(varis)
+        assert numpy.all(distribs1 == distribs2)
+
+        counts1, _ = histogram_for_chunks(varis, calc_obs_het, chunk_size=200,
+                                          n_workers=2)
+        counts2, _ = histogram_for_chunks(varis, calc_obs_het, chunk_size=200)
+        assert numpy.all(counts1 == counts2)
+
 
 class TajimaDTest(unittest.TestCase):
 
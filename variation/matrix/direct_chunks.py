@@ -0,0 +1,183 @@
+# Missing docstring
+# pylint: disable=C0111
+
+from itertools import product
+import zlib
+
+import numpy
+from h5py import h5z
+
+# The fletcher32 sums of HDF5 are folded into 16 bits, that keeps them
+# congruent modulo 0xffff
+FLETCHER32_MOD = 0xffff
+
+SUPPORTED_FILTERS = (h5z.FILTER_SHUFFLE, h5z.FILTER_DEFLATE,
+                     h5z.FILTER_FLETCHER32)
+
+
+class UnsupportedFilterError(Exception):
+    pass
+
+
+def get_dset_filters(dset):
+    plist = dset.id.get_create_plist()
+    filters = []
+    for idx in range(plist.get_nfilters()):
+        filter_id, _, values, _ = plist.get_filter(idx)
+        if filter_id not in SUPPORTED_FILTERS:
+            msg = 'HDF5 filter not supported for direct chunk writes: '
+            msg += str(filter_id)
+            raise UnsupportedFilterError(msg)
+        filters.append((filter_id, values))
+    return filters
+
+
+def _shuffle(data, itemsize):
+    if itemsize <= 1:
+        return data
+    bytes_ = numpy.frombuffer(data, dtype=numpy.uint8)
+    return bytes_.reshape((-1, itemsize)).T.tobytes()
+
+
+def _reduce_fletcher32_sum(sum_, is_zero):
+    # Folding never turns a positive sum into 0, so 0xffff is kept for the
+    # positive multiples of the modulus
+    sum_ %= FLETCHER32_MOD
+    if sum_ == 0 and not is_zero:
+        return FLETCHER32_MOD
+    return sum_
+
+
+def fletcher32(data):
+    # Same result as H5_checksum_fletcher32. HDF5 folds the sums every 360
+    # words, but the folded sums are just the sums modulo 0xffff, so sum1 is
+    # the sum of the words and sum2 the sum of the words weighted by the
+    # number of times that they are added to it.
+    bytes_ = numpy.frombuffer(data, dtype=numpy.uint8)
+    n_words = bytes_.shape[0] // 2
+    words = bytes_[:n_words * 2].reshape((n_words, 2)).astype(numpy.int64)
+    words = (words[:, 0] << 8) | words[:, 1]
+    weights = numpy.arange(n_words, 0, -1, dtype=numpy.int64)
+    weights %= FLETCHER32_MOD
+
+    sum1 = int(words.sum())
+    sum2 = int(numpy.dot(words, weights))
+    if bytes_.shape[0] % 2:
+        sum1 += int(bytes_[-1]) << 8
+        sum2 += sum1
+
+    is_zero = sum1 == 0
+    sum1 = _reduce_fletcher32_sum(sum1, is_zero)
+    sum2 = _reduce_fletcher32_sum(sum2, is_zero)
+    return (sum2 << 16) | sum1
+
+
+def compress_chunk(array, filters):
+    data = numpy.ascontiguousarray(array).tobytes()
+    itemsize = array.dtype.itemsize
+    for filter_id, values in filters:
+        if filter_id == h5z.FILTER_SHUFFLE:
+            data = _shuffle(data, itemsize)
+        elif filter_id == h5z.FILTER_DEFLATE:
+            level = values[0] if values else 4
+            data = zlib.compress(data, level)
+        elif filter_id == h5z.FILTER_FLETCHER32:
+            checksum = fletcher32(data)
+            data += numpy.array([checksum], dtype='<u4').tobytes()
+    return data
+
+
+def _compress_chunk_task(task):
+    offset, array, filters = task
+    return offset, compress_chunk(array, filters)
+
+
+class DirectChunkWriter:
+    '''It appends rows to an HDF5 dataset compressing whole storage chunks
+
+    The rows are kept in memory until a storage chunk is complete, the
+    complete chunks are returned by append as tasks to be compressed, by
+    compress_chunk, and written, by write_chunk, in any order.
+    The last incomplete chunk is written padded with the fill value by flush.
+    '''
+
+    def __init__(self, dset):
+        self.dset = dset
+        self.filters = get_dset_filters(dset)
+        self._chunk_shape = dset.chunks
+        self._chunk_len = dset.chunks[0]
+        self._fillvalue = dset.fillvalue
+
+        n_rows = dset.shape[0]
+        self._pending_start = (n_rows // self._chunk_len) * self._chunk_len
+        self._pending = dset[self._pending_start:n_rows]
+        self._dirty = False
+
+    def _chunks_in_rows(self, start, rows):
+        chunk_shape = self._chunk_shape
+        if rows.shape[0] < chunk_shape[0]:
+            padded_shape = (chunk_shape[0],) + rows.shape[1:]
+            padded = numpy.full(padded_shape, self._fillvalue,
+                                dtype=self.dset.dtype)
+            padded[:rows.shape[0]] = rows
+            rows = padded
+
+        other_dims = [range(0, dim_len, chunk_dim_len)
+                      for dim_len, chunk_dim_len in zip(rows.shape[1:],
+                                                        chunk_shape[1:])]
+        for other_offsets in product(*other_dims):
+            offset = (start,) + other_offsets
+            slice_ = tuple(slice(dim_start, dim_start + chunk_dim_len)
+                           for dim_start, chunk_dim_len in zip(offset[1:],
+                                                               chunk_shape[1:]))
+            chunk = rows[(slice(None),) + slice_]
+            if chunk.shape[1:] != chunk_shape[1:]:
+                padded = numpy.full(chunk_shape, self._fillvalue,
+                                    dtype=self.dset.dtype)
+                padded[tuple(slice(0, dim_len) for dim_len in chunk.shape)] = chunk
+                chunk = padded
+            yield offset, chunk
+
+    def append(self, rows):
+        dset = self.dset
+        n_rows = dset.shape[0] + rows.shape[0]
+        new_shape = (n_rows,) + dset.shape[1:]
+        dset.resize(new_shape)
+
+        pending = numpy.concatenate([self._pending, rows], axis=0)
+        n_full_rows = (pending.shape[0] // self._chunk_len) * self._chunk_len
+        tasks = []
+        for chunk_start in range(0, n_full_rows, self._chunk_len):
+            rows_in_chunk = pending[chunk_start:chunk_start + self._chunk_len]
+            start = self._pending_start + chunk_start
+            for offset, chunk in self._chunks_in_rows(start, rows_in_chunk):
+                tasks.append((offset, chunk, self.filters))
+        self._pending = pending[n_full_rows:]
+        self._pending_start += n_full_rows
+        self._dirty = bool(self._pending.shape[0])
+        return tasks
+
+    def write_chunk(self, offset, data):
+        self.dset.id.write_direct_chunk(offset, data)
+
+    def flush(self):
+        if not self._dirty:
+            return
+        for offset, chunk in self._chunks_in_rows(self._pending_start,
+                                                  self._pending):
+            self.write_chunk(offset, compress_chunk(chunk, self.filters))
+        self._dirty = False
+
+
+def write_chunk_tasks(writer_tasks, pool=None):
+    '''It compresses the tasks, in the pool if given, and writes them in order
+
+    writer_tasks is a list of (writer, task) tuples.
+    '''
+    tasks = [task for _, task in writer_tasks]
+    if pool is None:
+        compressed_chunks = map(_compress_chunk_task, tasks)
+    else:
+        compressed_chunks = pool.imap(_compress_chunk_task, tasks)
+    for (writer, _), (offset, data) in zip(writer_tasks, compressed_chunks):
+        writer.write_chunk(offset, data)
@@ -2,6 +2,7 @@
 # pylint: disable=C0111
 
 from functools import reduce, partial
+from itertools import combinations_with_replacement
 import operator
 
 import numpy
@@ -9,6 +10,12 @@ import matplotlib.pyplot as plt
 
 from variation.matrix.methods import iterate_matrix_chunks, is_dataset
 
+# The integer matrices are counted with a bincount if their range of values
+# is not larger than this
+MAX_VALUES_TO_BINCOUNT = 1024
+# Number of items whose bin indexes are calculated at once
+BINCOUNT_BLOCK_SIZE = 2 ** 22
+
 
 def _row_value_counter_array(array, value, axes):
     return (array == value).sum(axis=axes)
@@ -75,15 +82,12 @@ def counts_by_row(mat, missing_value=None, alleles=None):
                                     alleles=alleles)[0]
 
 
-def counts_and_allels_by_row(mat, missing_value=None, alleles=None):
-
+def _counts_and_allels_by_row_by_allele(mat, missing_value=None,
+                                        alleles=None):
     if alleles is None:
         alleles = sorted(numpy.unique(mat))
 
     allele_counts = None
-    # This algorithm is suboptimal, it would be better to go row per row
-    # the problem is a for snp in gts is very slow because the for in
-    # python is slow
     good_alleles = []
     for allele in alleles:
         if allele == missing_value:
@@ -109,6 +113,124 @@ def counts_and_allels_by_row(mat, missing_value=None, alleles=None):
     return allele_counts, good_alleles
 
 
+def _count_values_by_row(mat, min_value, n_values):
+    '''It counts every integer value in every row with one bincount
+
+    The values of every row are offset to their own range of bins. The rows
+    are processed in blocks to limit the memory used by the bin indexes.
+    '''
+    n_rows = mat.shape[0]
+    mat = mat.reshape((n_rows, -1))
+    rows_per_block = max(1, BINCOUNT_BLOCK_SIZE // max(mat.shape[1], 1))
+    counts = numpy.empty((n_rows, n_values), dtype=numpy.int64)
+    for start in range(0, n_rows, rows_per_block):
+        block = mat[start:start + rows_per_block]
+        n_block_rows = block.shape[0]
+        offsets = numpy.arange(n_block_rows, dtype=numpy.int64) * n_values
+        offsets -= min_value
+        bins = block.astype(numpy.int64)
+        bins += offsets[:, None]
+        block_counts = numpy.bincount(bins.ravel(),
+                                      minlength=n_block_rows * n_values)
+        counts[start:start + n_block_rows] = block_counts.reshape((n_block_rows,
+                                                                   n_values))
+    return counts
+
+
+def counts_and_allels_by_row(mat, missing_value=None, alleles=None):
+    if is_dataset(mat):
+        mat = mat[...]
+    if (len(mat.shape) < 2 or not mat.size or
+            not numpy.issubdtype(mat.dtype, numpy.integer)):
+        return _counts_and_allels_by_row_by_allele(mat,
+                                                   missing_value=missing_value,
+                                                   alleles=alleles)
+    min_value, max_value = int(mat.min()), int(mat.max())
+    n_values = max_value - min_value + 1
+    if n_values > MAX_VALUES_TO_BINCOUNT:
+        return _counts_and_allels_by_row_by_allele(mat,
+                                                   missing_value=missing_value,
+                                                   alleles=alleles)
+
+    counts = _count_values_by_row(mat, min_value, n_values)
+    if alleles is None:
+        present = numpy.nonzero(numpy.any(counts, axis=0))[0]
+        alleles = [mat.dtype.type(idx + min_value) for idx in present]
+
+    good_alleles = [allele for allele in alleles if allele != missing_value]
+    if not good_alleles:
+        return None, None
+
+    allele_counts = numpy.zeros((counts.shape[0], len(good_alleles)),
+                                dtype=counts.dtype)
+    for col, allele in enumerate(good_alleles):
+        if min_value <= allele <= max_value:
+            allele_counts[:, col] = counts[:, int(allele) - min_value]
+    return allele_counts, good_alleles
+
+
+def _calc_n_multisets(n_values, max_size):
+    '''The number of multisets of every size taken from every number of values
+
+    n_multisets[n, size] is the number of multisets of that size that can be
+    formed with n values.
+    '''
+    n_multisets = numpy.zeros((n_values + 1, max_size + 1), dtype=numpy.int64)
+    n_multisets[:, 0] = 1
+    for n in range(1, n_values + 1):
+        for size in range(1, max_size + 1):
+            n_multisets[n, size] = (n_multisets[n - 1, size] +
+                                    n_multisets[n, size - 1])
+    return n_multisets
+
+
+def calc_gt_classes(n_alleles, ploidy):
+    'The unordered genotypes, in the order of their classes'
+    return list(combinations_with_replacement(range(n_alleles), ploidy))
+
+
+def count_gt_classes_by_row(gts, n_alleles=None):
+    '''It counts the calls of every unordered genotype in every row
+
+    The alleles of every call are sorted and the class of the genotype is
+    its rank in the combinations with replacement of the alleles. All classes
+    are counted with one bincount. The calls with an allele out of
+    [0, n_alleles), like the missing ones, are not counted.
+    It returns a (n_rows, n_gt_classes) matrix and the genotype of every
+    class.
+    '''
+    if is_dataset(gts):
+        gts = gts[...]
+    n_rows, _, ploidy = gts.shape
+    if n_alleles is None:
+        n_alleles = max(int(gts.max()) + 1, 1) if gts.size else 1
+    gt_classes = calc_gt_classes(n_alleles, ploidy)
+    n_classes = len(gt_classes)
+    if not n_rows:
+        return numpy.zeros((0, n_classes), dtype=numpy.int64), gt_classes
+
+    gts = numpy.sort(gts, axis=2).astype(numpy.int64)
+    not_counted = numpy.any(numpy.logical_or(gts < 0, gts >= n_alleles),
+                            axis=2)
+    gts[not_counted] = 0
+
+    # The rank of a sorted genotype is, for every allele, the number of
+    # genotypes with the same previous alleles and a lower one in its place
+    n_multisets = _calc_n_multisets(n_alleles, ploidy)
+    classes = numpy.zeros(gts.shape[:2], dtype=numpy.int64)
+    prev_alleles = numpy.zeros(gts.shape[:2], dtype=numpy.int64)
+    for idx in range(ploidy):
+        alleles = gts[:, :, idx]
+        size = ploidy - idx
+        classes += n_multisets[n_alleles - prev_alleles, size]
+        classes -= n_multisets[n_alleles - alleles, size]
+        prev_alleles = alleles
+    classes[not_counted] = n_classes
+
+    counts = _count_values_by_row(classes, 0, n_classes + 1)
+    return counts[:, :n_classes], gt_classes
+
+
 def plot_hist(hist, bins, print_plot=False):
     width = 0.7 * (bins[1] - bins[0])
     center = (bins[:-1] + bins[1:]) / 2
@@ -32,6 +32,8 @@ def is_variable(variations, samples):
 
 
 class IsVariableAnnotator():
+    required_fields = [GT_FIELD]
+
     def __init__(self, annot_id, samples=None):
         self.samples = samples
         self.annot_id = annot_id
@@ -0,0 +1,171 @@
+# Missing docstring
+# pylint: disable=C0111
+
+from contextlib import contextmanager
+
+import numpy
+
+from variation.matrix.stats import counts_and_allels_by_row
+from variation.matrix.methods import is_dataset, is_missing
+
+# The intermediate results calculated from the genotype matrices are stored
+# here while an intermediates_cache context is active
+_CACHE = None
+
+_NOT_FOUND = object()
+
+COUNTS_AND_ALLELES = 'counts_and_alleles'
+IS_MISSING = 'is_missing'
+IS_HOM = 'is_hom'
+GTS012 = 'gts012'
+SAMPLES = 'samples'
+
+
+class _IntermediatesCache:
+    def __init__(self):
+        # the matrices are kept to avoid the reuse of their ids
+        self._values = {}
+        self._parents = {}
+
+    def _lookup(self, mat, key, derive_funct):
+        try:
+            cached_mat, values = self._values[id(mat)]
+        except KeyError:
+            cached_mat, values = mat, {}
+        if cached_mat is mat and key in values:
+            return values[key]
+
+        if derive_funct is None:
+            return _NOT_FOUND
+        try:
+            child_mat, parent_mat, rows = self._parents[id(mat)]
+        except KeyError:
+            return _NOT_FOUND
+        if child_mat is not mat:
+            return _NOT_FOUND
+        parent_value = self._lookup(parent_mat, key, derive_funct)
+        if parent_value is _NOT_FOUND:
+            return _NOT_FOUND
+        value = derive_funct(parent_value, rows)
+        self.store(mat, key, value)
+        return value
+
+    def store(self, mat, key, value):
+        try:
+            cached_mat, values = self._values[id(mat)]
+        except KeyError:
+            cached_mat = None
+        if cached_mat is not mat:
+            values = {}
+            self._values[id(mat)] = mat, values
+        values[key] = value
+
+    def get(self, mat, key, calc_funct, derive_funct=None):
+        value = self._lookup(mat, key, derive_funct)
+        if value is _NOT_FOUND:
+            value = calc_funct(mat)
+            self.store(mat, key, value)
+        return value
+
+    def add_row_subset(self, parent_mat, mat, rows):
+        self._parents[id(mat)] = mat, parent_mat, rows
+
+    def clear(self):
+        self._values = {}
+        self._parents = {}
+
+
+@contextmanager
+def intermediates_cache():
+    '''The intermediates calculated from the same GT matrix are reused
+
+    The intermediates for a matrix created by selecting rows from another
+    one are calculated from the intermediates of the original matrix.
+    '''
+    global _CACHE
+    previous_cache = _CACHE
+    _CACHE = _IntermediatesCache()
+    try:
+        yield _CACHE
+    finally:
+        _CACHE = previous_cache
+
+
+def get_intermediate(mat, key, calc_funct, derive_funct=None):
+    if _CACHE is None or is_dataset(mat):
+        return calc_funct(mat)
+    return _CACHE.get(mat, key, calc_funct, derive_funct)
+
+
+def register_row_subset(parent_mat, mat, rows):
+    if _CACHE is None or is_dataset(parent_mat) or is_dataset(mat):
+        return
+    _CACHE.add_row_subset(parent_mat, mat, rows)
+
+
+def forget_intermediates():
+    'It should be called when a cached matrix is modified in place'
+    if _CACHE is not None:
+        _CACHE.clear()
+
+
+def _take_rows(value, rows):
+    return value[rows]
+
+
+def _take_rows_from_counts_and_alleles(value, rows):
+    counts, alleles = value
+    if counts is None:
+        return None, None
+    counts = counts[rows]
+    # the alleles not found in the rows are removed, as counts_and_allels_by_row
+    # would do
+    present = numpy.any(counts > 0, axis=0)
+    if not numpy.any(present):
+        return None, None
+    if not numpy.all(present):
+        counts = counts[:, present]
+        alleles = [allele for allele, is_present in zip(alleles, present)
+                   if is_present]
+    return counts, alleles
+
+
+def calc_counts_and_alleles(gts, missing_value=None):
+    '''counts_and_allels_by_row for the genotypes, do not modify the result'''
+    def calc(gts):
+        return counts_and_allels_by_row(gts, missing_value=missing_value)
+    return get_intermediate(gts, (COUNTS_AND_ALLELES, missing_value), calc,
+                            _take_rows_from_counts_and_alleles)
+
+
+def calc_is_missing(gts, axis=2):
+    def calc(gts):
+        return is_missing(gts, axis=axis)
+    derive_funct = None if axis == 0 else _take_rows
+    return get_intermediate(gts, (IS_MISSING, axis), calc, derive_funct)
+
+
+def _calc_is_hom(gts):
+    if is_dataset(gts):
+        gts = gts[:]
+    is_hom = numpy.full(gts.shape[:-1], True, dtype=numpy.bool_)
+    for idx in range(1, gts.shape[2]):
+        is_hom = numpy.logical_and(gts[:, :, idx] == gts[:, :, idx - 1],
+                                   is_hom)
+    return is_hom
+
+
+def calc_is_hom_by_alleles(gts):
+    'The calls with all alleles equal, missing included'
+    return get_intermediate(gts, IS_HOM, _calc_is_hom, _take_rows)
+
+
+def calc_gts012(gts, calc_funct):
+    # the major allele is not derived from the original matrix
+    return get_intermediate(gts, GTS012, calc_funct)
+
+
+def get_samples_subset(variations, sample_filter, samples):
+    'It returns the result of the sample_filter for the given variations'
+    return get_intermediate(variations, (SAMPLES, tuple(samples)),
+                            sample_filter)
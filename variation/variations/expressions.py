@@ -0,0 +1,426 @@
+# Missing docstring
+# pylint: disable=C0111
+
+import operator
+import re
+
+import numpy
+
+from variation import GT_FIELD
+from variation.matrix.methods import is_dataset
+from variation.variations.stats import (calc_maf, calc_mac, calc_obs_het,
+                                        calc_called_gt)
+from variation.variations.zone_maps import (MIN, MAX, N_MISSING, ZONE_ALL,
+                                            ZONE_NONE, ZONE_SOME)
+
+VARIATIONS_GROUP = '/variations/'
+CALLS_GROUP = '/calls/'
+
+_TOKEN_REGEX = re.compile(r'''\s*(?:
+    (?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)|
+    (?P<string>'[^']*'|"[^"]*")|
+    (?P<op>==|!=|<=|>=|<|>|&|\||~|\(|\)|,)|
+    (?P<name>/?[A-Za-z_]\w*(?:/\w+)*)
+    )''', re.VERBOSE)
+
+_COMPARISONS = {'==': operator.eq, '!=': operator.ne, '<': operator.lt,
+                '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+# the comparison with the operands swapped
+_SWAPPED_COMPARISONS = {'==': '==', '!=': '!=', '<': '>', '<=': '>=',
+                        '>': '<', '>=': '<='}
+
+
+def _calc_called_gt_rate(variations):
+    return calc_called_gt(variations, rates=True)
+
+
+def _calc_maf(variations):
+    return calc_maf(variations, chunk_size=None)
+
+
+def _calc_mac(variations):
+    return calc_mac(variations, chunk_size=None)
+
+
+# The stats that can be used in an expression, they are calculated by row
+# from the genotypes
+FUNCTIONS = {'maf': _calc_maf,
+             'mac': _calc_mac,
+             'obs_het': calc_obs_het,
+             'called_gt': _calc_called_gt_rate}
+
+
+def _tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = _TOKEN_REGEX.match(expression, pos)
+        if match is None or match.end() == pos:
+            msg = 'Malformed expression at position {}: {}'
+            raise ValueError(msg.format(pos, expression))
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        pos = match.end()
+    return tokens
+
+
+def _field_path(name, group):
+    if name.startswith('/'):
+        return name
+    if name.startswith('calls/'):
+        return '/' + name
+    return group + name
+
+
+def _combine_zones_and(zones):
+    if ZONE_NONE in zones:
+        return ZONE_NONE
+    if all(zone == ZONE_ALL for zone in zones):
+        return ZONE_ALL
+    return ZONE_SOME
+
+
+def _combine_zones_or(zones):
+    if ZONE_ALL in zones:
+        return ZONE_ALL
+    if all(zone == ZONE_NONE for zone in zones):
+        return ZONE_NONE
+    return ZONE_SOME
+
+
+class _Literal:
+    fields = ()
+    uses_functions = False
+
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, variations, values):
+        return self.value
+
+
+class _Field:
+    uses_functions = False
+
+    def __init__(self, path):
+        self.path = path
+        self.fields = (path,)
+
+    def evaluate(self, variations, values):
+        # every field is read once per chunk
+        try:
+            return values[self.path]
+        except KeyError:
+            pass
+        try:
+            mat = variations[self.path]
+        except KeyError:
+            msg = 'Field used in the expression not in the variations: {}'
+            raise RuntimeError(msg.format(self.path))
+        if is_dataset(mat):
+            mat = mat[:]
+        if len(mat.shape) != 1:
+            msg = 'Only one dimensional fields can be used in an expression: '
+            raise ValueError(msg + self.path)
+        values[self.path] = mat
+        return mat
+
+
+class _Function:
+    uses_functions = True
+
+    def __init__(self, name, field_path):
+        if name not in FUNCTIONS:
+            raise ValueError('Unknown function in expression: ' + name)
+        if field_path != GT_FIELD:
+            msg = 'The functions are calculated from the genotypes, not: '
+            raise ValueError(msg + field_path)
+        self.name = name
+        self.fields = (field_path,)
+
+    def evaluate(self, variations, values):
+        key = 'function', self.name
+        try:
+            return values[key]
+        except KeyError:
+            pass
+        value = FUNCTIONS[self.name](variations)
+        values[key] = value
+        return value
+
+
+def _as_operand_of(value, array):
+    if isinstance(value, str) and array.dtype.kind == 'S':
+        return value.encode()
+    return value
+
+
+class _Comparison:
+    def __init__(self, left, op, right):
+        if isinstance(left, _Literal) and not isinstance(right, _Literal):
+            left, right = right, left
+            op = _SWAPPED_COMPARISONS[op]
+        self.left = left
+        self.op = op
+        self.right = right
+        self.fields = tuple(left.fields) + tuple(right.fields)
+        self.uses_functions = left.uses_functions or right.uses_functions
+
+    def evaluate(self, variations, values):
+        left = self.left.evaluate(variations, values)
+        right = self.right.evaluate(variations, values)
+        if isinstance(right, numpy.ndarray) != isinstance(left, numpy.ndarray):
+            array = left if isinstance(left, numpy.ndarray) else right
+            left = _as_operand_of(left, array)
+            right = _as_operand_of(right, array)
+        with numpy.errstate(invalid='ignore'):
+            return _COMPARISONS[self.op](left, right)
+
+    def select_zone(self, zone_stats):
+        if not isinstance(self.left, _Field) or not isinstance(self.right,
+                                                               _Literal):
+            return ZONE_SOME
+        try:
+            field_stats = zone_stats[self.left.path]
+        except KeyError:
+            return ZONE_SOME
+        if field_stats[N_MISSING] or field_stats[MIN] is None:
+            return ZONE_SOME
+        min_, max_ = field_stats[MIN], field_stats[MAX]
+        value = self.right.value
+        if isinstance(value, str) and isinstance(min_, bytes):
+            value = value.encode()
+        compare = _COMPARISONS[self.op]
+        try:
+            if self.op == '==':
+                if min_ == value == max_:
+                    return ZONE_ALL
+                if value < min_ or value > max_:
+                    return ZONE_NONE
+                return ZONE_SOME
+            if self.op == '!=':
+                if min_ == value == max_:
+                    return ZONE_NONE
+                if value < min_ or value > max_:
+                    return ZONE_ALL
+                return ZONE_SOME
+            all_true = compare(min_, value) and compare(max_, value)
+            none_true = not compare(min_, value) and not compare(max_, value)
+        except TypeError:
+            return ZONE_SOME
+        if all_true:
+            return ZONE_ALL
+        if none_true:
+            return ZONE_NONE
+        return ZONE_SOME
+
+
+class _BooleanValue:
+    'A field or function used as a condition with no comparison'
+
+    def __init__(self, operand):
+        self.operand = operand
+        self.fields = operand.fields
+        self.uses_functions = operand.uses_functions
+
+    def evaluate(self, variations, values):
+        value = self.operand.evaluate(variations, values)
+        if not isinstance(value, numpy.ndarray) or value.dtype != numpy.bool_:
+            msg = 'Only boolean values can be used as conditions'
+            raise ValueError(msg)
+        return value
+
+    def select_zone(self, zone_stats):
+        return ZONE_SOME
+
+
+class _Not:
+    def __init__(self, operand):
+        self.operand = operand
+        self.fields = operand.fields
+        self.uses_functions = operand.uses_functions
+
+    def evaluate(self, variations, values):
+        return numpy.logical_not(self.operand.evaluate(variations, values))
+
+    def select_zone(self, zone_stats):
+        zone = self.operand.select_zone(zone_stats)
+        if zone == ZONE_ALL:
+            return ZONE_NONE
+        if zone == ZONE_NONE:
+            return ZONE_ALL
+        return ZONE_SOME
+
+
+class _And:
+    def __init__(self, operands):
+        # the conditions that only compare fields are evaluated first, so
+        # the stats are not calculated if no row is left
+        self.operands = sorted(operands,
+                               key=lambda operand: operand.uses_functions)
+        self.fields = tuple(field for operand in operands
+                            for field in operand.fields)
+        self.uses_functions = any(operand.uses_functions
+                                  for operand in operands)
+
+    def evaluate(self, variations, values):
+        result = None
+        for operand in self.operands:
+            if result is not None and not result.any():
+                break
+            selected = operand.evaluate(variations, values)
+            if result is None:
+                result = numpy.array(selected, dtype=numpy.bool_, copy=True)
+            else:
+                numpy.logical_and(result, selected, out=result)
+        return result
+
+    def select_zone(self, zone_stats):
+        return _combine_zones_and([operand.select_zone(zone_stats)
+                                   for operand in self.operands])
+
+
+class _Or(_And):
+    def evaluate(self, variations, values):
+        result = None
+        for operand in self.operands:
+            if result is not None and result.all():
+                break
+            selected = operand.evaluate(variations, values)
+            if result is None:
+                result = numpy.array(selected, dtype=numpy.bool_, copy=True)
+            else:
+                numpy.logical_or(result, selected, out=result)
+        return result
+
+    def select_zone(self, zone_stats):
+        return _combine_zones_or([operand.select_zone(zone_stats)
+                                  for operand in self.operands])
+
+
+class _Parser:
+    '''A recursive descent parser for the expressions
+
+    expression := and_expr ('|' and_expr)*
+    and_expr := condition ('&' condition)*
+    condition := '~' condition | '(' expression ')' | operand [cmp operand]
+    operand := number | string | field | function '(' field ')'
+    '''
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None, None
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise ValueError('Unexpected end of expression: ' +
+                             self.expression)
+        self.pos += 1
+        return token
+
+    def _expect(self, value):
+        kind, token = self._next()
+        if token != value or kind in ('string', 'name'):
+            msg = 'Expected {} and found {} in expression: {}'
+            raise ValueError(msg.format(value, token, self.expression))
+
+    def parse(self):
+        node = self._parse_or()
+        if self.pos != len(self.tokens):
+            msg = 'Unexpected {} in expression: {}'
+            raise ValueError(msg.format(self._peek()[1], self.expression))
+        return node
+
+    def _parse_or(self):
+        operands = [self._parse_and()]
+        while self._peek() == ('op', '|'):
+            self._next()
+            operands.append(self._parse_and())
+        return operands[0] if len(operands) == 1 else _Or(operands)
+
+    def _parse_and(self):
+        operands = [self._parse_condition()]
+        while self._peek() == ('op', '&'):
+            self._next()
+            operands.append(self._parse_condition())
+        return operands[0] if len(operands) == 1 else _And(operands)
+
+    def _parse_condition(self):
+        token = self._peek()
+        if token == ('op', '~'):
+            self._next()
+            return _Not(self._parse_condition())
+        if token == ('op', '('):
+            self._next()
+            node = self._parse_or()
+            self._expect(')')
+            return node
+        left = self._parse_operand()
+        kind, op = self._peek()
+        if kind == 'op' and op in _COMPARISONS:
+            self._next()
+            right = self._parse_operand()
+            if isinstance(left, _Literal) and isinstance(right, _Literal):
+                msg = 'A comparison requires a field or function: '
+                raise ValueError(msg + self.expression)
+            return _Comparison(left, op, right)
+        if isinstance(left, _Literal):
+            raise ValueError('A literal is not a condition: ' +
+                             self.expression)
+        return _BooleanValue(left)
+
+    def _parse_operand(self):
+        kind, token = self._next()
+        if kind == 'number':
+            if re.fullmatch(r'-?\d+', token):
+                return _Literal(int(token))
+            return _Literal(float(token))
+        if kind == 'string':
+            return _Literal(token[1:-1])
+        if kind == 'name':
+            if self._peek() == ('op', '('):
+                self._next()
+                kind, arg = self._next()
+                if kind != 'name':
+                    msg = 'A field is required as function argument: '
+                    raise ValueError(msg + self.expression)
+                self._expect(')')
+                return _Function(token, _field_path(arg, CALLS_GROUP))
+            return _Field(_field_path(token, VARIATIONS_GROUP))
+        msg = 'Unexpected {} in expression: {}'
+        raise ValueError(msg.format(token, self.expression))
+
+
+class CompiledExpression:
+    '''A boolean expression over the fields of the variations
+
+    The fields are given by its path or by its path relative to
+    /variations/, like qual or info/DP, the comparisons can be combined
+    with & (and), | (or) and ~ (not). The functions (maf, mac, obs_het and
+    called_gt) calculate the stat for every row from the genotypes, e.g.
+    "qual > 30 & info/DP < 500 & (chrom == 'ch01' | maf(GT) > 0.05)"
+    '''
+
+    def __init__(self, expression):
+        self.expression = expression
+        self._root = _Parser(expression).parse()
+        fields = []
+        for field in self._root.fields:
+            if field not in fields:
+                fields.append(field)
+        self.fields = fields
+
+    def evaluate(self, variations):
+        'It returns the rows for which the expression is true'
+        return self._root.evaluate(variations, {})
+
+    def select_zone(self, zone_stats):
+        return self._root.select_zone(zone_stats)
@@ -1,7 +1,6 @@
 
 import array
 from collections import Counter, OrderedDict, defaultdict
-import itertools
 
 import numpy
 from scipy.stats import chi2_contingency, poisson
@@ -11,15 +10,24 @@ from variation.variations.stats import (calc_maf, calc_obs_het, GT_FIELD,
                                         MIN_NUM_GENOTYPES_FOR_POP_STAT,
                                         calc_mac, calc_snp_density,
                                         histogram, DEF_NUM_BINS,
-                                        call_is_het,
-                                        calc_allele_observation_based_maf)
+                                        call_is_het, HistogramSketch,
+                                        calc_allele_observation_based_maf,
+                                        calc_sample_qc)
 from variation.variations.vars_matrices import VariationsArrays
+from variation.variations.chunk_cache import (calc_counts_and_alleles,
+                                              get_samples_subset,
+                                              forget_intermediates)
+from variation.variations.expressions import CompiledExpression
+from variation.variations.zone_maps import (select_zone_by_range, MIN, MAX,
+                                            N_MISSING, ZONE_ALL, ZONE_NONE,
+                                            ZONE_SOME)
 from variation import (MISSING_INT, SNPS_PER_CHUNK, MISSING_FLOAT, ALT_FIELD,
-                       CHROM_FIELD, POS_FIELD, MISSING_BYTE, REF_FIELD)
+                       CHROM_FIELD, POS_FIELD, MISSING_BYTE, REF_FIELD,
+                       QUAL_FIELD, AD_FIELD)
 from variation.matrix.methods import is_dataset
-from variation.iterutils import first, group_in_packets
-from variation.matrix.stats import (row_value_counter_fact,
-                                    counts_and_allels_by_row)
+from variation.iterutils import first
+from variation.matrix.stats import (counts_and_allels_by_row,
+                                    count_gt_classes_by_row)
 
 COUNTS = 'counts'
 EDGES = 'edges'
@@ -30,6 +38,7 @@ TOT = 'tot'
 FLT_STATS = 'flt_stats'
 SELECTED_VARS = 'selected_vars'
 DISCARDED_VARS = 'discarded_vars'
+HISTOGRAM_SKETCH = 'histogram_sketch'
 
 
 def _filter_no_row(chunk):
@@ -38,7 +47,21 @@ def _filter_no_row(chunk):
     return selector
 
 
+def _add_histogram_to_result(result, stats, step):
+    if step.sketch_histogram:
+        sketch = HistogramSketch()
+        sketch.add(stats)
+        result[HISTOGRAM_SKETCH] = sketch
+    else:
+        counts, edges = histogram(stats, n_bins=step.n_bins,
+                                  range_=step.range)
+        result[COUNTS] = counts
+        result[EDGES] = edges
+
+
 class _BaseFilter:
+    # The fields read by the filter, None if they are not known
+    required_fields = None
 
     def __init__(self, n_bins=DEF_NUM_BINS, range_=None, do_filtering=True,
                  do_histogram=None, samples=None, keep_missing=False,
@@ -63,6 +86,8 @@ class _BaseFilter:
 
         self.n_bins = n_bins
         self.range = range_
+        # if set, a sketch is returned instead of counts and edges
+        self.sketch_histogram = False
         self._samples = samples
         self._filter_samples = None
 
@@ -112,8 +137,10 @@ class _BaseFilter:
         if self.samples is None:
             vars_for_stat = variations
         else:
-            filter_samples = self._get_sample_filter()
-            vars_for_stat = filter_samples(variations)[FLT_VARS]
+            # the filters that use the same samples share the filtered chunk
+            vars_for_stat = get_samples_subset(variations,
+                                               self._get_sample_filter(),
+                                               self.samples)[FLT_VARS]
         return vars_for_stat
 
     def _calc_stat_for_filtered_samples(self, variations):
@@ -128,10 +155,7 @@ class _BaseFilter:
             return {}
         result = {}
         if self.do_histogram:
-            counts, edges = histogram(stats, n_bins=self.n_bins,
-                                      range_=self.range)
-            result[COUNTS] = counts
-            result[EDGES] = edges
+            _add_histogram_to_result(result, stats, self)
 
         if self.report_selection or self.do_filtering:
             selected_rows, flt_stats = self._select_rows(variations, stats)
@@ -153,6 +177,7 @@ class _BaseFilter:
 
 
 class IndelFilter():
+    required_fields = [ALT_FIELD]
 
     def __init__(self, do_filtering=True, report_selection=False,
                  return_discarded=False):
@@ -208,6 +233,7 @@ class IndelFilter():
 
 
 class MinCalledGTsFilter(_BaseFilter):
+    required_fields = [GT_FIELD]
 
     def __init__(self, min_called=None, rates=True, **kwargs):
         self.rates = rates
@@ -219,6 +245,7 @@ class MinCalledGTsFilter(_BaseFilter):
 
 
 class NoMissingGTsFilter(_BaseFilter):
+    required_fields = [GT_FIELD]
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -262,6 +289,7 @@ class NoMissingGTsFilter(_BaseFilter):
 
 
 class VariableAndNotAllMissing(_BaseFilter):
+    required_fields = [GT_FIELD]
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -338,6 +366,7 @@ class NoMissingGTsOrHetFilter(NoMissingGTsFilter):
 
 
 class MafFilter(_BaseFilter):
+    required_fields = [GT_FIELD]
 
     def __init__(self, min_maf=None, max_maf=None,
                  min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT,
@@ -354,6 +383,7 @@ class MafFilter(_BaseFilter):
 
 
 class AlleleObservationBasedMafFilter(_BaseFilter):
+    required_fields = [AD_FIELD]
 
     def __init__(self, min_maf=None, max_maf=None,
                  **kwargs):
@@ -368,6 +398,7 @@ class AlleleObservationBasedMafFilter(_BaseFilter):
 
 
 class MacFilter(_BaseFilter):
+    required_fields = [GT_FIELD]
 
     def __init__(self, min_mac=None, max_mac=None,
                  min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT, **kwargs):
@@ -396,6 +427,12 @@ class ObsHetFilter(_BaseFilter):
 
         super().__init__(**kwargs)
 
+    @property
+    def required_fields(self):
+        if self.min_call_dp:
+            return [GT_FIELD, DP_FIELD]
+        return [GT_FIELD]
+
     def _calc_stat(self, variations):
         return calc_obs_het(variations,
                             min_num_genotypes=self.min_num_genotypes,
@@ -403,6 +440,7 @@ class ObsHetFilter(_BaseFilter):
 
 
 class SNPQualFilter(_BaseFilter):
+    required_fields = [QUAL_FIELD]
 
     def __init__(self, min_qual=None, max_qual=None, **kwargs):
         self.min = min_qual
@@ -423,34 +461,144 @@ class SNPQualFilter(_BaseFilter):
             stat[numpy.isinf(stat)] = numpy.finfo(stat.dtype).max
         return stat
 
+    def select_zone(self, zone_stats):
+        try:
+            qual_stats = zone_stats[QUAL_FIELD]
+        except KeyError:
+            return ZONE_SOME
+        if (qual_stats[MIN] is not None and
+                numpy.isinf([qual_stats[MIN], qual_stats[MAX]]).any()):
+            # the stat used by the filter is not the inf qual
+            return ZONE_SOME
+        return select_zone_by_range(qual_stats, min_=self.min, max_=self.max,
+                                    keep_missing=self._keep_nan)
+
+
+def _merge_intervals(intervals):
+    '''It sorts and merges the overlapping half open intervals
+
+    It returns the starts and the ends of the merged intervals.
+    '''
+    starts, ends = [], []
+    for start, end in sorted(intervals):
+        if starts and start <= ends[-1]:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return numpy.array(starts), numpy.array(ends)
+
+
+class _RegionIndex:
+    '''The regions sorted and merged by chromosome
+
+    A region is a chromosome or a chromosome with the start and end, not
+    included, of an interval.
+    '''
+
+    def __init__(self, regions):
+        whole_chroms = set()
+        intervals = defaultdict(list)
+        for region in regions:
+            chrom = region[0]
+            if isinstance(chrom, (tuple, list)):
+                raise ValueError('Malformed region: ' + str(region))
+            if len(region) == 1:
+                whole_chroms.add(chrom)
+            else:
+                intervals[chrom].append((region[1], region[2]))
+        self.whole_chroms = whole_chroms
+        self.intervals = {chrom: _merge_intervals(chrom_intervals)
+                          for chrom, chrom_intervals in intervals.items()
+                          if chrom not in whole_chroms}
+        self.chroms = list(whole_chroms) + list(self.intervals.keys())
+
+    def _in_intervals(self, chrom, poss):
+        starts, ends = self.intervals[chrom]
+        interval_idxs = numpy.searchsorted(starts, poss, side='right') - 1
+        in_intervals = interval_idxs >= 0
+        interval_idxs[~in_intervals] = 0
+        in_intervals &= poss < ends[interval_idxs]
+        return in_intervals
+
+    def in_any_region(self, chroms, poss):
+        in_any_region = numpy.zeros((chroms.shape[0],), dtype=numpy.bool_)
+        if not chroms.shape[0]:
+            return in_any_region
+        chunk_chroms, chrom_idxs = numpy.unique(chroms, return_inverse=True)
+        # the rows of every chrom are grouped together
+        rows_by_chrom = numpy.argsort(chrom_idxs, kind='stable')
+        chrom_ends = numpy.cumsum(numpy.bincount(chrom_idxs,
+                                                 minlength=len(chunk_chroms)))
+        chrom_start = 0
+        for chrom, chrom_end in zip(chunk_chroms, chrom_ends):
+            rows = rows_by_chrom[chrom_start:chrom_end]
+            chrom_start = chrom_end
+            if chrom in self.whole_chroms:
+                in_any_region[rows] = True
+            elif chrom in self.intervals:
+                in_any_region[rows] = self._in_intervals(chrom, poss[rows])
+        return in_any_region
+
+    def select_zone(self, min_chrom, max_chrom, min_pos, max_pos):
+        for chrom in self.chroms:
+            if isinstance(chrom, bytes) != isinstance(min_chrom, bytes):
+                return ZONE_SOME
+        if min_chrom != max_chrom:
+            # with several chroms in the zone the positions can not be
+            # compared
+            for chrom in self.chroms:
+                if min_chrom <= chrom <= max_chrom:
+                    return ZONE_SOME
+            return ZONE_NONE
+        if min_chrom in self.whole_chroms:
+            return ZONE_ALL
+        if min_chrom not in self.intervals:
+            return ZONE_NONE
+        starts, ends = self.intervals[min_chrom]
+        # the first interval that ends after min_pos
+        idx = numpy.searchsorted(ends, min_pos, side='right')
+        if idx == len(starts) or starts[idx] > max_pos:
+            return ZONE_NONE
+        if starts[idx] <= min_pos and max_pos < ends[idx]:
+            return ZONE_ALL
+        return ZONE_SOME
+
 
 class SNPPositionFilter(_BaseFilter):
+    required_fields = [CHROM_FIELD, POS_FIELD]
 
     def __init__(self, regions, reverse=False, **kwargs):
         self.regions = regions
         self.reverse = reverse
+        self._index = _RegionIndex(regions)
 
         super().__init__(**kwargs)
 
     def _in_any_region(self, variations):
-        chroms = variations[CHROM_FIELD]
+        chroms = variations[CHROM_FIELD][:]
         poss = variations[POS_FIELD][:]
+        return self._index.in_any_region(chroms, poss)
 
-        in_any_region = None
-        for region in self.regions:
-            desired_chrom = region[0]
-            if isinstance(desired_chrom, (tuple, list)):
-                raise ValueError('Malformed region: ' + str(region))
-            in_this_region = chroms[:] == desired_chrom
-            if len(region) > 1:
-                in_this_region = numpy.logical_and(in_this_region,
-                                                   numpy.logical_and(region[1] <= poss, poss < region[2]))
-            if in_any_region is None:
-                in_any_region = in_this_region
-            else:
-                in_any_region = numpy.logical_or(in_any_region,
-                                                 in_this_region)
-        return in_any_region
+    def _select_zone_not_reversed(self, zone_stats):
+        chrom_stats = zone_stats[CHROM_FIELD]
+        pos_stats = zone_stats[POS_FIELD]
+        if chrom_stats[N_MISSING] or pos_stats[N_MISSING]:
+            return ZONE_SOME
+        return self._index.select_zone(chrom_stats[MIN], chrom_stats[MAX],
+                                       pos_stats[MIN], pos_stats[MAX])
+
+    def select_zone(self, zone_stats):
+        try:
+            zone_selection = self._select_zone_not_reversed(zone_stats)
+        except (KeyError, TypeError):
+            return ZONE_SOME
+        if self.reverse:
+            if zone_selection == ZONE_ALL:
+                zone_selection = ZONE_NONE
+            elif zone_selection == ZONE_NONE:
+                zone_selection = ZONE_ALL
+        return zone_selection
 
     def __call__(self, variations):
 
@@ -470,6 +618,10 @@ class SNPPositionFilter(_BaseFilter):
         if self.do_filtering:
             flt_vars = variations.get_chunk(selected_rows)
             result[FLT_VARS] = flt_vars
+            n_kept = numpy.count_nonzero(selected_rows)
+            tot = selected_rows.shape[0]
+            result[FLT_STATS] = {N_KEPT: n_kept, N_FILTERED_OUT: tot - n_kept,
+                                 TOT: tot}
 
             if self.return_discarded:
                 discarded_rows = numpy.logical_not(selected_rows)
@@ -489,6 +641,11 @@ class _GTsToMissingSetter:
         self.do_filtering = do_filtering
         self.range = range_
         self.n_bins = n_bins
+        self.sketch_histogram = False
+
+    @property
+    def required_fields(self):
+        return [GT_FIELD, self.field_path]
 
     def __call__(self, variations):
 
@@ -500,6 +657,8 @@ class _GTsToMissingSetter:
             gts[mat_to_check < self.min] = MISSING_INT
         else:
             gts[mat_to_check < self.min] = MISSING_INT
+            # the genotypes have been modified in place
+            forget_intermediates()
 
         result = {}
         if self.do_filtering:
@@ -510,10 +669,7 @@ class _GTsToMissingSetter:
             result[FLT_VARS] = copied_vars
 
         if self.do_histogram:
-            counts, edges = histogram(mat_to_check, n_bins=self.n_bins,
-                                      range_=self.range)
-            result[COUNTS] = counts
-            result[EDGES] = edges
+            _add_histogram_to_result(result, mat_to_check, self)
 
         return result
 
@@ -535,6 +691,7 @@ class LowQualGTsToMissingSetter(_GTsToMissingSetter):
 
 
 class DuplicatedAlleleFixer:
+    required_fields = [GT_FIELD, REF_FIELD, ALT_FIELD]
 
     def __init__(self, do_histogram=False, do_filtering=True):
         self.do_histogram = do_histogram
@@ -588,6 +745,7 @@ class DuplicatedAlleleFixer:
 
 
 class NonBiallelicFilter(_BaseFilter):
+    required_fields = [GT_FIELD]
 
     def __init__(self, samples=None, report_selection=False,
                  keep_monomorphic=False, reverse=False):
@@ -608,26 +766,13 @@ class NonBiallelicFilter(_BaseFilter):
         keep_monomorphic = self.keep_monomorphic
 
         gts = chunk[GT_FIELD]
-        if is_dataset(gts):
-            gts = gts[:]
-
-        shape = gts.shape
-
-        # we count how many different alleles are per row
-        # we do it adding a complex part to each number. The complex part is
-        # related with the row. Then we use unique
-        weight = 1j * numpy.arange(0, shape[0])
-        weight = numpy.repeat(weight, shape[1] * shape[2]).reshape(shape)
-        b = gts + weight
-        _, ind = numpy.unique(b, return_index=True)
-        b = numpy.zeros_like(gts)
-        c = numpy.ones_like(gts)
-        numpy.put(b, ind, c.flat[ind])
-        c = numpy.sum(b, axis=(2, 1))
-
-        # we remove the missing values from the count
-        rows_with_missing = numpy.any(gts == -1, axis=(1, 2))
-        c -= rows_with_missing
+
+        # we count how many different alleles, missing excluded, are per row
+        counts = calc_counts_and_alleles(gts, missing_value=MISSING_INT)[0]
+        if counts is None:
+            c = numpy.zeros((gts.shape[0],), dtype=int)
+        else:
+            c = numpy.sum(counts > 0, axis=1)
 
         if keep_monomorphic:
             selected_rows = (c <= 2)
@@ -664,31 +809,21 @@ class NonBiallelicFilter(_BaseFilter):
 def _calc_fisher_for_gts(variations, samples1, samples2):
     snps1 = SampleFilter(samples1)(variations)[FLT_VARS]
     snps2 = SampleFilter(samples2)(variations)[FLT_VARS]
-    gt_counts1 = _count_gts(snps1)
-    gt_counts2 = _count_gts(snps2)
     if not snps1.num_variations or not snps2.num_variations:
         return None, None, None
 
-    genotypes = list(sorted(set(gt_counts1.keys()).union(gt_counts2.keys())))
-    counts1 = {}
-    counts2 = {}
-    for gt in genotypes:
-        wgs_counts_for_gt = gt_counts1.get(gt, None)
-        gbs_counts_for_gt = gt_counts2.get(gt, None)
-        if wgs_counts_for_gt is None:
-            wgs_counts_for_gt = numpy.zeros_like(gbs_counts_for_gt)
-        if gbs_counts_for_gt is None:
-            gbs_counts_for_gt = numpy.zeros_like(wgs_counts_for_gt)
-        counts1[gt] = wgs_counts_for_gt
-        counts2[gt] = gbs_counts_for_gt
+    gts1 = snps1[GT_FIELD][...]
+    gts2 = snps2[GT_FIELD][...]
+    # both sample sets are counted with the same genotype classes
+    n_alleles = max([int(gts.max()) for gts in (gts1, gts2) if gts.size] +
+                    [0]) + 1
+    counts1 = count_gt_classes_by_row(gts1, n_alleles=n_alleles)[0]
+    counts2 = count_gt_classes_by_row(gts2, n_alleles=n_alleles)[0]
 
     chi2_vals = array.array('f')
     p_vals = array.array('f')
     counts = []
-    for snp_idx in range(counts1[genotypes[0]].shape[0]):
-        counts1_for_snp = [counts1[gt][snp_idx] for gt in genotypes]
-        counts2_for_snp = [counts2[gt][snp_idx] for gt in genotypes]
-
+    for counts1_for_snp, counts2_for_snp in zip(counts1, counts2):
         counts_for_snp = numpy.array([counts1_for_snp, counts2_for_snp])
         counts_for_snp = counts_for_snp[:, numpy.sum(counts_for_snp, axis=0) > 0]
         counts.append(counts_for_snp)
@@ -702,55 +837,8 @@ def _calc_fisher_for_gts(variations, samples1, samples2):
     return numpy.array(chi2_vals), numpy.array(p_vals), counts
 
 
-def _packed_gt_to_tuple(gt, ploidy):
-    gt_len = ploidy * 2
-    gt_fmt = '%0' + str(gt_len) + 'd'
-    gt = gt_fmt % gt
-    gt = tuple(sorted([int(gt[idx: idx + 2]) for idx in range(0, len(gt), 2)]))
-    return gt
-
-
-def _count_gts(variations):
-
-    if variations[GT_FIELD].shape[0] == 0:
-        return numpy.array([]), numpy.array([]), numpy.array([])
-
-    gts = variations[GT_FIELD]
-    gts = gts[...]
-
-    # get rid of genotypes with missing alleles
-    missing_alleles = gts == MISSING_INT
-    miss_gts = numpy.any(missing_alleles, axis=2)
-
-    # We pack the genotype of a sample that is in third axes as two
-    # integers as one integer: 1, 1 -> 11 0, 1 -> 01, 0, 0-> 0
-    gts_per_haplo = [(gts[:, :, idx].astype(numpy.int16)) * (100 ** idx) for idx in range(gts.shape[2])]
-    packed_gts = None
-    for gts_ in gts_per_haplo:
-        if packed_gts is None:
-            packed_gts = gts_
-        else:
-            packed_gts += gts_
-    packed_gts[miss_gts] = MISSING_INT
-
-    different_gts = numpy.unique(packed_gts)
-    # Count genotypes, homo, het and alleles
-    ploidy = gts.shape[2]
-    counts = {}
-    for gt in different_gts:
-        count_gt_by_row = row_value_counter_fact(gt)
-        gt_counts = count_gt_by_row(packed_gts)
-        if gt == MISSING_INT:
-            continue
-        unpacked_gt = _packed_gt_to_tuple(gt, ploidy)
-        if unpacked_gt not in counts:
-            counts[unpacked_gt] = gt_counts
-        else:
-            counts[unpacked_gt] += gt_counts
-    return counts
-
-
 class Chi2GtFreqs2SampleSetsFilter(_BaseFilter):
+    required_fields = [GT_FIELD]
 
     def __init__(self, samples1, samples2, min_pval, **kwargs):
         self.min = min_pval
@@ -817,6 +905,11 @@ class FieldFilter:
 
         self.do_filtering = True
 
+    @property
+    def required_fields(self):
+        # with ignored_fields every other field is kept
+        return self.kept_fields
+
     def _filter(self, variations):
         return variations.get_chunk(slice(None, None),
                                     kept_fields=self.kept_fields,
@@ -833,6 +926,7 @@ class FieldFilter:
 
 
 class SamplesFilterByIndex:
+    required_fields = []
 
     def __init__(self, samples_col_idxs, reverse=False):
         self.samples_col_idxs = samples_col_idxs
@@ -853,6 +947,7 @@ class SamplesFilterByIndex:
 
 
 class SampleFilter:
+    required_fields = []
 
     def __init__(self, samples, reverse=False):
         self.samples = samples
@@ -890,41 +985,10 @@ class SampleFilter:
         return filter_samples(variations)
 
 
-def _calc_sample_missing_rates(variations, chunk_size,
-                               min_called_rate, max_het):
-
-    if chunk_size is None:
-        chunks = [variations]
-    else:
-        chunks = variations.iterate_chunks(kept_fields=[GT_FIELD],
-                                           chunk_size=chunk_size)
-    missing = None
-    het_counts = None
-    for chunk in chunks:
-        chunk_missing = calc_called_gt(chunk, rates=False, axis=0)
-        if min_called_rate is not None:
-            if missing is None:
-                missing = chunk_missing
-            else:
-                missing += chunk_missing
-
-        if max_het is not None:
-            is_het = call_is_het(chunk[GT_FIELD])
-            chunk_het_counts = numpy.sum(is_het, axis=0)
-            if het_counts is None:
-                het_counts = chunk_het_counts
-            else:
-                het_counts += chunk_het_counts
-
-    res = {}
-    if min_called_rate is not None:
-        rates = missing / variations.num_variations
-        res['missing_rates'] = rates
-    if max_het is not None:
-        obs_hets = het_counts / variations.num_variations
-        res['obs_hets'] = obs_hets
-
-    return res
+def _calc_sample_missing_rates(sample_qc):
+    n_vars = sample_qc['n_vars']
+    return {'missing_rates': sample_qc['called_gts'] / n_vars,
+            'obs_hets': sample_qc['het'] / n_vars}
 
 
 def filter_samples_by_missing_rate(in_vars, min_called_rate=None,
@@ -932,7 +996,12 @@ def filter_samples_by_missing_rate(in_vars, min_called_rate=None,
                                    out_vars=None,
                                    chunk_size=SNPS_PER_CHUNK,
                                    n_bins=DEF_NUM_BINS, samples=None,
-                                   do_histogram=None):
+                                   do_histogram=None, sample_qc=None):
+    '''It keeps the samples with enough called genotypes and few het ones
+
+    The sample_qc calculated by calc_sample_qc for the in_vars can be given
+    to avoid reading them to calculate the rates.
+    '''
 
     res = _get_result_if_empty_vars(in_vars, do_histogram)
     if res is not None:
@@ -940,8 +1009,10 @@ def filter_samples_by_missing_rate(in_vars, min_called_rate=None,
 
     do_filtering = False if out_vars is None else True
 
-    rates = _calc_sample_missing_rates(in_vars, chunk_size,
-                                       min_called_rate, max_het)
+    if sample_qc is None:
+        sample_qc = calc_sample_qc(in_vars, chunk_size=chunk_size,
+                                   do_depth=False)
+    rates = _calc_sample_missing_rates(sample_qc)
 
     idxs = []
     if min_called_rate is not None:
@@ -973,12 +1044,12 @@ def filter_samples_by_missing_rate(in_vars, min_called_rate=None,
     if do_histogram:
         counts, edges = histogram(missing_rates, n_bins=n_bins, range_=missing_range)
 
-    if chunk_size is None:
-        chunks = [in_vars]
-    else:
-        chunks = in_vars.iterate_chunks(chunk_size=chunk_size)
-    for chunk in chunks:
-        if do_filtering:
+    if do_filtering:
+        if chunk_size is None:
+            chunks = [in_vars]
+        else:
+            chunks = in_vars.iterate_chunks(chunk_size=chunk_size)
+        for chunk in chunks:
             flt_chunk = filter_samples(chunk)[FLT_VARS]
             out_vars.put_chunks([flt_chunk])
 
@@ -994,21 +1065,6 @@ def filter_samples_by_missing_rate(in_vars, min_called_rate=None,
     return res
 
 
-def _calc_range_for_var_density(variations, window, chunk_size):
-
-    min_, max_ = None, None
-    for stats in group_in_packets(calc_snp_density(variations, window),
-                                  chunk_size):
-        stats = array.array('I', stats)
-        this_min = min(stats)
-        if min_ is None or min_ > this_min:
-            min_ = this_min
-        this_max = max(stats)
-        if max_ is None or max_ < this_max:
-            max_ = this_max
-    return min_, max_
-
-
 def _check_if_histogram_is_required(do_histogram, n_bins, range_):
     if (n_bins != DEF_NUM_BINS or range_ is not None) and do_histogram is None:
         do_histogram = True
@@ -1038,31 +1094,30 @@ def filter_variation_density(in_vars, max_density, window, out_vars=None,
 
     do_filtering = False if out_vars is None else True
 
-    if do_histogram and range_ is None:
-        range_ = _calc_range_for_var_density(in_vars, window, chunk_size)
+    # with no range the histogram is built once all densities are known
+    sketch = HistogramSketch() if do_histogram and range_ is None else None
 
-    stats = calc_snp_density(in_vars, window)
+    stats = calc_snp_density(in_vars, window, chunk_size=chunk_size)
     edges, counts = None, None
 
     if chunk_size is None:
-        chunks = in_vars.iterate_chunks(chunk_size=chunk_size)
-    else:
         chunks = [in_vars]
+    else:
+        chunks = in_vars.iterate_chunks(chunk_size=chunk_size)
 
-    n_kept, tot, n_filtered_out = 0, 0, 0
+    n_kept, tot = 0, 0
     for chunk in chunks:
-        stats_for_chunk = itertools.islice(stats, chunk.num_variations)
-        stats_for_chunk = numpy.array(array.array('I', stats_for_chunk))
+        stats_for_chunk = stats[tot:tot + chunk.num_variations]
 
         if do_filtering:
             selected_rows = stats_for_chunk <= max_density
             out_vars.put_chunks([chunk.get_chunk(selected_rows)])
-
             n_kept += numpy.count_nonzero(selected_rows)
-            tot += selected_rows.shape[0]
-            n_filtered_out += tot - n_kept
+        tot += chunk.num_variations
 
-        if do_histogram:
+        if sketch is not None:
+            sketch.add(stats_for_chunk)
+        elif do_histogram:
             this_counts, this_edges = histogram(stats_for_chunk, n_bins=n_bins,
                                                 range_=range_)
             if edges is None:
@@ -1076,9 +1131,11 @@ def filter_variation_density(in_vars, max_density, window, out_vars=None,
 
     res = {}
     if do_filtering:
-        res[FLT_STATS] = {N_KEPT: n_kept, N_FILTERED_OUT: n_filtered_out,
+        res[FLT_STATS] = {N_KEPT: n_kept, N_FILTERED_OUT: tot - n_kept,
                           TOT: tot}
 
+    if sketch is not None:
+        counts, edges = sketch.calc_histogram(n_bins)
     if do_histogram:
         res[EDGES] = edges
         res[COUNTS] = counts
@@ -1087,6 +1144,7 @@ def filter_variation_density(in_vars, max_density, window, out_vars=None,
 
 
 class PseudoHetDuplicationFilter(_BaseFilter):
+    required_fields = [GT_FIELD, DP_FIELD]
 
     def __init__(self, sample_dp_means, max_high_dp_freq, max_obs_het,
                  poisson_percent_for_high_dp_call=1, **kwargs):
@@ -1123,10 +1181,7 @@ class PseudoHetDuplicationFilter(_BaseFilter):
         result = {}
 
         if self.do_histogram:
-            counts, edges = histogram(freq_high_dp, n_bins=self.n_bins,
-                                      range_=self.range)
-            result[COUNTS] = counts
-            result[EDGES] = edges
+            _add_histogram_to_result(result, freq_high_dp, self)
 
         if self.do_filtering or self.report_selection:
             het_call = call_is_het(vars_for_stat[GT_FIELD])
@@ -1160,6 +1215,7 @@ class PseudoHetDuplicationFilter(_BaseFilter):
 
 
 class PseudoHetDuplicationFilter2(_BaseFilter):
+    required_fields = [GT_FIELD, DP_FIELD]
 
     def __init__(self, sample_dp_means, max_high_dp_freq,
                  poisson_percent_for_high_dp_call=1, **kwargs):
@@ -1203,6 +1259,7 @@ class PseudoHetDuplicationFilter2(_BaseFilter):
 
 
 class VarsSamplingFilter(_BaseFilter):
+    required_fields = []
 
     def __init__(self, sample_rate, **kwargs):
         self.sample_rate = sample_rate
@@ -1235,6 +1292,7 @@ class VarsSamplingFilter(_BaseFilter):
 
 
 class VarsSamplingFilter2(_BaseFilter):
+    required_fields = []
 
     def __init__(self, num_vars, **kwargs):
         self.num_vars = num_vars
@@ -1276,6 +1334,16 @@ class OrFilter:
             flt.do_filtering = False
             flt.do_histogram = False
 
+    @property
+    def required_fields(self):
+        required_fields = set()
+        for flt in self.filters:
+            flt_fields = getattr(flt, 'required_fields', None)
+            if flt_fields is None:
+                return None
+            required_fields.update(flt_fields)
+        return sorted(required_fields)
+
     def __call__(self, variations):
         selected_vars = None
         for flt in self.filters:
@@ -1311,6 +1379,24 @@ class FieldValueFilter(_BaseFilter):
         self._field = field_path
         self._value = value
 
+    @property
+    def required_fields(self):
+        return [self._field]
+
+    def select_zone(self, zone_stats):
+        try:
+            field_stats = zone_stats[self._field]
+            if field_stats[N_MISSING]:
+                return ZONE_SOME
+            if (self._value < field_stats[MIN] or
+                    self._value > field_stats[MAX]):
+                return ZONE_NONE
+            if field_stats[MIN] == self._value == field_stats[MAX]:
+                return ZONE_ALL
+        except (KeyError, TypeError):
+            pass
+        return ZONE_SOME
+
     def __call__(self, variations):
         try:
             assert self._field in variations
@@ -1333,3 +1419,50 @@ class FieldValueFilter(_BaseFilter):
                              N_FILTERED_OUT: n_filtered_out,
                              TOT: tot}
         return result
+
+
+class ExpressionFilter:
+    '''It keeps the variations for which the expression is true
+
+    The expression is parsed once and it is evaluated for every chunk with
+    vectorized operations, e.g.
+    "qual > 30 & info/DP < 500 & (chrom == 'ch01' | maf(GT) > 0.05)"
+    '''
+
+    def __init__(self, expression, report_selection=False,
+                 return_discarded=False):
+        self.expression = CompiledExpression(expression)
+        self.do_filtering = True
+        self.do_histogram = False
+        self.report_selection = report_selection
+        self.return_discarded = return_discarded
+
+    @property
+    def required_fields(self):
+        return list(self.expression.fields)
+
+    def select_zone(self, zone_stats):
+        return self.expression.select_zone(zone_stats)
+
+    def __call__(self, variations):
+        if variations.num_variations == 0:
+            raise ValueError('No SNPs to filter')
+
+        selected_rows = self.expression.evaluate(variations)
+        result = {}
+
+        if self.report_selection:
+            result[SELECTED_VARS] = selected_rows
+
+        if self.do_filtering:
+            result[FLT_VARS] = variations.get_chunk(selected_rows)
+            n_kept = numpy.count_nonzero(selected_rows)
+            tot = selected_rows.shape[0]
+            result[FLT_STATS] = {N_KEPT: n_kept, N_FILTERED_OUT: tot - n_kept,
+                                 TOT: tot}
+
+            if self.return_discarded:
+                discarded_rows = numpy.logical_not(selected_rows)
+                result[DISCARDED_VARS] = variations.get_chunk(discarded_rows)
+
+        return result
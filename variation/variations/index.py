@@ -1,16 +1,41 @@
 
 from collections import OrderedDict
-from bisect import bisect_left, bisect_right
 
 import numpy
 
-from variation import POS_FIELD, CHROM_FIELD
+from variation import POS_FIELD, CHROM_FIELD, SNPS_PER_CHUNK
+
+
+def calc_chrom_runs(chroms, chunk_size=SNPS_PER_CHUNK):
+    '''It returns the chrom and the first row of every run of rows with the
+    same chrom
+
+    The chroms are read in chunks and the last boundary is the number of
+    rows.
+    '''
+    n_rows = chroms.shape[0]
+    if chunk_size is None:
+        chunk_size = max(n_rows, 1)
+    run_chroms, boundaries = [], []
+    for start in range(0, n_rows, chunk_size):
+        chunk_chroms = chroms[start:start + chunk_size]
+        if not run_chroms or chunk_chroms[0] != run_chroms[-1]:
+            run_chroms.append(chunk_chroms[0])
+            boundaries.append(start)
+        changes = numpy.nonzero(chunk_chroms[1:] != chunk_chroms[:-1])[0] + 1
+        run_chroms.extend(chunk_chroms[changes])
+        boundaries.extend(changes + start)
+    boundaries.append(n_rows)
+    return run_chroms, boundaries
 
 
 class PosIndex():
     def __init__(self, variations):
         self.variations = variations
         self._index = self._create_dict()
+        # only the positions for the last chrom asked are kept in memory
+        self._cached_chrom = None
+        self._cached_chrom_poss = None
 
     @property
     def chroms(self):
@@ -47,20 +72,33 @@ class PosIndex():
                             lo=self._index[chrom]['start'],
                             hi=self._index[chrom]['end'])
 
+    def get_chrom_poss(self, chrom):
+        if self._cached_chrom is not None and self._cached_chrom == chrom:
+            return self._cached_chrom_poss
+        chrom_locs = self._index[chrom]
+        poss = self.variations[POS_FIELD][chrom_locs['start']:chrom_locs['end']]
+        self._cached_chrom = chrom
+        self._cached_chrom_poss = poss
+        return poss
+
+    def index_poss(self, chrom, poss, side='left'):
+        'Vectorized index_pos, it returns the indexes for several positions'
+        chrom_poss = self.get_chrom_poss(chrom)
+        idxs = numpy.searchsorted(chrom_poss, poss, side=side)
+        return idxs + self._index[chrom]['start']
+
     def _create_dict(self):
+        # the chroms are kept in the order of the variations, but all the
+        # variations of every chrom have to be together
         idx = OrderedDict()
-        snps = self.variations
-        chrom_mat = snps[CHROM_FIELD]
-        for chrom in numpy.unique(chrom_mat):
-            start = bisect_left(chrom_mat, chrom)
-            end = bisect_right(chrom_mat, chrom)
-            try:
-                chrom_start = chrom_mat[start]
-            except ValueError:
-                raise RuntimeError('Maybe SNPs are not sorted')
-            if chrom_start != chrom:
-                raise RuntimeError('Maybe SNPs are not sorted')
-            idx[chrom] = {'start': start, 'end': end}
+        run_chroms, boundaries = calc_chrom_runs(self.variations[CHROM_FIELD])
+        for chrom, start, end in zip(run_chroms, boundaries[:-1],
+                                     boundaries[1:]):
+            if chrom in idx:
+                msg = 'The variations of every chromosome have to be '
+                msg += 'together, maybe SNPs are not sorted'
+                raise RuntimeError(msg)
+            idx[chrom] = {'start': int(start), 'end': int(end)}
         return idx
 
     def _bisect(self, chrom_positions, pos, lo=0, hi=None):
@@ -0,0 +1,97 @@
+# Missing docstring
+# pylint: disable=C0111
+
+from collections import deque
+from multiprocessing import Pool
+
+import numpy
+
+from variation import SNPS_PER_CHUNK
+
+# The function run by the processes of the pool
+_WORKER_MAP_FUNCT = None
+
+
+def _init_worker(map_funct):
+    global _WORKER_MAP_FUNCT
+    _WORKER_MAP_FUNCT = map_funct
+
+
+def _run_map_funct_in_worker(chunk):
+    return _WORKER_MAP_FUNCT(chunk)
+
+
+def _map_chunks_in_pool(map_funct, chunks, n_workers):
+    # Only a few chunks are sent to the pool ahead of the one being
+    # reduced, the results are yielded in the input order
+    max_chunks_in_flight = n_workers * 2
+    with Pool(n_workers, initializer=_init_worker,
+              initargs=(map_funct,)) as pool:
+        pending_results = deque()
+        for chunk in chunks:
+            pending_results.append(pool.apply_async(_run_map_funct_in_worker,
+                                                    (chunk,)))
+            while len(pending_results) > max_chunks_in_flight:
+                yield pending_results.popleft().get()
+        while pending_results:
+            yield pending_results.popleft().get()
+
+
+def map_chunks(map_funct, chunks, n_workers=None):
+    '''It yields the result of the map_funct for every chunk, in order
+
+    With two or more n_workers the chunks are processed by a pool of
+    processes, so the map_funct has to be picklable, like a module function
+    or a partial of it.
+    '''
+    if n_workers is None or n_workers < 2:
+        return map(map_funct, chunks)
+    return _map_chunks_in_pool(map_funct, chunks, n_workers)
+
+
+def add_chunk_results(result, chunk_result):
+    'The arrays are added, also the items of tuples, lists and dicts'
+    if isinstance(chunk_result, dict):
+        return {key: add_chunk_results(result[key], value)
+                for key, value in chunk_result.items()}
+    if isinstance(chunk_result, (tuple, list)):
+        return type(chunk_result)(add_chunk_results(item1, item2)
+                                  for item1, item2 in zip(result,
+                                                          chunk_result))
+    return numpy.add(result, chunk_result)
+
+
+def add_histograms(result, chunk_result):
+    'The counts of (counts, edges, ...) histograms are added'
+    return (numpy.add(result[0], chunk_result[0]),) + tuple(result[1:])
+
+
+def map_reduce_chunks(map_funct, variations, merge_funct=None,
+                      kept_fields=None, chunk_size=SNPS_PER_CHUNK,
+                      n_workers=None):
+    '''It runs the map_funct for every chunk and merges the results
+
+    The merge_funct takes the result so far and the result of the next chunk
+    and returns the merged result. Without merge_funct the results are
+    concatenated. With no chunk_size the variations are processed at once.
+    '''
+    if chunk_size is None:
+        chunks = [variations]
+    else:
+        chunks = variations.iterate_chunks(kept_fields=kept_fields,
+                                           chunk_size=chunk_size)
+    chunk_results = map_chunks(map_funct, chunks, n_workers=n_workers)
+
+    if merge_funct is None:
+        chunk_results = list(chunk_results)
+        if not chunk_results:
+            return numpy.array([])
+        return numpy.concatenate(chunk_results, axis=0)
+
+    result = None
+    for chunk_result in chunk_results:
+        if result is None:
+            result = chunk_result
+        else:
+            result = merge_funct(result, chunk_result)
+    return result
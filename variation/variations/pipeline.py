@@ -1,14 +1,199 @@
 
 import itertools
+import os
+import pickle
+import time
+from contextlib import contextmanager, ExitStack
+from functools import partial
 
 import numpy
 
-from variation import SNPS_PER_CHUNK
+from variation import SNPS_PER_CHUNK, POS_FIELD
 from variation.variations.filters import (COUNTS, EDGES, FLT_VARS, FLT_STATS,
                                           N_KEPT, TOT, N_FILTERED_OUT,
-                                          SELECTED_VARS)
+                                          SELECTED_VARS, HISTOGRAM_SKETCH)
 from collections import OrderedDict
 from variation.variations.annotation import ANNOTATED_VARS
+from variation.variations.vars_matrices import (VariationsArrays, VariationsH5,
+                                                LazyRowsVariations,
+                                                iterate_parser_chunks)
+from variation.variations.zone_maps import ZONE_ALL, ZONE_NONE
+from variation.variations.chunk_cache import intermediates_cache
+from variation.variations.map_reduce import map_chunks
+
+PROFILE = 'profile'
+RUN_PROFILE = 'run_profile'
+WALL_TIME = 'wall_time'
+CPU_TIME = 'cpu_time'
+ROWS_IN = 'rows_in'
+ROWS_OUT = 'rows_out'
+BYTES_IN = 'bytes_in'
+PEAK_CHUNK_BYTES = 'peak_chunk_bytes'
+READ_TIME = 'read_time'
+WRITE_TIME = 'write_time'
+BYTES_READ = 'bytes_read'
+N_CHUNKS = 'n_chunks'
+
+# seconds between checkpoints
+DEF_CHECKPOINT_INTERVAL = 300
+
+def _process_chunk(chunk_and_results, pipeline, deferred_filtering,
+                   profile=False):
+    # the chunks with their results already known are not processed
+    chunk, results = chunk_and_results
+    if results is None:
+        results = pipeline._pipeline_funct(chunk,
+                                           deferred_filtering=deferred_filtering,
+                                           profile=profile)
+    return results
+
+
+def _process_chunk_in_pipelines(chunk_and_results, pipelines,
+                                deferred_filtering):
+    chunk, chunk_results = chunk_and_results
+    pipelines_results = []
+    for pipeline, pipeline_results in zip(pipelines, chunk_results):
+        if pipeline_results is None:
+            # A pipeline could modify the arrays of the chunk, so
+            # each one gets a view that copies the fields it uses
+            pipeline_chunk = LazyRowsVariations(chunk)
+            pipeline_results = pipeline._pipeline_funct(pipeline_chunk,
+                                                        deferred_filtering)
+        pipelines_results.append(pipeline_results)
+    return pipelines_results
+
+
+def _is_parser(vars_in):
+    return not hasattr(vars_in, 'keys') and hasattr(vars_in, 'variations')
+
+
+def _iterate_shared_chunks(vars_in, pipelines, chunk_size, kept_fields,
+                           ignored_fields, start=0):
+    '''It yields every chunk and the results already known for each pipeline
+
+    The chunks that no pipeline would keep, according to the zone maps, are
+    not read. The vars_in can also be a parser, its variations are processed
+    as they are parsed.
+    '''
+    if _is_parser(vars_in):
+        chunks = iterate_parser_chunks(vars_in, chunk_size=chunk_size,
+                                       kept_fields=kept_fields,
+                                       ignored_fields=ignored_fields)
+        if start:
+            # the parser could discard some variations, so the chunks do not
+            # have to be complete and the chunks already processed are skipped
+            chunks = itertools.islice(chunks, start // chunk_size, None)
+        for chunk in chunks:
+            yield chunk, [None] * len(pipelines)
+        return
+
+    zone_maps = vars_in.zone_maps
+    if zone_maps is None:
+        for chunk in vars_in.iterate_chunks(kept_fields=kept_fields,
+                                            ignored_fields=ignored_fields,
+                                            chunk_size=chunk_size,
+                                            start=start):
+            yield chunk, [None] * len(pipelines)
+        return
+
+    slices = vars_in._create_iterate_chunk_slices(chunk_size=chunk_size,
+                                                  start=start)
+    for slice_ in slices:
+        n_vars = slice_.stop - slice_.start
+        zone_stats = zone_maps.get_zone_stats(slice_.start, slice_.stop)
+        results = [pipeline._results_for_discarded_zone(zone_stats, n_vars)
+                   for pipeline in pipelines]
+        if all(pipeline_results is not None for pipeline_results in results):
+            yield None, results
+            continue
+        chunk = vars_in.get_chunk(slice_, kept_fields=kept_fields,
+                                  ignored_fields=ignored_fields)
+        yield chunk, results
+
+
+def _create_run_profile():
+    return {WALL_TIME: 0, READ_TIME: 0, WRITE_TIME: 0, BYTES_READ: 0,
+            PEAK_CHUNK_BYTES: 0, N_CHUNKS: 0}
+
+
+def _profile_chunk_reads(chunks_to_process, run_profile):
+    chunks_to_process = iter(chunks_to_process)
+    while True:
+        start = time.perf_counter()
+        try:
+            chunk, results = next(chunks_to_process)
+        except StopIteration:
+            return
+        run_profile[READ_TIME] += time.perf_counter() - start
+        if chunk is not None:
+            nbytes = chunk.nbytes
+            run_profile[N_CHUNKS] += 1
+            run_profile[BYTES_READ] += nbytes
+            run_profile[PEAK_CHUNK_BYTES] = max(run_profile[PEAK_CHUNK_BYTES],
+                                                nbytes)
+        yield chunk, results
+
+
+def _add_step_profile(step_profile, chunk_step_profile):
+    for key, value in chunk_step_profile.items():
+        if key == PEAK_CHUNK_BYTES:
+            step_profile[key] = max(step_profile.get(key, 0), value)
+        else:
+            step_profile[key] = step_profile.get(key, 0) + value
+
+
+class _Checkpoint:
+    '''It saves the chunks already processed and the results for them
+
+    The vars_out is flushed before saving, so the rows written by the chunks
+    processed after the last checkpoint can be removed when the run resumes.
+    '''
+
+    def __init__(self, fpath, chunk_size, interval=DEF_CHECKPOINT_INTERVAL):
+        self.fpath = fpath
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.n_chunks_done = 0
+        self._last_save = time.time()
+
+    def load(self, vars_out):
+        'It returns the results saved, if any, and truncates the vars_out'
+        if not os.path.exists(self.fpath):
+            return None
+        with open(self.fpath, 'rb') as fhand:
+            state = pickle.load(fhand)
+        if state['chunk_size'] != self.chunk_size:
+            msg = 'The checkpoint was created with a different chunk_size'
+            raise ValueError(msg)
+        if vars_out is not None:
+            vars_out.truncate(state['vars_out_num_variations'])
+        self.n_chunks_done = state['n_chunks_done']
+        return state['result']
+
+    def chunk_done(self, result, vars_out):
+        self.n_chunks_done += 1
+        if time.time() - self._last_save >= self.interval:
+            self.save(result, vars_out)
+
+    def save(self, result, vars_out):
+        if vars_out is None:
+            num_variations = 0
+        else:
+            vars_out.flush()
+            num_variations = vars_out.num_variations
+        state = {'chunk_size': self.chunk_size,
+                 'n_chunks_done': self.n_chunks_done,
+                 'vars_out_num_variations': num_variations,
+                 'result': result}
+        tmp_fpath = self.fpath + '.tmp'
+        with open(tmp_fpath, 'wb') as fhand:
+            pickle.dump(state, fhand)
+        os.replace(tmp_fpath, self.fpath)
+        self._last_save = time.time()
+
+    def remove(self):
+        if os.path.exists(self.fpath):
+            os.remove(self.fpath)
 
 
 class Pipeline():
@@ -25,7 +210,12 @@ class Pipeline():
                 'order': len(self._pipeline)}
         self._pipeline.append(step)
 
-    def _pipeline_funct(self, chunk):
+    def _pipeline_funct(self, chunk, deferred_filtering=False, profile=False):
+        # the steps share the intermediate results calculated for the chunk
+        with intermediates_cache():
+            return self._run_steps(chunk, deferred_filtering, profile)
+
+    def _run_steps(self, chunk, deferred_filtering, profile):
         results = []
         for step in self._pipeline:
             # This for should be more internal than the for for the HDF5
@@ -35,6 +225,18 @@ class Pipeline():
             if chunk.num_variations == 0:
                 continue
 
+            if (deferred_filtering and
+                    not isinstance(chunk, LazyRowsVariations)):
+                # The filters select rows from a view of the chunk and the
+                # fields are copied only when a step uses them
+                chunk = LazyRowsVariations(chunk)
+
+            if profile:
+                rows_in = chunk.num_variations
+                bytes_in = chunk.nbytes
+                start_wall_time = time.perf_counter()
+                start_cpu_time = time.process_time()
+
             callable_instance = step['callable']
             result = callable_instance(chunk)
             if FLT_VARS in result:
@@ -44,108 +246,341 @@ class Pipeline():
                 chunk = result[ANNOTATED_VARS]
                 del result[ANNOTATED_VARS]
 
+            if profile:
+                wall_time = time.perf_counter() - start_wall_time
+                cpu_time = time.process_time() - start_cpu_time
+                result[PROFILE] = {WALL_TIME: wall_time, CPU_TIME: cpu_time,
+                                   ROWS_IN: rows_in,
+                                   ROWS_OUT: chunk.num_variations,
+                                   BYTES_IN: bytes_in,
+                                   PEAK_CHUNK_BYTES: bytes_in}
             results.append(result)
+        if isinstance(chunk, LazyRowsVariations):
+            chunk = chunk.materialize()
         return results, chunk
 
-    def _reduce_results(self, results, vars_out):
-        result = OrderedDict()
+    def _results_for_discarded_zone(self, zone_stats, n_vars):
+        '''It returns the results for a chunk discarded using the zone maps
+
+        If the chunk can not be discarded without reading it, it returns None
+        '''
+        results = []
+        for step in self._pipeline:
+            callable_instance = step['callable']
+            if (not hasattr(callable_instance, 'select_zone') or
+                    callable_instance.do_histogram or
+                    callable_instance.report_selection):
+                return None
+            if not callable_instance.do_filtering:
+                results.append({})
+                continue
+            zone_selection = callable_instance.select_zone(zone_stats)
+            if zone_selection == ZONE_ALL:
+                n_kept = n_vars
+            elif zone_selection == ZONE_NONE:
+                n_kept = 0
+            else:
+                return None
+            results.append({FLT_STATS: {N_KEPT: n_kept,
+                                        N_FILTERED_OUT: n_vars - n_kept,
+                                        TOT: n_vars}})
+            if not n_kept:
+                return results, VariationsArrays()
+        return None
+
+    def _iterate_chunks_to_process(self, vars_in, chunk_size, kept_fields,
+                                   ignored_fields, start=0):
+        '''It yields the chunks to process and the results already known
+
+        The chunks that no filter would keep, according to the zone maps,
+        are not read and its results are yielded instead of the chunk.
+        '''
+        for chunk, results in _iterate_shared_chunks(vars_in, [self],
+                                                     chunk_size, kept_fields,
+                                                     ignored_fields,
+                                                     start=start):
+            yield chunk, results[0]
+
+    def _reduce_results(self, results, vars_out, run_profile=None,
+                        profile_callback=None, checkpoint=None, result=None):
+        if result is None:
+            result = OrderedDict()
+        if run_profile is not None:
+            result[RUN_PROFILE] = run_profile
         for slice_result, chunk in results:
-            if vars_out is not None:
-                vars_out.put_chunks([chunk])
-            for step_result, step in zip(slice_result, self._pipeline):
-                step_id = step['id']
-                callable_instance = step['callable']
+            self._add_chunk_results(result, slice_result, chunk, vars_out,
+                                    run_profile)
+            if profile_callback is not None:
+                profile_callback(result)
+            if checkpoint is not None:
+                checkpoint.chunk_done(result, vars_out)
+        return result
 
-                if step_id not in result:
-                    result[step_id] = {'name': step['name'],
-                                       'order': step['order']}
+    def _add_chunk_results(self, result, slice_result, chunk, vars_out,
+                           run_profile=None):
+        if vars_out is not None:
+            if run_profile is not None:
+                start = time.perf_counter()
+            vars_out.put_chunks([chunk])
+            if run_profile is not None:
+                run_profile[WRITE_TIME] += time.perf_counter() - start
+        for step_result, step in zip(slice_result, self._pipeline):
+            step_id = step['id']
+            callable_instance = step['callable']
+
+            if step_id not in result:
+                result[step_id] = {'name': step['name'],
+                                   'order': step['order']}
 
-                if not hasattr(callable_instance, 'do_histogram'):
-                    do_hist = False
+            if not hasattr(callable_instance, 'do_histogram'):
+                do_hist = False
+            else:
+                do_hist = callable_instance.do_histogram
+            if not step_result:
+                continue
+            if do_hist and HISTOGRAM_SKETCH in step_result:
+                sketch = step_result[HISTOGRAM_SKETCH]
+                if HISTOGRAM_SKETCH not in result[step_id]:
+                    result[step_id][HISTOGRAM_SKETCH] = sketch
                 else:
-                    do_hist = callable_instance.do_histogram
-                if not step_result:
-                    continue
-                if do_hist:
-                    if COUNTS not in result[step_id]:
-                        result[step_id][COUNTS] = step_result[COUNTS]
-                        result[step_id][EDGES] = step_result[EDGES]
-                    else:
-                        if not numpy.allclose(step_result[EDGES],
-                                              result[step_id][EDGES]):
-                            msg = 'The bin edges for a pipeline '
-                            msg += 'result in step %s '
-                            msg += 'funct %s do not match'
-                            msg %= step['id'], step['name']
-                            raise RuntimeError(msg)
-                        result[step_id][COUNTS] += step_result[COUNTS]
-
-                if SELECTED_VARS in step_result:
-                    result[step_id][SELECTED_VARS] = step_result[SELECTED_VARS]
-                if FLT_STATS in step_result:
-                    if FLT_STATS not in result[step_id]:
-                        result[step_id][FLT_STATS] = step_result[FLT_STATS]
-                    else:
-                        n_kept = step_result[FLT_STATS][N_KEPT]
-                        tot = step_result[FLT_STATS][TOT]
-                        flt_out = step_result[FLT_STATS][N_FILTERED_OUT]
-                        result[step_id][FLT_STATS][N_KEPT] += n_kept
-                        result[step_id][FLT_STATS][TOT] += tot
-                        result[step_id][FLT_STATS][N_FILTERED_OUT] += flt_out
-        return result
+                    result[step_id][HISTOGRAM_SKETCH].merge(sketch)
+            elif do_hist:
+                if COUNTS not in result[step_id]:
+                    result[step_id][COUNTS] = step_result[COUNTS]
+                    result[step_id][EDGES] = step_result[EDGES]
+                else:
+                    if not numpy.allclose(step_result[EDGES],
+                                          result[step_id][EDGES]):
+                        msg = 'The bin edges for a pipeline '
+                        msg += 'result in step %s '
+                        msg += 'funct %s do not match'
+                        msg %= step['id'], step['name']
+                        raise RuntimeError(msg)
+                    result[step_id][COUNTS] += step_result[COUNTS]
+
+            if PROFILE in step_result:
+                _add_step_profile(result[step_id].setdefault(PROFILE, {}),
+                                  step_result[PROFILE])
+            if SELECTED_VARS in step_result:
+                result[step_id][SELECTED_VARS] = step_result[SELECTED_VARS]
+            if FLT_STATS in step_result:
+                if FLT_STATS not in result[step_id]:
+                    result[step_id][FLT_STATS] = step_result[FLT_STATS]
+                else:
+                    n_kept = step_result[FLT_STATS][N_KEPT]
+                    tot = step_result[FLT_STATS][TOT]
+                    flt_out = step_result[FLT_STATS][N_FILTERED_OUT]
+                    result[step_id][FLT_STATS][N_KEPT] += n_kept
+                    result[step_id][FLT_STATS][TOT] += tot
+                    result[step_id][FLT_STATS][N_FILTERED_OUT] += flt_out
 
-    def _check_and_fix_histogram_ranges(self, vars_in, chunk_size, kept_fields,
-                                        ignored_fields):
-        callables_to_check = []
+    @contextmanager
+    def _sketching_histograms(self):
+        '''It yields the histogram steps with no range
+
+        Their ranges are not known until all chunks have been processed, so
+        they return sketches that are binned once the run is done.
+        '''
+        steps_to_sketch = []
         for step in self._pipeline:
             callable_instance = step['callable']
-            if not hasattr(callable_instance, 'do_histogram'):
+            if not hasattr(callable_instance, 'sketch_histogram'):
                 continue
             if (callable_instance.do_histogram and
                callable_instance.range is None):
-                callables_to_check.append(callable_instance)
-        if not callables_to_check:
-            return
+                steps_to_sketch.append(step)
+        for step in steps_to_sketch:
+            step['callable'].sketch_histogram = True
+        try:
+            yield steps_to_sketch
+        finally:
+            for step in steps_to_sketch:
+                step['callable'].sketch_histogram = False
 
-        original_do_filterings = []
-        for callable_instance in callables_to_check:
-            original_do_filterings.append(callable_instance.do_filtering)
-            callable_instance.do_filtering = False
+    def _build_histograms_from_sketches(self, result, steps_to_sketch):
+        for step in steps_to_sketch:
+            step_result = result.get(step['id'])
+            if step_result is None or HISTOGRAM_SKETCH not in step_result:
+                continue
+            sketch = step_result.pop(HISTOGRAM_SKETCH)
+            counts, edges = sketch.calc_histogram(step['callable'].n_bins)
+            step_result[COUNTS] = counts
+            step_result[EDGES] = edges
 
-        mins = []
-        maxs = []
-        for callable_instance in callables_to_check:
-            mins.append(None)
-            maxs.append(None)
+    def _get_fields_to_read(self, vars_in, vars_out):
+        '''The fields required by the steps and the ones written to vars_out
 
-        for chunk in vars_in.iterate_chunks(kept_fields=kept_fields,
-                                            ignored_fields=ignored_fields,
-                                            chunk_size=chunk_size):
-            for idx, callable_instance in enumerate(callables_to_check):
-                result = callable_instance(chunk)
-                min_, max_ = result[EDGES][0], result[EDGES][-1]
-                if mins[idx] is None or mins[idx] > min_:
-                    mins[idx] = min_
-                if maxs[idx] is None or maxs[idx] < max_:
-                    maxs[idx] = max_
-
-        for idx, callable_instance in enumerate(callables_to_check):
-            callable_instance.do_filtering = original_do_filterings[idx]
-            callable_instance.range = mins[idx], maxs[idx]
+        An empty vars_out gets every input field. If a step does not declare
+        its required fields, it returns None and every field is read.
+        '''
+        fields_to_read = set()
+        for step in self._pipeline:
+            step_fields = getattr(step['callable'], 'required_fields', None)
+            if step_fields is None:
+                return None
+            fields_to_read.update(step_fields)
+
+        if _is_parser(vars_in):
+            # the fields parsed are not known until the variations are read
+            if vars_out is not None and not vars_out.keys():
+                return None
+            if vars_out is not None:
+                fields_to_read.update(vars_out.keys())
+            return sorted(fields_to_read)
+
+        in_fields = list(vars_in.keys())
+        if vars_out is not None:
+            # the fields copied to the output
+            if vars_out.keys():
+                fields_to_read.update(vars_out.keys())
+            else:
+                fields_to_read.update(in_fields)
+        # the fields created by the steps are not in the input
+        fields_to_read = [field for field in in_fields
+                          if field in fields_to_read]
+        if not fields_to_read and in_fields:
+            # one field is read to know the number of variations
+            row_field = POS_FIELD if POS_FIELD in in_fields else in_fields[0]
+            fields_to_read = [row_field]
+        return fields_to_read
 
     def run(self, vars_in, vars_out=None, chunk_size=SNPS_PER_CHUNK,
-            kept_fields=None, ignored_fields=None, max_chunks_to_process=None):
+            kept_fields=None, ignored_fields=None, max_chunks_to_process=None,
+            n_workers=None, deferred_filtering=False, profile=False,
+            profile_callback=None, checkpoint_fpath=None,
+            checkpoint_interval=DEF_CHECKPOINT_INTERVAL):
+        '''It runs the steps for every chunk of vars_in
+
+        The vars_in can be a VariationsH5, a VariationsArrays or a parser,
+        like VCFParser, whose variations are filtered while they are parsed.
+
+        With profile, or a profile_callback, the time spent and the rows and
+        bytes processed by every step are added to its result, and the time
+        spent reading and writing to run_profile.
+        The profile_callback is called with the result after every chunk.
+
+        With a checkpoint_fpath the state of the run is saved every
+        checkpoint_interval seconds, and a run with the same checkpoint_fpath
+        resumes from the last checkpoint. The vars_out has to be a
+        VariationsH5 opened in r+ mode to resume. The checkpoint is removed
+        once the run is done.
+        '''
+        if checkpoint_fpath is None:
+            checkpoint = None
+        else:
+            if vars_out is not None and not isinstance(vars_out,
+                                                       VariationsH5):
+                msg = 'Only a VariationsH5 vars_out can be checkpointed'
+                raise ValueError(msg)
+            if chunk_size is None:
+                raise ValueError('A chunk_size is required for checkpoints')
+            checkpoint = _Checkpoint(checkpoint_fpath, chunk_size,
+                                     interval=checkpoint_interval)
+
+        if profile_callback is not None:
+            profile = True
+        if profile:
+            run_profile = _create_run_profile()
+            start = time.perf_counter()
+        else:
+            run_profile = None
+
+        if kept_fields is None and ignored_fields is None:
+            kept_fields = self._get_fields_to_read(vars_in, vars_out)
+
+        with self._sketching_histograms() as steps_to_sketch:
+            result = self._run(vars_in, vars_out, chunk_size, kept_fields,
+                               ignored_fields, max_chunks_to_process,
+                               n_workers, deferred_filtering, run_profile,
+                               profile_callback, checkpoint)
+        self._build_histograms_from_sketches(result, steps_to_sketch)
+        if run_profile is not None:
+            run_profile[WALL_TIME] = time.perf_counter() - start
+        if checkpoint is not None:
+            checkpoint.remove()
+        return result
+
+    def _run(self, vars_in, vars_out, chunk_size, kept_fields, ignored_fields,
+             max_chunks_to_process, n_workers, deferred_filtering,
+             run_profile=None, profile_callback=None, checkpoint=None):
+        if checkpoint is None:
+            result, start = None, 0
+        else:
+            result = checkpoint.load(vars_out)
+            start = checkpoint.n_chunks_done * chunk_size
+        chunks_to_process = self._iterate_chunks_to_process(vars_in,
+                                                            chunk_size,
+                                                            kept_fields,
+                                                            ignored_fields,
+                                                            start=start)
+        if max_chunks_to_process:
+            chunks_to_process = itertools.islice(chunks_to_process,
+                                                 max_chunks_to_process)
+        profile = run_profile is not None
+        if profile:
+            chunks_to_process = _profile_chunk_reads(chunks_to_process,
+                                                     run_profile)
+
+        # with n_workers the pipeline is sent to the processes of the pool
+        process_chunk = partial(_process_chunk, pipeline=self,
+                                deferred_filtering=deferred_filtering,
+                                profile=profile)
+        results_and_chunks = map_chunks(process_chunk, chunks_to_process,
+                                        n_workers=n_workers)
+
+        return self._reduce_results(results_and_chunks, vars_out,
+                                    run_profile, profile_callback,
+                                    checkpoint, result)
+
+
+def run_pipelines(vars_in, pipelines, vars_outs=None,
+                  chunk_size=SNPS_PER_CHUNK, kept_fields=None,
+                  ignored_fields=None, max_chunks_to_process=None,
+                  n_workers=None, deferred_filtering=False):
+    '''It runs several pipelines reading the input only once
+
+    Every chunk read is given to all pipelines, vars_outs has the vars_out
+    for each pipeline. It returns the results for each pipeline.
+    With two or more n_workers the chunks are processed by a pool of
+    processes. The profiling and the checkpoints of Pipeline.run are not
+    supported, the pipelines that require them have to be run one by one.
+    '''
+    if vars_outs is None:
+        vars_outs = [None] * len(pipelines)
+    if len(vars_outs) != len(pipelines):
+        raise ValueError('One vars_out is required for every pipeline')
 
-        self._check_and_fix_histogram_ranges(vars_in, chunk_size,
-                                             kept_fields=kept_fields,
-                                             ignored_fields=ignored_fields)
+    if kept_fields is None and ignored_fields is None:
+        fields_to_read = set()
+        for pipeline, vars_out in zip(pipelines, vars_outs):
+            pipeline_fields = pipeline._get_fields_to_read(vars_in, vars_out)
+            if pipeline_fields is None:
+                fields_to_read = None
+                break
+            fields_to_read.update(pipeline_fields)
+        if fields_to_read is not None:
+            kept_fields = list(fields_to_read)
 
-        chunks = vars_in.iterate_chunks(kept_fields=kept_fields,
-                                        ignored_fields=ignored_fields,
-                                        chunk_size=chunk_size)
+    results = [OrderedDict() for _ in pipelines]
+    with ExitStack() as stack:
+        steps_to_sketch = [stack.enter_context(pipeline._sketching_histograms())
+                           for pipeline in pipelines]
+        chunks = _iterate_shared_chunks(vars_in, pipelines, chunk_size,
+                                        kept_fields, ignored_fields)
         if max_chunks_to_process:
             chunks = itertools.islice(chunks, max_chunks_to_process)
 
-        results_and_chunks = map(self._pipeline_funct, chunks)
+        process_chunk = partial(_process_chunk_in_pipelines,
+                                pipelines=pipelines,
+                                deferred_filtering=deferred_filtering)
+        for chunk_results in map_chunks(process_chunk, chunks,
+                                        n_workers=n_workers):
+            for idx, pipeline in enumerate(pipelines):
+                slice_result, flt_chunk = chunk_results[idx]
+                pipeline._add_chunk_results(results[idx], slice_result,
+                                            flt_chunk, vars_outs[idx])
 
-        return self._reduce_results(results_and_chunks, vars_out)
+    for pipeline, result, pipeline_steps in zip(pipelines, results,
+                                                steps_to_sketch):
+        pipeline._build_histograms_from_sketches(result, pipeline_steps)
+    return results
@@ -1,9 +1,9 @@
 import re
 from functools import reduce
-from itertools import combinations_with_replacement, permutations
+from itertools import permutations
 import operator
 import math
-from functools import lru_cache
+from functools import lru_cache, partial
 
 import numpy
 from scipy.stats.stats import chisquare
@@ -16,12 +16,25 @@ from variation import (MISSING_VALUES, SNPS_PER_CHUNK, DEF_MIN_DEPTH,
                        GQ_FIELD, CHROM_FIELD, POS_FIELD, RO_FIELD, AO_FIELD,
                        MIN_NUM_GENOTYPES_FOR_POP_STAT, AD_FIELD)
 from variation.matrix.stats import (counts_by_row, counts_and_allels_by_row,
-                                    row_value_counter_fact)
+                                    count_gt_classes_by_row,
+                                    _count_values_by_row)
 from variation.matrix.methods import (is_missing, calc_min_max,
                                       is_dataset, iterate_matrix_chunks)
 from variation.plot import _estimate_percentiles_from_distrib
+from variation.variations.chunk_cache import (calc_counts_and_alleles,
+                                              calc_is_missing,
+                                              calc_is_hom_by_alleles)
+from variation.variations.index import calc_chrom_runs
+from variation.variations.vars_matrices import _WindowBuffer
+from variation.variations.map_reduce import (map_reduce_chunks, map_chunks,
+                                             add_chunk_results,
+                                             add_histograms)
 
 DEF_NUM_BINS = 20
+# Above this number of distinct values the histogram sketches are rounded
+DEF_MAX_DISTINCT_VALUES_IN_SKETCH = 2 ** 16
+# The windows along a chromosome are calculated in blocks of this size
+WINDOWS_PER_BLOCK = 2 ** 20
 
 REQUIRED_FIELDS_FOR_STAT = {'calc_maf': [GT_FIELD],
                             'calc_allele_freq': [GT_FIELD],
@@ -78,25 +91,181 @@ def calc_cum_distrib(distrib):
         return numpy.fliplr(numpy.cumsum(numpy.fliplr(distrib), axis=1))
 
 
+def histograms_per_sample(mat, n_bins=DEF_NUM_BINS, range_=None, mask=None,
+                          classes=None, n_classes=None):
+    '''It calculates the histogram of every column of a matrix at once
+
+    The values are binned as numpy.histogram does and the bins of every
+    column are offset, so all columns are counted with one bincount. The
+    missing values, the ones out of the range and the ones not in the mask
+    are not counted.
+    It returns a (n_cols, n_bins) count matrix and the edges. With classes,
+    a matrix with the class of every value, the counts of every class are
+    returned in a (n_classes, n_cols, n_bins) matrix. The values with a
+    negative class are not counted.
+    '''
+    if is_dataset(mat):
+        mat = mat[...]
+    mat = numpy.asarray(mat)
+    n_cols = mat.shape[1]
+
+    missing_value = MISSING_VALUES[mat.dtype]
+    if math.isnan(missing_value):
+        counted = ~numpy.isnan(mat)
+    else:
+        counted = mat != missing_value
+    if mask is not None:
+        counted &= mask
+    if classes is not None:
+        counted &= classes >= 0
+
+    if range_ is None:
+        values = mat[counted]
+        values = values[numpy.isfinite(values)]
+        range_ = (values.min(), values.max()) if values.size else (0, 1)
+    edges = numpy.histogram(mat[:0].ravel(), bins=n_bins, range=range_)[1]
+    first_edge, last_edge = range_
+    if first_edge == last_edge:
+        first_edge, last_edge = first_edge - 0.5, last_edge + 0.5
+    counted &= mat >= first_edge
+    counted &= mat <= last_edge
+
+    values = mat[counted].astype(edges.dtype, copy=False)
+    norm = n_bins / numpy.subtract(last_edge, first_edge)
+    bins = ((values - first_edge) * norm).astype(numpy.intp)
+    bins[bins == n_bins] -= 1
+    # the bins are corrected for the rounding errors near the edges
+    bins[values < edges[bins]] -= 1
+    bins[(values >= edges[bins + 1]) & (bins != n_bins - 1)] += 1
+
+    cols = numpy.broadcast_to(numpy.arange(n_cols), mat.shape)[counted]
+    bins += cols * n_bins
+    if classes is None:
+        n_hists = n_cols
+    else:
+        bins += classes[counted].astype(numpy.intp) * (n_cols * n_bins)
+        n_hists = n_classes * n_cols
+    counts = numpy.bincount(bins, minlength=n_hists * n_bins)
+    if classes is None:
+        return counts.reshape((n_cols, n_bins)), edges
+    return counts.reshape((n_classes, n_cols, n_bins)), edges
+
+
 def histograms_for_columns(matrix2d, n_bins=DEF_NUM_BINS, range_=None):
 
     if range_ is None:
         range_ = calc_min_max(matrix2d, chunk_size=None)
 
-    hists = None
-    edges = None
-    n_cols = matrix2d.shape[1]
-    for col_idx in range(n_cols):
-        column = matrix2d[:, col_idx]
-        counts, col_edges = _calc_histogram(column, n_bins, range_=range_)
-        if hists is None:
-            # hists = numpy.zeros((n_cols, counts.shape[0]))
-            hists = numpy.zeros((counts.shape[0], n_cols))
-            edges = col_edges
-        assert numpy.allclose(edges, col_edges)
-        # hists[col_idx, :] += counts
-        hists[:, col_idx] += counts
-    return hists, edges
+    hists, edges = histograms_per_sample(matrix2d, n_bins=n_bins,
+                                         range_=range_)
+    return hists.T, edges
+
+
+def _remove_missing_and_inf(vector):
+    try:
+        dtype = vector.dtype
+    except AttributeError:
+        dtype = type(vector[0])
+    missing_value = MISSING_VALUES[dtype]
+
+    if is_dataset(vector):
+        vector = vector[:]
+    vector = numpy.asarray(vector)
+
+    if math.isnan(missing_value):
+        return vector[numpy.isfinite(vector)]
+    vector = vector[vector != missing_value]
+    if numpy.issubdtype(vector.dtype, numpy.floating):
+        vector = vector[numpy.isfinite(vector)]
+    return vector
+
+
+class HistogramSketch:
+    '''It accumulates the values of several chunks to build a histogram
+
+    The number of times that every distinct value is found is kept, so the
+    histogram built is the one that would be calculated with all the values
+    together. If there are more than max_distinct_values different values
+    they are rounded to a grid of bins fine enough to keep them below that
+    number.
+    The sketches calculated for different chunks can be merged.
+    '''
+
+    def __init__(self, max_distinct_values=DEF_MAX_DISTINCT_VALUES_IN_SKETCH):
+        self.max_distinct_values = max_distinct_values
+        self._values = numpy.array([])
+        self._counts = numpy.array([], dtype=numpy.int64)
+        # the width of the grid used to round the values, if any
+        self._grid_width = None
+        self._min = None
+        self._max = None
+
+    @property
+    def num_values(self):
+        return int(self._counts.sum())
+
+    def _round_to_grid(self, values):
+        grid_width = self._grid_width
+        # the grids are nested, so the values rounded to a finer grid
+        # fall in the same coarser bin
+        values = (numpy.floor(values / grid_width) + 0.5) * grid_width
+        return numpy.clip(values, self._min, self._max)
+
+    def _add_counts(self, values, counts):
+        # the values are sorted
+        if values.size:
+            if self._min is None or values[0] < self._min:
+                self._min = values[0]
+            if self._max is None or values[-1] > self._max:
+                self._max = values[-1]
+        if self._grid_width is not None:
+            values = self._round_to_grid(values)
+        values = numpy.concatenate([self._values, values])
+        counts = numpy.concatenate([self._counts, counts])
+        self._values, idxs = numpy.unique(values, return_inverse=True)
+        self._counts = numpy.zeros(self._values.shape[0], dtype=numpy.int64)
+        numpy.add.at(self._counts, idxs, counts)
+
+        if self._values.shape[0] > self.max_distinct_values:
+            self._coarsen()
+
+    def _coarsen(self):
+        span = float(self._values[-1] - self._values[0])
+        grid_width = 2 ** math.ceil(math.log2(span /
+                                              (self.max_distinct_values - 1)))
+        if self._grid_width is not None:
+            grid_width = max(grid_width, self._grid_width * 2)
+        self._grid_width = grid_width
+        values, counts = self._values, self._counts
+        self._values = numpy.array([])
+        self._counts = numpy.array([], dtype=numpy.int64)
+        self._add_counts(values, counts)
+
+    def add(self, vector):
+        'It adds the values of the vector, the missing values are ignored'
+        vector = _remove_missing_and_inf(vector)
+        if not vector.size:
+            return
+        values, counts = numpy.unique(vector, return_counts=True)
+        self._add_counts(values, counts)
+
+    def merge(self, sketch):
+        if (sketch._grid_width is not None and
+                (self._grid_width is None or
+                 self._grid_width < sketch._grid_width)):
+            self._grid_width = sketch._grid_width
+            values, counts = self._values, self._counts
+            self._values = numpy.array([])
+            self._counts = numpy.array([], dtype=numpy.int64)
+            self._add_counts(values, counts)
+        self._add_counts(sketch._values, sketch._counts)
+
+    def calc_histogram(self, n_bins=DEF_NUM_BINS, range_=None):
+        if range_ is None and self._min is not None:
+            # the values could have been rounded
+            range_ = self._min, self._max
+        return numpy.histogram(self._values, bins=n_bins, range=range_,
+                               weights=self._counts)
 
 
 def _guess_stat_funct_called(calc_funct):
@@ -107,53 +276,49 @@ def _guess_stat_funct_called(calc_funct):
     return funct_name
 
 
-def _calc_stats_for_chunks(calc_funct, variations, chunk_size):
-    funct_name = _guess_stat_funct_called(calc_funct)
-    req_fields = REQUIRED_FIELDS_FOR_STAT[funct_name]
-    vectors = (calc_funct(chunk)
-               for chunk in variations.iterate_chunks(kept_fields=req_fields,
-                                                      chunk_size=chunk_size))
-    return vectors
+def _sketch_stat(variations, calc_funct):
+    sketch = HistogramSketch()
+    sketch.add(calc_funct(variations))
+    return sketch
 
 
-def histogram_for_chunks(variations, calc_funct, n_bins=DEF_NUM_BINS,
-                         range_=None, chunk_size=None):
-    if range_ is None:
-        range_ = _calc_range(_calc_stats_for_chunks(calc_funct, variations,
-                                                    chunk_size))
+def _merge_sketches(sketch, chunk_sketch):
+    sketch.merge(chunk_sketch)
+    return sketch
+
+
+def _calc_stat_histogram(variations, calc_funct, n_bins, range_):
+    return histogram(calc_funct(variations), n_bins, range_)
 
-    hist = None
-    for stat in _calc_stats_for_chunks(calc_funct, variations, chunk_size):
-        stat_hist, bins = histogram(stat, n_bins, range_)
-        if hist is None:
-            hist = stat_hist
-        else:
-            hist += stat_hist
-    return hist, bins
 
+def histogram_for_chunks(variations, calc_funct, n_bins=DEF_NUM_BINS,
+                         range_=None, chunk_size=None, n_workers=None):
+    req_fields = REQUIRED_FIELDS_FOR_STAT[_guess_stat_funct_called(calc_funct)]
+    chunks = variations.iterate_chunks(kept_fields=req_fields,
+                                       chunk_size=chunk_size)
+    if range_ is None:
+        # the range is not known until all values have been seen
+        sketches = map_chunks(partial(_sketch_stat, calc_funct=calc_funct),
+                              chunks, n_workers=n_workers)
+        sketch = reduce(_merge_sketches, sketches, HistogramSketch())
+        return sketch.calc_histogram(n_bins)
 
-def _calc_range(vectors):
-    min_ = None
-    max_ = None
-    for stat in vectors:
-        stat_max = numpy.max(stat)
-        stat_min = numpy.min(stat)
-        if min_ is None or min_ > stat_min:
-            min_ = stat_min
-        if max_ is None or max_ < stat_max:
-            max_ = stat_max
-    range_ = min_, max_
-    return range_
+    calc_hist = partial(_calc_stat_histogram, calc_funct=calc_funct,
+                        n_bins=n_bins, range_=range_)
+    return reduce(add_histograms, map_chunks(calc_hist, chunks,
+                                             n_workers=n_workers))
 
 
 def _calc_mac(variations, min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT):
-    gt_counts, alleles = counts_and_allels_by_row(variations[GT_FIELD])
+    gt_counts, alleles = calc_counts_and_alleles(variations[GT_FIELD])
     if gt_counts is None:
         return numpy.array([])
 
     if MISSING_INT in alleles:
         missing_allele_idx = alleles.index(MISSING_INT)
         num_missing = numpy.copy(gt_counts[:, missing_allele_idx])
+        # the counts could be shared with other calculations
+        gt_counts = numpy.copy(gt_counts)
         gt_counts[:, missing_allele_idx] = 0
     else:
         num_missing = 0
@@ -169,7 +334,7 @@ def _calc_mac(variations, min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT):
 
 def _calc_maf(variations, min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT):
     gts = variations[GT_FIELD]
-    gt_counts = counts_by_row(gts, missing_value=MISSING_INT)
+    gt_counts = calc_counts_and_alleles(gts, missing_value=MISSING_INT)[0]
     if gt_counts is None:
         return numpy.array([])
     max_ = numpy.amax(gt_counts, axis=1)
@@ -200,74 +365,57 @@ def _calc_allele_observation_based_maf(variations):
 
 
 def _calc_allele_observation_based_maf_by_chunk(variations,
-                                                chunk_size=SNPS_PER_CHUNK):
-    mafs = None
-    for chunk in variations.iterate_chunks(kept_fields=[AD_FIELD],
-                                           chunk_size=chunk_size):
-        chunk_maf = _calc_allele_observation_based_maf(chunk)
-        if mafs is None:
-            mafs = chunk_maf
-        else:
-            mafs = numpy.append(mafs, chunk_maf)
-    if mafs is None:
-        return numpy.array([])
-    return mafs
+                                                chunk_size=SNPS_PER_CHUNK,
+                                                n_workers=None):
+    return map_reduce_chunks(_calc_allele_observation_based_maf, variations,
+                             kept_fields=[AD_FIELD], chunk_size=chunk_size,
+                             n_workers=n_workers)
 
 
 def _calc_mac_by_chunk(variations,
                        min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT,
-                       chunk_size=SNPS_PER_CHUNK):
-    macs = None
-    for chunk in variations.iterate_chunks(kept_fields=[GT_FIELD],
-                                           chunk_size=chunk_size):
-        chunk_maf = _calc_mac(chunk, min_num_genotypes=min_num_genotypes)
-        if macs is None:
-            macs = chunk_maf
-        else:
-            macs = numpy.append(macs, chunk_maf)
-    if macs is None:
-        return numpy.array([])
-    return macs
+                       chunk_size=SNPS_PER_CHUNK, n_workers=None):
+    return map_reduce_chunks(partial(_calc_mac,
+                                     min_num_genotypes=min_num_genotypes),
+                             variations, kept_fields=[GT_FIELD],
+                             chunk_size=chunk_size, n_workers=n_workers)
 
 
 def _calc_maf_by_chunk(variations,
                        min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT,
-                       chunk_size=SNPS_PER_CHUNK):
-    mafs = None
-    for chunk in variations.iterate_chunks(kept_fields=[GT_FIELD],
-                                           chunk_size=chunk_size):
-        chunk_maf = _calc_maf(chunk, min_num_genotypes=min_num_genotypes)
-        if mafs is None:
-            mafs = chunk_maf
-        else:
-            mafs = numpy.append(mafs, chunk_maf)
-    if mafs is None:
-        return numpy.array([])
-    return mafs
+                       chunk_size=SNPS_PER_CHUNK, n_workers=None):
+    return map_reduce_chunks(partial(_calc_maf,
+                                     min_num_genotypes=min_num_genotypes),
+                             variations, kept_fields=[GT_FIELD],
+                             chunk_size=chunk_size, n_workers=n_workers)
 
 
 def calc_mac(variations, min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT,
-             chunk_size=SNPS_PER_CHUNK):
+             chunk_size=SNPS_PER_CHUNK, n_workers=None):
     if chunk_size is None:
         return _calc_mac(variations, min_num_genotypes=min_num_genotypes)
     else:
-        return _calc_mac_by_chunk(variations, min_num_genotypes, chunk_size)
+        return _calc_mac_by_chunk(variations, min_num_genotypes, chunk_size,
+                                  n_workers=n_workers)
 
 
 def calc_maf(variations, min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT,
-             chunk_size=SNPS_PER_CHUNK):
+             chunk_size=SNPS_PER_CHUNK, n_workers=None):
     if chunk_size is None:
         return _calc_maf(variations, min_num_genotypes=min_num_genotypes)
     else:
-        return _calc_maf_by_chunk(variations, min_num_genotypes, chunk_size)
+        return _calc_maf_by_chunk(variations, min_num_genotypes, chunk_size,
+                                  n_workers=n_workers)
 
 
-def calc_allele_observation_based_maf(variations, chunk_size=SNPS_PER_CHUNK):
+def calc_allele_observation_based_maf(variations, chunk_size=SNPS_PER_CHUNK,
+                                      n_workers=None):
     if not chunk_size:
         return _calc_allele_observation_based_maf(variations)
     else:
         return _calc_allele_observation_based_maf_by_chunk(variations,
-                                                           chunk_size)
+                                                           chunk_size,
+                                                           n_workers=n_workers)
 
 
 def calc_depth(variations):
@@ -326,32 +474,22 @@ def _calc_called_gts_distrib_per_depth(variations, depths):
 
 
 def _calc_called_gts_distrib_per_depth_by_chunk(variations, depths,
-                                                chunk_size):
-    distributions = None
+                                                chunk_size, n_workers=None):
     req_fields = REQUIRED_FIELDS_FOR_STAT['calc_called_gts_distrib_per_depth']
-    for chunk in variations.iterate_chunks(kept_fields=req_fields,
-                                           chunk_size=chunk_size):
-        chunk_distribs = None
-        for depth in depths:
-            chunk_distrib, bins = calc_num_samples_called_distrib(chunk,
-                                                                  depth)
-            if chunk_distribs is None:
-                chunk_distribs = chunk_distrib
-            else:
-                chunk_distribs = numpy.vstack((chunk_distribs, chunk_distrib))
-        if distributions is None:
-            distributions = chunk_distribs
-        else:
-            distributions = numpy.add(distributions, chunk_distribs)
-
-    return distributions, bins
+    return map_reduce_chunks(partial(_calc_called_gts_distrib_per_depth,
+                                     depths=depths),
+                             variations, merge_funct=add_histograms,
+                             kept_fields=req_fields, chunk_size=chunk_size,
+                             n_workers=n_workers)
 
 
 def calc_called_gts_distrib_per_depth(variations, depths,
-                                      chunk_size=SNPS_PER_CHUNK):
+                                      chunk_size=SNPS_PER_CHUNK,
+                                      n_workers=None):
     if chunk_size:
         return _calc_called_gts_distrib_per_depth_by_chunk(variations, depths,
-                                                           chunk_size)
+                                                           chunk_size,
+                                                           n_workers=n_workers)
     else:
         return _calc_called_gts_distrib_per_depth(variations, depths)
 
@@ -365,9 +503,7 @@ def calc_missing_gt(variations, rates=True, axis=1):
     gts = variations[GT_FIELD]
     if gts.shape[0] == 0:
         return numpy.array([])
-    if is_dataset(gts):
-        gts = gts[:]
-    missing = numpy.any(gts == MISSING_VALUES[int], axis=2).sum(axis=axis)
+    missing = calc_is_missing(gts, axis=2).sum(axis=axis)
     if rates:
         num_items_per_row = gts.shape[axis]
         result = missing / num_items_per_row
@@ -408,15 +544,9 @@ def _call_is_hom(variations, min_call_dp, max_call_dp=None):
     if gts.shape[0] == 0:
         return numpy.array([]), numpy.array([])
 
-    if is_dataset(gts):
-        gts = gts[:]
-
-    is_hom = numpy.full(gts.shape[:-1], True, dtype=numpy.bool)
-    for idx in range(1, gts.shape[2]):
-        is_hom = numpy.logical_and(gts[:, :, idx] == gts[:, :, idx - 1],
-                                   is_hom)
-
-    missing_gts = is_missing(gts, axis=2)
+    # the cached intermediates are not modified
+    is_hom = numpy.copy(calc_is_hom_by_alleles(gts))
+    missing_gts = calc_is_missing(gts, axis=2)
 
     if min_call_dp or max_call_dp:
         dps = variations[DP_FIELD]
@@ -491,141 +621,234 @@ def _calc_obs_het_by_sample(variations, min_call_dp=0, max_call_dp=None):
 
 
 def calc_obs_het_by_sample(variations, chunk_size=SNPS_PER_CHUNK,
-                           min_call_dp=0, max_call_dp=None):
-    if not chunk_size:
-        chunks = [variations]
-    else:
-        kept_fields = [GT_FIELD]
-        if DP_FIELD in variations.keys():
-            kept_fields.append(DP_FIELD)
-        chunks = variations.iterate_chunks(kept_fields=kept_fields,
-                                           chunk_size=chunk_size)
-    obs_het_by_sample = None
-    called_gts = None
-    for chunk in chunks:
-        chunk_obs_het_by_sample, missing = _calc_obs_het_by_sample(chunk,
-                                                                   min_call_dp,
-                                                                   max_call_dp)
-        chunk_called_gts = missing
-        if called_gts is None:
-            obs_het_by_sample = chunk_obs_het_by_sample
-            called_gts = chunk_called_gts
-        else:
-            obs_het_by_sample += chunk_obs_het_by_sample
-            called_gts += chunk_called_gts
+                           min_call_dp=0, max_call_dp=None, n_workers=None):
+    kept_fields = [GT_FIELD]
+    if DP_FIELD in variations.keys():
+        kept_fields.append(DP_FIELD)
+    counts = map_reduce_chunks(partial(_calc_obs_het_by_sample,
+                                       min_call_dp=min_call_dp,
+                                       max_call_dp=max_call_dp),
+                               variations, merge_funct=add_chunk_results,
+                               kept_fields=kept_fields,
+                               chunk_size=chunk_size or None,
+                               n_workers=n_workers)
+    obs_het_by_sample, called_gts = counts
     with numpy.errstate(invalid='ignore'):
         obs_het_by_sample = obs_het_by_sample / called_gts
     return obs_het_by_sample
 
 
-def calc_stats_by_sample(variations, chunk_size=SNPS_PER_CHUNK,
-                         min_call_dp=0, max_call_dp=None, dp_range=None,
-                         dp_n_bins=DEF_NUM_BINS):
+def _count_singletons_by_sample(gts, missing_gts):
+    'The variations in which the sample has an allele found in no other one'
+    if is_dataset(gts):
+        gts = gts[:]
+    n_rows = gts.shape[0]
+    # every allele of a call is counted once, the missing ones in the bin 0
+    alleles = numpy.sort(gts, axis=2) + 1
+    alleles[alleles < 0] = 0
+    alleles[:, :, 1:][alleles[:, :, 1:] == alleles[:, :, :-1]] = 0
+    alleles[missing_gts] = 0
+    n_values = int(alleles.max()) + 1 if alleles.size else 1
+    n_carriers = _count_values_by_row(alleles, 0, n_values)
+    n_carriers = numpy.take_along_axis(n_carriers,
+                                       alleles.reshape((n_rows, -1)), axis=1)
+    n_carriers = n_carriers.reshape(alleles.shape)
+    is_private = numpy.logical_and(n_carriers == 1, alleles > 0)
+    return numpy.sum(numpy.any(is_private, axis=2), axis=0)
+
+
+def _count_dp_values(dps, classes, n_classes=3):
+    '''It counts every (depth, class, sample) found in the integer depths
+
+    The combinations are coded in one int64 key and the sorted keys are
+    returned with their counts. The missing depths are not counted.
+    '''
+    n_samples = dps.shape[1]
+    counted = dps >= 0
+    cols = classes * n_samples + numpy.arange(n_samples)
+    keys = (dps[counted].astype(numpy.int64) * (n_classes * n_samples) +
+            cols[counted])
+    return numpy.unique(keys, return_counts=True)
+
+
+def _merge_dp_value_counts(value_counts1, value_counts2):
+    keys = numpy.concatenate([value_counts1[0], value_counts2[0]])
+    counts = numpy.concatenate([value_counts1[1], value_counts2[1]])
+    keys, idxs = numpy.unique(keys, return_inverse=True)
+    merged_counts = numpy.zeros(keys.shape[0], dtype=numpy.int64)
+    numpy.add.at(merged_counts, idxs, counts)
+    return keys, merged_counts
+
+
+def _bin_dp_value_counts(value_counts, n_samples, n_bins, dp_range=None,
+                         n_classes=3):
+    '''It bins the counted depths as histograms_per_sample would do
+
+    If no dp_range is given it goes from 0 to the maximum depth found.
+    It returns a (n_classes, n_samples, n_bins) count matrix and the edges.
+    '''
+    keys, counts = value_counts
+    n_cols = n_classes * n_samples
+    dps = keys // n_cols
+    cols = keys % n_cols
+    if dp_range is None:
+        dp_range = (0, dps[-1] if dps.size else 0)
+    edges = numpy.histogram([], bins=n_bins, range=dp_range)[1]
+
+    in_range = numpy.logical_and(dps >= edges[0], dps <= edges[-1])
+    bins = numpy.searchsorted(edges, dps[in_range], side='right') - 1
+    bins[bins == n_bins] = n_bins - 1
+    hists = numpy.bincount(cols[in_range] * n_bins + bins,
+                           weights=counts[in_range],
+                           minlength=n_cols * n_bins)
+    hists = hists.astype(numpy.int64).reshape(n_classes, n_samples, n_bins)
+    return hists, edges
 
-    do_depth = True if DP_FIELD in variations.keys() else False
 
-    if not chunk_size:
-        chunks = [variations]
-    else:
-        kept_fields = [GT_FIELD]
-        if do_depth:
-            kept_fields.append(DP_FIELD)
-        chunks = variations.iterate_chunks(kept_fields=kept_fields,
-                                           chunk_size=chunk_size)
+def _add_sample_qc_counts(result, chunk_result):
+    if 'dp_value_counts' in chunk_result:
+        value_counts = _merge_dp_value_counts(
+            result.pop('dp_value_counts'),
+            chunk_result.pop('dp_value_counts'))
+        result = add_chunk_results(result, chunk_result)
+        result['dp_value_counts'] = value_counts
+        return result
+    return add_chunk_results(result, chunk_result)
+
+
+def _count_sample_qc(variations, min_call_dp=0, max_call_dp=None,
+                     dp_range=None, dp_n_bins=DEF_NUM_BINS, do_depth=False):
+    gts = variations[GT_FIELD]
+    is_hom, missing_gts = _call_is_hom(variations, min_call_dp, max_call_dp)
+    is_het = numpy.logical_not(is_hom)
+    is_het[missing_gts] = False
+
+    counts = {'n_vars': gts.shape[0],
+              'het': numpy.sum(is_het, axis=0),
+              'hom': numpy.sum(is_hom, axis=0),
+              'called_gts': numpy.sum(numpy.logical_not(missing_gts), axis=0),
+              'singletons': _count_singletons_by_sample(gts, missing_gts)}
 
-    if dp_range is None and do_depth:
+    if do_depth:
+        dps = variations[DP_FIELD]
+        if is_dataset(dps):
+            dps = dps[:]
+        # the depths of the hom, het and missing calls are counted apart
+        classes = numpy.where(is_het, 1, 0)
+        classes[missing_gts] = 2
+        if numpy.issubdtype(dps.dtype, numpy.integer):
+            counts['dp_value_counts'] = _count_dp_values(dps, classes)
+        else:
+            counts['dp'] = histograms_per_sample(dps, n_bins=dp_n_bins,
+                                                 range_=dp_range,
+                                                 classes=classes,
+                                                 n_classes=3)[0]
+        has_dp = numpy.logical_not(is_missing(dps, axis=None))
+        counts['dp_sum'] = numpy.sum(dps, axis=0, where=has_dp)
+        counts['n_dps'] = numpy.sum(has_dp, axis=0)
+    return counts
+
+
+def calc_sample_qc(variations, chunk_size=SNPS_PER_CHUNK, min_call_dp=0,
+                   max_call_dp=None, dp_range=None, dp_n_bins=DEF_NUM_BINS,
+                   do_depth=None, n_workers=None):
+    '''It calculates the quality stats of every sample reading the chunks once
+
+    For every sample it counts the called, het and hom genotypes and the
+    singletons, the variations in which only that sample carries an allele.
+    With depths, by default if there is DP, the mean depth and the depth
+    histograms of the hom, het and missing calls are also calculated. The
+    integer depths are counted by value and binned at the end, so if no
+    dp_range is given it goes from 0 to the maximum depth. For non integer
+    depths the range is taken from the DP matrix before.
+    The result can be given to the sample filters, so they do not have to
+    read the variations to calculate it again.
+    '''
+    if do_depth is None:
+        do_depth = DP_FIELD in variations.keys()
+
+    kept_fields = [GT_FIELD]
+    if do_depth or min_call_dp or max_call_dp:
+        kept_fields.append(DP_FIELD)
+
+    dps_are_ints = (do_depth and
+                    numpy.issubdtype(variations[DP_FIELD].dtype,
+                                     numpy.integer))
+    if dp_range is None and do_depth and not dps_are_ints:
         dp_range = calc_min_max(variations[DP_FIELD],
                                 chunk_size=chunk_size)
     if dp_range is not None and dp_range[0] < 0:
         dp_range = [0, dp_range[1]]
 
-    het_counts = None
-    call_gt_counts = None
-    hom_counts = None
-    dp_hist_cnts = None
-    dp_hist_no_missing_cnts = None
-    dp_het_hist_cnts = None
-    for chunk in chunks:
-        is_hom, is_missing = _call_is_hom(chunk, min_call_dp, max_call_dp)
-        is_het = numpy.logical_not(is_hom)
-        is_het[is_missing] = False
-
-        chunk_het_counts = numpy.sum(is_het, axis=0)
-        if het_counts is None:
-            het_counts = chunk_het_counts
-        else:
-            het_counts += chunk_het_counts
-
-        chunk_hom_ref_counts = numpy.sum(is_hom, axis=0)
-        if hom_counts is None:
-            hom_counts = chunk_hom_ref_counts
-        else:
-            hom_counts += chunk_hom_ref_counts
+    count_qc = partial(_count_sample_qc, min_call_dp=min_call_dp,
+                       max_call_dp=max_call_dp, dp_range=dp_range,
+                       dp_n_bins=dp_n_bins, do_depth=do_depth)
+    counts = map_reduce_chunks(count_qc, variations,
+                               merge_funct=_add_sample_qc_counts,
+                               kept_fields=kept_fields,
+                               chunk_size=chunk_size or None,
+                               n_workers=n_workers)
+
+    n_vars = counts['n_vars']
+    called_gts = counts['called_gts']
+    qc = {'n_vars': n_vars,
+          'called_gts': called_gts,
+          'het': counts['het'],
+          'hom': counts['hom'],
+          'singletons': counts['singletons']}
+    with numpy.errstate(invalid='ignore'):
+        qc['called_gt_rate'] = called_gts / n_vars
+        qc['obs_het'] = counts['het'] / called_gts
+        qc['homozygosity'] = counts['hom'] / called_gts
 
-        chunk_called_gts = numpy.sum(numpy.logical_not(is_missing), axis=0)
-        if call_gt_counts is None:
-            call_gt_counts = chunk_called_gts
-        else:
-            call_gt_counts += chunk_called_gts
-
-        if do_depth:
-            dps = chunk[DP_FIELD]
-            chunk_dp_hist = histograms_for_columns(dps, n_bins=dp_n_bins,
-                                                   range_=dp_range)
-            if dp_hist_cnts is None:
-                dp_hist_cnts = chunk_dp_hist[0]
-                dp_bin_edges = chunk_dp_hist[1]
-            else:
-                dp_hist_cnts += chunk_dp_hist[0]
-
-            dps_no_missing = numpy.copy(dps)
-            dps_no_missing[is_missing] = MISSING_INT
-            chunk_dp_hist_no_missing = histograms_for_columns(dps_no_missing,
-                                                              n_bins=dp_n_bins,
-                                                              range_=dp_range)
-            if dp_hist_no_missing_cnts is None:
-                dp_hist_no_missing_cnts = chunk_dp_hist_no_missing[0]
-            else:
-                dp_hist_no_missing_cnts += chunk_dp_hist_no_missing[0]
-
-            dps_het = numpy.copy(dps)
-            dps_het[numpy.logical_not(is_het)] = MISSING_INT
-            chunk_dp_het_hist = histograms_for_columns(dps_het,
-                                                       n_bins=dp_n_bins,
-                                                       range_=dp_range)
-            if dp_het_hist_cnts is None:
-                dp_het_hist_cnts = chunk_dp_het_hist[0]
-            else:
-                dp_het_hist_cnts += chunk_dp_het_hist[0]
     if do_depth:
-        dp_hom_hist_cnts = dp_hist_no_missing_cnts - dp_het_hist_cnts
-
-    with numpy.errstate(invalid='ignore'):
-        het_rate = het_counts / call_gt_counts
+        with numpy.errstate(invalid='ignore'):
+            qc['mean_dp'] = counts['dp_sum'] / counts['n_dps']
+        if dps_are_ints:
+            dp_counts, dp_bin_edges = _bin_dp_value_counts(
+                counts['dp_value_counts'], n_samples=called_gts.shape[0],
+                n_bins=dp_n_bins, dp_range=dp_range)
+        else:
+            # the edges used for the histograms of every chunk
+            dp_counts = counts['dp']
+            dp_bin_edges = numpy.histogram([], bins=dp_n_bins,
+                                           range=dp_range)[1]
+        dp_hom_counts, dp_het_counts, dp_missing_counts = dp_counts
+        qc['dp_hists'] = {'bin_edges': dp_bin_edges,
+                          'dp_hom_counts': dp_hom_counts,
+                          'dp_het_counts': dp_het_counts,
+                          'dp_missing_counts': dp_missing_counts}
+    return qc
 
-    with numpy.errstate(invalid='ignore'):
-        hom_rate = hom_counts / call_gt_counts
 
-    with numpy.errstate(invalid='ignore'):
-        if isinstance(variations, dict):
-            # just for the test
-            num_vars = variations[GT_FIELD].shape[0]
-        else:
-            num_vars = variations.num_variations
-        call_gt_rate = call_gt_counts / num_vars
+def calc_stats_by_sample(variations, chunk_size=SNPS_PER_CHUNK,
+                         min_call_dp=0, max_call_dp=None, dp_range=None,
+                         dp_n_bins=DEF_NUM_BINS, n_workers=None,
+                         sample_qc=None):
+    if sample_qc is None:
+        sample_qc = calc_sample_qc(variations, chunk_size=chunk_size,
+                                   min_call_dp=min_call_dp,
+                                   max_call_dp=max_call_dp, dp_range=dp_range,
+                                   dp_n_bins=dp_n_bins, n_workers=n_workers)
 
     # for the test
     samples = {} if isinstance(variations, dict) else variations.samples[:]
-    res = {'called_gt_rate': call_gt_rate,
-           'obs_het': het_rate,
-           'homozygosity': hom_rate,
+    res = {'called_gt_rate': sample_qc['called_gt_rate'],
+           'obs_het': sample_qc['obs_het'],
+           'homozygosity': sample_qc['homozygosity'],
            'samples': samples}
-    if do_depth:
-        dp_hists = {'bin_edges': dp_bin_edges,
-                    'dp_counts': dp_hist_cnts,
-                    'dp_no_missing_counts': dp_hist_no_missing_cnts,
-                    'dp_het_counts': dp_het_hist_cnts,
-                    'dp_hom_counts': dp_hom_hist_cnts}
+    if 'dp_hists' in sample_qc:
+        qc_hists = sample_qc['dp_hists']
+        # the histograms of every sample are in the columns
+        dp_hom_counts = qc_hists['dp_hom_counts'].T
+        dp_het_counts = qc_hists['dp_het_counts'].T
+        dp_no_missing_counts = dp_hom_counts + dp_het_counts
+        dp_counts = dp_no_missing_counts + qc_hists['dp_missing_counts'].T
+        dp_hists = {'bin_edges': qc_hists['bin_edges'],
+                    'dp_counts': dp_counts,
+                    'dp_no_missing_counts': dp_no_missing_counts,
+                    'dp_het_counts': dp_het_counts,
+                    'dp_hom_counts': dp_hom_counts}
         res['dp_hists'] = dp_hists
     return res
 
@@ -660,87 +883,34 @@ def _calc_gt_type_stats(variations):
     return numpy.array([ref_hom, het, alt_hom, missing])
 
 
-def calc_gt_type_stats(variations, chunk_size=None):
-    if chunk_size is None:
-        chunks = [variations]
-    else:
-        chunks = variations.iterate_chunks(kept_fields=[GT_FIELD],
-                                           chunk_size=chunk_size)
-    gt_type_stats = None
-    for chunk in chunks:
-        chunk_stats = _calc_gt_type_stats(chunk)
-        if gt_type_stats is None:
-            gt_type_stats = chunk_stats
-        else:
-            gt_type_stats += chunk_stats
-    return gt_type_stats
-
-
-def _snps_close(chrom1, pos1, chrom2, pos2, dist):
-    if chrom1 != chrom2:
-        return None
-    if pos1 == pos2:
-        return True
-    elif abs(pos1 - pos2) <= dist:
-        return True
-    else:
-        return False
-
-
-class _ArrayWrapper():
-
-    def __init__(self, array, cache_len=400):
-        self.array = array
-        self._h5_cache = None
-        self._cache_len = cache_len
-        self._cache_offset = None
+def calc_gt_type_stats(variations, chunk_size=None, n_workers=None):
+    return map_reduce_chunks(_calc_gt_type_stats, variations,
+                             merge_funct=add_chunk_results,
+                             kept_fields=[GT_FIELD], chunk_size=chunk_size,
+                             n_workers=n_workers)
 
-    @lru_cache(maxsize=128)
-    def __getitem__(self, idx):
-        if self._h5_cache is None:
-            self._fill_cache(idx)
-        return self.read_from_cache(idx)
 
-    def read_from_cache(self, idx):
-        # is cache consumed?
-        if idx - self._cache_offset >= len(self._h5_cache):
-            self._fill_cache(idx)
-        return self._h5_cache[idx - self._cache_offset]
+def calc_snp_density(variations, window, chunk_size=SNPS_PER_CHUNK):
+    '''It returns the number of SNPs in the window centered in every SNP
 
-    def _fill_cache(self, idx):
-        self._h5_cache = self.array[idx: idx + self._cache_len]
-        self._cache_offset = idx
-
-
-def calc_snp_density(variations, window):
+    The result is an int32 numpy array with one density per SNP, in the
+    order of the variations, not a generator. The SNPs should be sorted by
+    position within every chromosome.
+    '''
     half_win = (window - 1) / 2
-    chroms = _ArrayWrapper(variations[CHROM_FIELD])
-    poss = _ArrayWrapper(variations[POS_FIELD])
-
-    last_idx = len(chroms.array) - 1
-    left_win_idx = 0
-    right_win_idx = 0
-    for idx in range(chroms.array.shape[0]):
-        chrom = chroms[idx]
-        pos = poss[idx]
-        # update left index
-        while True:
-            if not _snps_close(chrom, pos, chroms[left_win_idx],
-                               poss[left_win_idx], half_win):
-                left_win_idx += 1
-            else:
-                break
-        # update right index
-        while True:
-            if right_win_idx + 1 > last_idx:
-                break
-            elif _snps_close(chrom, pos, chroms[right_win_idx + 1],
-                             poss[right_win_idx + 1], half_win):
-                right_win_idx += 1
-            else:
-                break
-        snps_in_win = right_win_idx - left_win_idx + 1
-        yield snps_in_win
+    poss = variations[POS_FIELD][:]
+    boundaries = calc_chrom_runs(variations[CHROM_FIELD],
+                                 chunk_size=chunk_size)[1]
+
+    density = numpy.empty((poss.shape[0],), dtype=numpy.int32)
+    for start, stop in zip(boundaries[:-1], boundaries[1:]):
+        chrom_poss = poss[start:stop]
+        win_starts = numpy.searchsorted(chrom_poss, chrom_poss - half_win,
+                                        side='left')
+        win_ends = numpy.searchsorted(chrom_poss, chrom_poss + half_win,
+                                      side='right')
+        density[start:stop] = win_ends - win_starts
+    return density
 
 
 def _calc_allele_counts(gts, alleles=None):
@@ -835,67 +1005,36 @@ def _calc_inbreeding_coef(variations,
 
 
 def calc_inbreeding_coef(variations, chunk_size=SNPS_PER_CHUNK,
-                         min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT):
-    if chunk_size is None:
-        chunks = [variations]
-    else:
-        chunks = variations.iterate_chunks(kept_fields=[GT_FIELD, ALT_FIELD],
-                                           chunk_size=chunk_size)
-    inbreed_coef = None
-    for chunk in chunks:
-        chunk_inbreed_coef = _calc_inbreeding_coef(chunk,
-                                                   min_num_genotypes)
-        if inbreed_coef is None:
-            inbreed_coef = chunk_inbreed_coef
-        else:
-            inbreed_coef = numpy.append(inbreed_coef, chunk_inbreed_coef)
-    if inbreed_coef is None:
-        return numpy.array([])
-    return inbreed_coef
+                         min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT,
+                         n_workers=None):
+    return map_reduce_chunks(partial(_calc_inbreeding_coef,
+                                     min_num_genotypes=min_num_genotypes),
+                             variations, kept_fields=[GT_FIELD, ALT_FIELD],
+                             chunk_size=chunk_size, n_workers=n_workers)
 
 
 def _calc_hwe_chi2_test(variations, num_allele,
                         min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT):
-    ploidy = variations.ploidy
     gts = variations[GT_FIELD]
     if gts.shape[0] == 0:
         return numpy.array([])
 
     allele_freq = calc_allele_freq(variations,
                                    min_num_genotypes=min_num_genotypes)
+    # the alleles of the chunk are fewer than the ones asked for
+    if num_allele > allele_freq.shape[1]:
+        return numpy.empty((0, 2))
     # Select vars with a certain number of alleles
     sel_vars = numpy.sum(allele_freq != 0, axis=1) == num_allele
     allele_freq = allele_freq[sel_vars]
     gts = gts[sel_vars, :, :]
 
-    genotypes = list(combinations_with_replacement(range(num_allele),
-                                                   ploidy))
-
-    gts_counts = numpy.zeros((gts.shape[0], len(genotypes)))
-    exp_gts_freq = numpy.ones((gts.shape[0], len(genotypes)))
+    gts_counts, genotypes = count_gt_classes_by_row(gts, n_alleles=num_allele)
 
+    exp_gts_freq = numpy.ones(gts_counts.shape)
     for i, genotype in enumerate(genotypes):
-
-        permutated_gts = set(permutations(genotype))
-        mask = None
-        for gt in permutated_gts:
-            permuted_mask = None
-            for allele_idx in range(ploidy):
-                if permuted_mask is None:
-                    permuted_mask = gts[:, :, allele_idx] == gt[allele_idx]
-                else:
-                    new_mask = gts[:, :, allele_idx] == gt[allele_idx]
-                    permuted_mask = numpy.logical_and(permuted_mask, new_mask)
-
-            if mask is None:
-                mask = permuted_mask
-            else:
-                mask = numpy.stack([mask, permuted_mask], axis=2)
-                mask = numpy.any(mask, axis=2)
-
-            allele = genotype[allele_idx]
-            exp_gts_freq[:, i] *= allele_freq[:, allele]
-        gts_counts[:, i] = numpy.sum(mask, axis=1)
+        for _ in set(permutations(genotype)):
+            exp_gts_freq[:, i] *= allele_freq[:, genotype[-1]]
 
     total_gt_counts = numpy.sum(gts_counts, axis=1)
     exp_gts_counts = (exp_gts_freq.T * total_gt_counts).T
@@ -906,22 +1045,13 @@ def _calc_hwe_chi2_test(variations, num_allele,
 
 def calc_hwe_chi2_test(variations, num_allele=2,
                        min_num_genotypes=MIN_NUM_GENOTYPES_FOR_POP_STAT,
-                       chunk_size=SNPS_PER_CHUNK):
-    if chunk_size is None:
-        chunks = [variations]
-    else:
-        req_fields = REQUIRED_FIELDS_FOR_STAT['calc_hwe_chi2_test']
-        chunks = variations.iterate_chunks(kept_fields=req_fields,
-                                           chunk_size=chunk_size)
-    hwe_test = None
-    for chunk in chunks:
-        chunk_hwe_test = _calc_hwe_chi2_test(chunk, num_allele,
-                                             min_num_genotypes)
-        if hwe_test is None:
-            hwe_test = chunk_hwe_test
-        else:
-            hwe_test = numpy.append(hwe_test, chunk_hwe_test, axis=0)
-    return hwe_test
+                       chunk_size=SNPS_PER_CHUNK, n_workers=None):
+    req_fields = REQUIRED_FIELDS_FOR_STAT['calc_hwe_chi2_test']
+    return map_reduce_chunks(partial(_calc_hwe_chi2_test,
+                                     num_allele=num_allele,
+                                     min_num_genotypes=min_num_genotypes),
+                             variations, kept_fields=req_fields,
+                             chunk_size=chunk_size, n_workers=n_workers)
 
 
 def _get_allele_observations(variations, mask_func, weights_field=None,
@@ -970,75 +1100,75 @@ def _update_range(xrange, this_x_range):
     return xrange
 
 
+def _calc_allele_observations_range(variations, mask_func=None,
+                                    mask_field=GT_FIELD):
+    mat1, mat2, _ = _get_allele_observations(variations, mask_func,
+                                             mask_field=mask_field)
+    return list(calc_min_max(mat1)), list(calc_min_max(mat2))
+
+
+def _merge_ranges(ranges, chunk_ranges):
+    return [_update_range(range_, chunk_range)
+            for range_, chunk_range in zip(ranges, chunk_ranges)]
+
+
 def _hist2d_allele_observations_by_chunk(variations, n_bins=DEF_NUM_BINS,
                                          range_=None, mask_func=None,
                                          weights_field=None,
                                          chunk_size=SNPS_PER_CHUNK,
-                                         mask_field=GT_FIELD):
+                                         mask_field=GT_FIELD, n_workers=None):
     fields = [RO_FIELD, AO_FIELD, GT_FIELD]
     if range_ is None:
-        xrange = None
-        yrange = None
-        for var_chunk in variations.iterate_chunks(kept_fields=fields,
-                                                   chunk_size=chunk_size):
-            mat1, mat2, _ = _get_allele_observations(var_chunk, mask_func,
-                                                     mask_field=mask_field)
-            this_x_range = calc_min_max(mat1)
-            xrange = _update_range(xrange, this_x_range)
-            this_y_range = calc_min_max(mat2)
-            yrange = _update_range(yrange, this_y_range)
-        range_ = [xrange, yrange]
+        calc_range = partial(_calc_allele_observations_range,
+                             mask_func=mask_func, mask_field=mask_field)
+        range_ = map_reduce_chunks(calc_range, variations,
+                                   merge_funct=_merge_ranges,
+                                   kept_fields=fields, chunk_size=chunk_size,
+                                   n_workers=n_workers)
 
     if weights_field is not None:
         fields.append(weights_field)
-    hist = None
-    for var_chunk in variations.iterate_chunks(kept_fields=fields,
-                                               chunk_size=chunk_size):
-        res = _hist2d_allele_observations(var_chunk, n_bins=n_bins,
-                                          range_=range_, mask_func=mask_func,
-                                          weights_field=weights_field)
-        this_hist, xbins, y_bins = res
-        if hist is None:
-            hist = this_hist
-        else:
-            hist = numpy.add(hist, this_hist)
-    return hist, xbins, y_bins
+    calc_hist2d = partial(_hist2d_allele_observations, n_bins=n_bins,
+                          range_=range_, mask_func=mask_func,
+                          weights_field=weights_field)
+    return map_reduce_chunks(calc_hist2d, variations,
+                             merge_funct=add_histograms, kept_fields=fields,
+                             chunk_size=chunk_size, n_workers=n_workers)
 
 
 def hist2d_allele_observations(variations, n_bins=DEF_NUM_BINS, range_=None,
-                               mask_func=None, chunk_size=SNPS_PER_CHUNK):
+                               mask_func=None, chunk_size=SNPS_PER_CHUNK,
+                               weights_field=None, n_workers=None):
     if chunk_size:
         return _hist2d_allele_observations_by_chunk(variations,
                                                     n_bins=n_bins,
                                                     range_=range_,
                                                     mask_func=mask_func,
-                                                    chunk_size=chunk_size)
+                                                    weights_field=weights_field,
+                                                    chunk_size=chunk_size,
+                                                    n_workers=n_workers)
     else:
         return _hist2d_allele_observations(variations, n_bins=n_bins,
-                                           range_=range_, mask_func=mask_func)
+                                           range_=range_, mask_func=mask_func,
+                                           weights_field=weights_field)
 
 
 def hist2d_gq_allele_observations(variations, n_bins=DEF_NUM_BINS, range_=None,
                                   mask_func=None, chunk_size=SNPS_PER_CHUNK,
-                                  hist_counts=None):
+                                  hist_counts=None, n_workers=None):
     if hist_counts is None:
         res = hist2d_allele_observations(variations, n_bins=n_bins,
                                          range_=range_,
                                          mask_func=mask_func,
-                                         chunk_size=chunk_size)
+                                         chunk_size=chunk_size,
+                                         n_workers=n_workers)
         hist_counts, _, _ = res
 
-    if chunk_size:
-        res = _hist2d_allele_observations_by_chunk(variations,
-                                                   n_bins=n_bins,
-                                                   range_=range_,
-                                                   mask_func=mask_func,
-                                                   weights_field=GQ_FIELD,
-                                                   chunk_size=chunk_size)
-    else:
-        res = _hist2d_allele_observations(variations, n_bins=n_bins,
-                                          range_=range_, mask_func=mask_func,
-                                          weights_field=GQ_FIELD)
+    res = hist2d_allele_observations(variations, n_bins=n_bins,
+                                     range_=range_, mask_func=mask_func,
+                                     chunk_size=chunk_size,
+                                     weights_field=GQ_FIELD,
+                                     n_workers=n_workers)
     hist, xbins, ybins = res
     with numpy.errstate(invalid='ignore'):
         hist = hist / hist_counts
@@ -1046,14 +1176,6 @@ def hist2d_gq_allele_observations(variations, n_bins=DEF_NUM_BINS, range_=None,
     return hist, xbins, ybins
 
 
-def _packed_gt_to_tuple(gt, ploidy):
-    gt_len = ploidy * 2
-    gt_fmt = '%0' + str(gt_len) + 'd'
-    gt = gt_fmt % gt
-    gt = tuple(sorted([int(gt[idx: idx + 2]) for idx in range(0, len(gt), 2)]))
-    return gt
-
-
 def _gt_is_homo(gt):
     return all(allele == gt[0] for allele in gt)
 
@@ -1070,70 +1192,34 @@ def _hist2d_het_allele_freq(variations, n_bins=DEF_NUM_BINS,
     if is_dataset(gts):
         gts = gts[...]
 
-    # get rid of genotypes with missing alleles
-    missing_alleles = gts == MISSING_INT
-    miss_gts = numpy.any(missing_alleles, axis=2)
     if min_call_dp_for_het:
         dps = variations[DP_FIELD]
         if is_dataset(dps):
             dps = dps[...]
         low_dp = dps < min_call_dp_for_het
-        miss_gts = numpy.logical_or(miss_gts, low_dp)
-
-    # We pack the genotype of a sample that is in third axes as two
-    # integers as one integer: 1, 1 -> 11 0, 1 -> 01, 0, 0-> 0
-    gts_per_haplo = [(gts[:, :, idx].astype(numpy.int16)) * (100 ** idx) for idx in range(gts.shape[2])]
-    packed_gts = None
-    for gts_ in gts_per_haplo:
-        if packed_gts is None:
-            packed_gts = gts_
-        else:
-            packed_gts += gts_
-    packed_gts[miss_gts] = MISSING_INT
+        gts = numpy.copy(gts)
+        gts[low_dp] = MISSING_INT
 
-    different_gts = numpy.unique(packed_gts)
     # Count genotypes, homo, het and alleles
-    ploidy = gts.shape[2]
-    allele_counts_by_snp = {}
-    het_counts_by_snp = None
-    homo_counts_by_snp = None
-    miss_gt_counts_by_snp = None
-    for gt in different_gts:
-
-        count_gt_by_row = row_value_counter_fact(gt)
-        gt_counts = count_gt_by_row(packed_gts)
-
-        if gt == MISSING_INT:
-            miss_gt_counts_by_snp = gt_counts
-            continue
-
-        unpacked_gt = _packed_gt_to_tuple(gt, ploidy)
-        if _gt_is_homo(unpacked_gt):
-            if homo_counts_by_snp is None:
-                homo_counts_by_snp = gt_counts
-            else:
-                homo_counts_by_snp += gt_counts
-        else:
-            if het_counts_by_snp is None:
-                het_counts_by_snp = gt_counts
-            else:
-                het_counts_by_snp += gt_counts
-
-        for allele in unpacked_gt:
-            if allele not in allele_counts_by_snp:
-                allele_counts_by_snp[allele] = numpy.copy(gt_counts)
-            else:
-                allele_counts_by_snp[allele] += gt_counts
-    if het_counts_by_snp is None:
-        het_counts_by_snp = numpy.zeros(shape=homo_counts_by_snp.shape)
-    het = het_counts_by_snp / (homo_counts_by_snp + het_counts_by_snp)
-
-    allele_counts = numpy.array(list(allele_counts_by_snp.values()))
-    max_allele = numpy.amax(allele_counts, axis=0)
-    max_allele_freq = max_allele / numpy.sum(allele_counts, axis=0)
-    if min_num_genotypes > 0 and miss_gt_counts_by_snp is not None:
-        num_samples = gts.shape[1]
-        num_calls = -miss_gt_counts_by_snp + num_samples
+    gt_counts, genotypes = count_gt_classes_by_row(gts)
+    gt_is_homo = numpy.array([_gt_is_homo(gt) for gt in genotypes])
+    homo_counts_by_snp = numpy.sum(gt_counts[:, gt_is_homo], axis=1)
+    het_counts_by_snp = numpy.sum(gt_counts[:, ~gt_is_homo], axis=1)
+    num_calls = homo_counts_by_snp + het_counts_by_snp
+    het = het_counts_by_snp / num_calls
+
+    # the number of copies of every allele in every genotype
+    n_alleles = max(max(gt) for gt in genotypes) + 1
+    alleles_in_gts = numpy.zeros((len(genotypes), n_alleles), dtype=int)
+    for gt_idx, gt in enumerate(genotypes):
+        for allele in gt:
+            alleles_in_gts[gt_idx, allele] += 1
+    allele_counts = numpy.dot(gt_counts, alleles_in_gts)
+    max_allele = numpy.amax(allele_counts, axis=1)
+    max_allele_freq = max_allele / numpy.sum(allele_counts, axis=1)
+
+    num_samples = gts.shape[1]
+    if min_num_genotypes > 0 and numpy.any(num_calls < num_samples):
         enoug_calls = num_calls >= min_num_genotypes
         het = het[enoug_calls]
         max_allele_freq = max_allele_freq[enoug_calls]
@@ -1273,22 +1359,15 @@ def calc_field_distribs_per_sample(variations, field, range_=None,
             chunks = [(mat, mask_mat)]
 
     histograms = None
-
     for chunk in chunks:
-        chunk_hists = None
         chunk_mask = None
-        if mask_mat is not None and mask_func is not None:
+        if mask_mat is not None:
             chunk, mask_chunk = chunk
-            chunk_mask = mask_func(mask_chunk)
-        for sample_idx in range(len(variations.samples)):
-            dps = chunk[:, sample_idx]
-            if chunk_mask is not None:
-                dps = dps[chunk_mask[:, sample_idx]]
-            chunk_hist, bins = histogram(dps, n_bins=n_bins, range_=range_)
-            if chunk_hists is None:
-                chunk_hists = chunk_hist
-            else:
-                chunk_hists = numpy.vstack((chunk_hists, chunk_hist))
+            if mask_func is not None:
+                chunk_mask = mask_func(mask_chunk)
+        chunk_hists, bins = histograms_per_sample(chunk, n_bins=n_bins,
+                                                  range_=range_,
+                                                  mask=chunk_mask)
         if histograms is None:
             histograms = chunk_hists
         else:
@@ -1315,33 +1394,24 @@ def _calc_maf_depth(variations, min_depth=DEF_MIN_DEPTH):
     return depth_maf
 
 
+def _calc_maf_depth_distribs_per_sample(variations, min_depth=DEF_MIN_DEPTH,
+                                        n_bins=DEF_NUM_BINS * 2):
+    maf_depth = _calc_maf_depth(variations, min_depth)
+    if len(maf_depth.shape) != 2:
+        return None, None
+    return histograms_per_sample(maf_depth, n_bins=n_bins, range_=(0, 1))
+
+
 def calc_maf_depth_distribs_per_sample(variations, min_depth=DEF_MIN_DEPTH,
                                        n_bins=DEF_NUM_BINS * 2,
-                                       chunk_size=SNPS_PER_CHUNK):
-    range_ = 0, 1
-    if chunk_size:
-        chunks = variations.iterate_chunks(kept_fields=[AO_FIELD, RO_FIELD],
-                                           chunk_size=chunk_size)
-    else:
-        chunks = [variations]
-
-    histograms = None
-    bins = None
-    for chunk in chunks:
-        chunk_hists = None
-        maf_depth = _calc_maf_depth(chunk, min_depth)
-        for sample_idx in range(len(variations.samples)):
-            chunk_hist, bins = histogram(maf_depth[:, sample_idx],
-                                         n_bins=n_bins, range_=range_)
-            if chunk_hists is None:
-                chunk_hists = chunk_hist
-            else:
-                chunk_hists = numpy.vstack((chunk_hists, chunk_hist))
-        if histograms is None:
-            histograms = chunk_hists
-        else:
-            histograms = numpy.add(histograms, chunk_hists)
-    return histograms, bins
+                                       chunk_size=SNPS_PER_CHUNK,
+                                       n_workers=None):
+    return map_reduce_chunks(partial(_calc_maf_depth_distribs_per_sample,
+                                     min_depth=min_depth, n_bins=n_bins),
+                             variations, merge_funct=add_histograms,
+                             kept_fields=[AO_FIELD, RO_FIELD],
+                             chunk_size=chunk_size or None,
+                             n_workers=n_workers)
 
 
 class PositionalStatsCalculator:
@@ -1356,13 +1426,37 @@ class PositionalStatsCalculator:
         self.step = step
         self.take_windows = take_windows
 
-    def _calc_chrom_window_stat(self, pos, values):
+    def _iterate_chrom_window_blocks(self, pos, values):
+        '''It yields the starts and the stats of the windows by blocks
+
+        The sum of the values in every window is taken from the cumulative
+        sum of the values, so the cost is linear with the number of
+        positions and windows.
+        '''
         # TODO: take into account unknown positions in the genome fastafile?
+        if numpy.any(pos[1:] < pos[:-1]):
+            order = numpy.argsort(pos, kind='mergesort')
+            pos = pos[order]
+            values = values[order]
+        cum_values = numpy.concatenate(([0], numpy.cumsum(values)))
+        first_start, last_start = int(pos[0]), int(pos[-1])
+        block_len = self.step * WINDOWS_PER_BLOCK
+        for block_start in range(first_start, last_start, block_len):
+            block_end = min(block_start + block_len, last_start)
+            starts = numpy.arange(block_start, block_end, self.step,
+                                  dtype=numpy.int64)
+            firsts = numpy.searchsorted(pos, starts, side='left')
+            lasts = numpy.searchsorted(pos, starts + self.window_size,
+                                       side='left')
+            sums = cum_values[lasts] - cum_values[firsts]
+            yield starts, sums / self.window_size
+
+    def _calc_chrom_window_stat(self, pos, values):
         if self.window_size and self.take_windows:
-            for i in range(pos[0], pos[-1], self.step):
-                window = numpy.logical_and(pos >= i,
-                                           pos < i + self.window_size)
-                yield i, numpy.sum(values[window]) / self.window_size
+            for starts, stats in self._iterate_chrom_window_blocks(pos,
+                                                                   values):
+                for start, stat in zip(starts.tolist(), stats.tolist()):
+                    yield start, stat
         else:
             for x, y in zip(pos, values):
                 yield x, y
@@ -1370,25 +1464,38 @@ class PositionalStatsCalculator:
     def calc_window_stat(self):
         w_chroms, w_pos, w_stat = [], [], []
         for chrom_name, pos, values in self._iterate_chroms():
-            for chrom_pos, value in self._calc_chrom_window_stat(pos, values):
-                w_chroms.append(chrom_name)
-                w_pos.append(chrom_pos)
-                w_stat.append(value)
-        chrom = numpy.array(w_chroms)
-        pos = numpy.array(w_pos)
-        stat = numpy.array(w_stat)
+            if self.window_size and self.take_windows:
+                blocks = self._iterate_chrom_window_blocks(pos, values)
+            else:
+                blocks = [(pos, values)]
+            for block_pos, block_stat in blocks:
+                w_chroms.append(numpy.full(block_pos.shape[0], chrom_name))
+                w_pos.append(block_pos)
+                w_stat.append(block_stat)
+        if w_chroms:
+            chrom = numpy.concatenate(w_chroms)
+            pos = numpy.concatenate(w_pos)
+            stat = numpy.concatenate(w_stat)
+        else:
+            chrom, pos, stat = numpy.array([]), numpy.array([]), numpy.array([])
 
         return PositionalStatsCalculator(chrom, pos, stat, self.window_size,
                                          self.step, False)
 
     def _iterate_chroms(self):
-        for chrom_name in self.chrom_names:
-            mask = numpy.logical_and(self.chrom == chrom_name,
-                                     numpy.logical_not(numpy.isnan(self.stat)))
-            values = self.stat[mask]
-            pos = self.pos[mask]
-            if values.shape != () and values.shape != (0,):
-                yield chrom_name, pos, values
+        not_nan = numpy.logical_not(numpy.isnan(self.stat))
+        chrom = self.chrom[not_nan]
+        pos = self.pos[not_nan]
+        stat = self.stat[not_nan]
+        # the rows are grouped by chrom keeping their order within a chrom
+        chrom_idxs = numpy.searchsorted(self.chrom_names, chrom)
+        order = numpy.argsort(chrom_idxs, kind='mergesort')
+        limits = numpy.searchsorted(chrom_idxs[order],
+                                    numpy.arange(len(self.chrom_names) + 1))
+        for chrom_idx, chrom_name in enumerate(self.chrom_names):
+            chrom_rows = order[limits[chrom_idx]:limits[chrom_idx + 1]]
+            if chrom_rows.shape[0]:
+                yield chrom_name, pos[chrom_rows], stat[chrom_rows]
 
     def _get_track_definition(self, track_type, name, description, **kwargs):
         types = {'wig': 'wiggle_0', 'bedgraph': 'bedGraph'}
@@ -1470,49 +1577,69 @@ class PositionalStatsCalculator:
         fhand.flush()
 
 
-def _calc_r2(gts):
+def _calc_dosages(gts):
     gts = GenotypeArray(gts)
-    gns = gts.to_n_alt(fill=MISSING_VALUES[int])
-    return rogers_huff_r(gns) ** 2
+    return gts.to_n_alt(fill=MISSING_VALUES[int])
 
 
-def calc_r2_windows(variations, window_size, step=None):
-    if step is None:
-        step = window_size
-    chrom = variations[CHROM_FIELD]
-    if is_dataset(chrom):
-        chrom = chrom[:]
-    pos = variations[POS_FIELD]
-    if is_dataset(pos):
-        pos = pos[:]
-    gts = variations[GT_FIELD]
+def _calc_r2(gts):
+    return rogers_huff_r(_calc_dosages(gts)) ** 2
 
-    window_chrom = []
-    window_pos = []
-    window_r2 = []
 
-    chrom_names = numpy.unique(chrom)
+def _calc_chunk_dosages(chunk):
+    return _calc_dosages(chunk[GT_FIELD])
 
-    for chrom_name in chrom_names:
-        chrom_mask = chrom == chrom_name
-        chrom_pos = pos[chrom_mask]
-        if isinstance(chrom_pos, int) or len(chrom_pos.shape) == 0:
-            continue
-        for position in range(chrom_pos[0], chrom_pos[-1], step):
-            start, stop = position, position + window_size
-            window_mask = numpy.logical_and(pos > start, pos <= stop)
-            chrom_window_mask = numpy.logical_and(window_mask, chrom_mask)
 
-            if not numpy.any(chrom_window_mask):
-                continue
+def _calc_r2_windows_by_chrom(variations, window_size, step):
+    '''The r2 windows for every run of rows of the same chromosome
 
-            r2s = _calc_r2(gts[chrom_window_mask, :, :])
-            r2 = numpy.mean(r2s) if r2s.size else float('nan')
+    The dosages of the rows shared by overlapping windows are calculated
+    only once.
+    '''
+    dosages = _WindowBuffer(variations, kept_fields=[GT_FIELD],
+                            rows_funct=_calc_chunk_dosages)
+    chroms, win_starts, window_r2 = [], [], []
+    win_slices = variations._iterate_win_slices(window_size, step,
+                                                stop_included=True)
+    for chrom, win_start, first, last in win_slices:
+        if last <= first:
+            continue
+        r2s = rogers_huff_r(dosages.get_chunk(first, last)) ** 2
+        chroms.append(chrom)
+        win_starts.append(win_start)
+        window_r2.append(numpy.mean(r2s) if r2s.size else float('nan'))
+    return chroms, win_starts, window_r2
+
+
+def calc_r2_windows(variations, window_size, step=None, n_workers=None):
+    '''It calculates the mean r2 in windows along every chromosome
+
+    The windows include their stop position but not their start. The
+    chromosomes are processed in the order in which they are found, so all
+    the variations of every chromosome have to be together, sorted by
+    position. With two or more n_workers the chromosomes are processed by a
+    pool of processes.
+    '''
+    if step is None:
+        step = window_size
 
-            window_chrom.append(chrom_name)
-            window_pos.append(start)
-            window_r2.append(r2)
-    return (numpy.array(window_chrom), numpy.array(window_pos),
+    if n_workers is None or n_workers < 2:
+        results = [_calc_r2_windows_by_chrom(variations, window_size, step)]
+    else:
+        fields = [CHROM_FIELD, POS_FIELD, GT_FIELD]
+        chroms = (chrom_vars for _, chrom_vars
+                  in variations.iterate_chroms(kept_fields=fields))
+        results = map_chunks(partial(_calc_r2_windows_by_chrom,
+                                     window_size=window_size, step=step),
+                             chroms, n_workers=n_workers)
+    chroms, win_starts, window_r2 = [], [], []
+    for chrom_chroms, chrom_win_starts, chrom_window_r2 in results:
+        chroms.extend(chrom_chroms)
+        win_starts.extend(chrom_win_starts)
+        window_r2.extend(chrom_window_r2)
+    if not chroms:
+        return numpy.array([]), numpy.array([]), numpy.array([])
+    return (numpy.array(chroms), numpy.array(win_starts, dtype=numpy.int64),
             numpy.array(window_r2))
 
 
@@ -1559,32 +1686,23 @@ def calc_call_dp_distrib_for_a_sample(variations, sample, range_=None,
         dp_chunks = [dps[:, sample_idx]]
         gt_chunks = [gts[:, sample_idx, :]]
 
-    hom_counts, edges = None, None
-    het_counts = None
+    counts, edges = None, None
     for dp_chunk, gt_chunk in zip(dp_chunks, gt_chunks):
         are_hom, are_missing = _call_is_hom_for_sample(gt_chunk)
-        are_het = numpy.logical_and(numpy.logical_not(are_hom),
-                                    numpy.logical_not(are_missing))
-        are_hom = are_hom.astype(int)
-        are_het = are_het.astype(int)
-
-        hom_res = histogram(dp_chunk, n_bins=n_bins, range_=range_,
-                            weights=are_hom)
-        het_res = histogram(dp_chunk, n_bins=n_bins, range_=range_,
-                            weights=are_het)
-        chunk_hom_counts, chunk_hom_edges = hom_res
-        chunk_het_counts, chunk_het_edges = het_res
-
-        if hom_counts is None:
-            hom_counts = chunk_hom_counts
-            het_counts = chunk_het_counts
-            edges = chunk_hom_edges
+        # the hom calls are counted in the first class and the het in the
+        # second one
+        classes = numpy.where(are_hom, 0, 1)
+        classes[are_missing] = -1
+        chunk_counts, edges = histograms_per_sample(dp_chunk.reshape((-1, 1)),
+                                                    n_bins=n_bins,
+                                                    range_=range_,
+                                                    classes=classes.reshape((-1, 1)),
+                                                    n_classes=2)
+        if counts is None:
+            counts = chunk_counts
         else:
-            hom_counts += chunk_hom_counts
-            het_counts += chunk_het_counts
-            assert numpy.allclose(edges, chunk_hom_edges)
-        het_counts += chunk_het_counts
-        assert numpy.allclose(edges, chunk_het_edges)
+            counts += chunk_counts
+    hom_counts, het_counts = counts[:, 0]
 
     return {'hom': hom_counts, 'het': het_counts}, edges
 
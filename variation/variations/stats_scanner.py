@@ -0,0 +1,175 @@
+# Missing docstring
+# pylint: disable=C0111
+
+from collections import OrderedDict
+
+import numpy
+
+from variation import SNPS_PER_CHUNK
+from variation.variations.stats import (HistogramSketch, histogram,
+                                        DEF_NUM_BINS)
+from variation.variations.chunk_cache import intermediates_cache
+from variation.variations.map_reduce import map_chunks
+
+
+def _pad_with_zeros(array, shape):
+    if array.shape == tuple(shape):
+        return array
+    padded = numpy.zeros(shape, dtype=array.dtype)
+    padded[tuple(slice(0, dim_len) for dim_len in array.shape)] = array
+    return padded
+
+
+def _add_arrays(array1, array2):
+    array1 = numpy.asarray(array1)
+    array2 = numpy.asarray(array2)
+    if array1.shape != array2.shape:
+        # the arrays with different lengths are padded with zeros
+        shape = numpy.maximum(array1.shape, array2.shape)
+        array1 = _pad_with_zeros(array1, shape)
+        array2 = _pad_with_zeros(array2, shape)
+    return numpy.add(array1, array2)
+
+
+class ConcatStat:
+    'The values calculated for every variation, in the input order'
+
+    def __init__(self, calc_funct, required_fields=None):
+        self.calc_funct = calc_funct
+        self.required_fields = required_fields
+
+    def calc(self, chunk):
+        return self.calc_funct(chunk)
+
+    def merge(self, result, chunk_result):
+        if result is None:
+            result = []
+        result.append(chunk_result)
+        return result
+
+    def finish(self, result):
+        if not result:
+            return numpy.array([])
+        return numpy.concatenate(result, axis=0)
+
+
+class SumStat:
+    '''The values calculated for every chunk are added
+
+    If the calc_funct returns a tuple, only its first item is added and the
+    rest, like the bin edges, should be equal for every chunk. The arrays with
+    different shapes are padded with zeros before adding them.
+    '''
+
+    def __init__(self, calc_funct, required_fields=None, finish_funct=None):
+        self.calc_funct = calc_funct
+        self.required_fields = required_fields
+        self.finish_funct = finish_funct
+
+    def calc(self, chunk):
+        return self.calc_funct(chunk)
+
+    def merge(self, result, chunk_result):
+        if result is None:
+            return chunk_result
+        if isinstance(chunk_result, tuple):
+            return (_add_arrays(result[0], chunk_result[0]),) + result[1:]
+        return _add_arrays(result, chunk_result)
+
+    def finish(self, result):
+        if self.finish_funct is None:
+            return result
+        return self.finish_funct(result)
+
+
+class HistogramStat:
+    '''The histogram of the values calculated for every variation
+
+    With no range the histogram is built from a sketch once all values are
+    known.
+    '''
+
+    def __init__(self, calc_funct, required_fields=None, n_bins=DEF_NUM_BINS,
+                 range_=None):
+        self.calc_funct = calc_funct
+        self.required_fields = required_fields
+        self.n_bins = n_bins
+        self.range = range_
+
+    def calc(self, chunk):
+        values = self.calc_funct(chunk)
+        if self.range is None:
+            sketch = HistogramSketch()
+            sketch.add(values)
+            return sketch
+        return histogram(values, n_bins=self.n_bins, range_=self.range)
+
+    def merge(self, result, chunk_result):
+        if result is None:
+            return chunk_result
+        if self.range is None:
+            result.merge(chunk_result)
+            return result
+        counts, edges = result
+        return counts + chunk_result[0], edges
+
+    def finish(self, result):
+        if result is None:
+            result = HistogramSketch()
+        if self.range is None:
+            return result.calc_histogram(self.n_bins)
+        return result
+
+
+class StatsScanner:
+    '''It calculates several stats reading every chunk of variations once
+
+    The stats share the intermediates calculated from the genotypes of
+    every chunk.
+    '''
+
+    def __init__(self):
+        self._stats = OrderedDict()
+
+    def add(self, name, stat):
+        if name in self._stats:
+            raise ValueError('Stat already added: ' + name)
+        self._stats[name] = stat
+
+    def _get_fields_to_read(self, variations):
+        fields = set()
+        for stat in self._stats.values():
+            if stat.required_fields is None:
+                return None
+            fields.update(stat.required_fields)
+        fields_to_read = [field for field in variations.keys()
+                          if field in fields]
+        return fields_to_read if fields_to_read else None
+
+    def _calc_chunk_stats(self, chunk):
+        with intermediates_cache():
+            return [stat.calc(chunk) for stat in self._stats.values()]
+
+    def run(self, variations, chunk_size=SNPS_PER_CHUNK, n_workers=None):
+        '''It returns the result of every stat by name
+
+        With two or more n_workers the chunks are processed by a pool of
+        processes, so the stats have to be picklable.
+        '''
+        if chunk_size is None:
+            chunks = [variations]
+        else:
+            kept_fields = self._get_fields_to_read(variations)
+            chunks = variations.iterate_chunks(kept_fields=kept_fields,
+                                               chunk_size=chunk_size)
+
+        stats = list(self._stats.values())
+        results = [None] * len(stats)
+        for chunk_results in map_chunks(self._calc_chunk_stats, chunks,
+                                        n_workers=n_workers):
+            results = [stat.merge(result, chunk_result)
+                       for stat, result, chunk_result in zip(stats, results,
+                                                             chunk_results)]
+        return OrderedDict((name, stat.finish(result))
+                           for name, stat, result in zip(self._stats.keys(),
+                                                         stats, results))
@@ -1,9 +1,10 @@
 import posixpath
 import json
 import copy
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
 import warnings
 import random
+from multiprocessing.pool import ThreadPool
 
 import numpy
 import h5py
@@ -14,7 +15,15 @@ from variation import (SNPS_PER_CHUNK, MISSING_VALUES, DEF_DSET_PARAMS,
 from variation.iterutils import first, group_items
 from variation.matrix.stats import counts_by_row
 from variation.matrix.methods import is_dataset, concat_matrices, resize_array
+from variation.matrix.direct_chunks import (DirectChunkWriter,
+                                            UnsupportedFilterError,
+                                            write_chunk_tasks)
 from variation.variations.index import PosIndex
+from variation.variations.chunk_cache import (calc_counts_and_alleles,
+                                              calc_is_missing, calc_gts012,
+                                              register_row_subset)
+from variation.variations.zone_maps import (ZoneMaps, ZONE_MAPS_GROUP,
+                                            DEF_ZONE_MAP_FIELDS)
 from variation.gt_writers.vcf import write_vcf
 
 # Missing docstring
@@ -615,6 +624,105 @@ class _ChunkGenerator:
             yield varis
 
 
+class _WindowBuffer:
+    '''It keeps in memory the rows read for the last windows
+
+    The overlapping windows are served from memory, so every variation is
+    read only once no matter the window step.
+    With a rows_funct, like one that converts the genotypes to dosages, the
+    chunks read are converted only once and its result, an array with one
+    item per row, is kept and served instead of the rows.
+    '''
+
+    def __init__(self, variations, kept_fields=None, ignored_fields=None,
+                 read_ahead=SNPS_PER_CHUNK, rows_funct=None):
+        self.variations = variations
+        self.kept_fields = kept_fields
+        self.ignored_fields = ignored_fields
+        self.read_ahead = read_ahead
+        self.rows_funct = rows_funct
+        self._chunk = None
+        self._start = 0
+        self._stop = 0
+
+    def _read(self, start, stop):
+        stop = max(stop, start + self.read_ahead)
+        stop = min(stop, self.variations.num_variations)
+        chunk = self.variations.get_chunk(slice(start, stop),
+                                          kept_fields=self.kept_fields,
+                                          ignored_fields=self.ignored_fields)
+        if self.rows_funct is not None:
+            chunk = self.rows_funct(chunk)
+        return chunk, stop
+
+    def _get_rows(self, index, return_copy=False):
+        if self.rows_funct is None:
+            return self._chunk.get_chunk(index, return_copy=return_copy)
+        rows = self._chunk[index]
+        return rows.copy() if return_copy else rows
+
+    def _fill(self, start, stop):
+        if (self._chunk is None or start < self._start or
+                start >= self._stop):
+            self._chunk, self._stop = self._read(start, stop)
+            self._start = start
+            return
+
+        new_rows, new_stop = self._read(self._stop, stop)
+        kept_rows = self._get_rows(slice(start - self._start, None))
+        if self.rows_funct is None:
+            self._chunk = _concat_chunks([kept_rows, new_rows])
+        else:
+            self._chunk = numpy.concatenate([kept_rows, new_rows], axis=0)
+        self._start = start
+        self._stop = new_stop
+
+    def get_chunk(self, start, stop, return_copy=False):
+        if self._chunk is None or start < self._start or stop > self._stop:
+            self._fill(start, stop)
+        index = slice(start - self._start, stop - self._start)
+        return self._get_rows(index, return_copy=return_copy)
+
+
+def _calc_gts012(gts):
+    counts = calc_counts_and_alleles(gts, missing_value=MISSING_INT)[0]
+    if counts is None:
+        return numpy.full((gts.shape[0], gts.shape[1]),
+                          fill_value=MISSING_INT)
+
+    major_alleles = numpy.argmax(counts, axis=1)
+    if is_dataset(gts):
+        gts = gts[:]
+    gts012 = numpy.sum(gts != major_alleles[:, None, None], axis=2)
+    gts012[calc_is_missing(gts, axis=2)] = MISSING_INT
+    return gts012
+
+
+def _concat_chunks(chunks):
+    'It concatenates in memory chunks with the same fields'
+    concat_chunk = VariationsArrays()
+    for path in chunks[0].keys():
+        concat_chunk[path] = numpy.concatenate([chunk[path]
+                                                for chunk in chunks], axis=0)
+    concat_chunk._set_metadata(chunks[0].metadata)
+    concat_chunk._set_samples(chunks[0].samples)
+    return concat_chunk
+
+
+def _merge_row_ranges(starts, stops, max_gap=0):
+    'It merges the sorted row ranges closer than max_gap rows'
+    merged = []
+    merged_stop = None
+    for start, stop in zip(starts, stops):
+        if merged and start <= merged_stop + max_gap:
+            merged[-1].append((start, stop))
+            merged_stop = max(merged_stop, stop)
+        else:
+            merged.append([(start, stop)])
+            merged_stop = stop
+    return merged
+
+
 def _put_vars_in_mats(vars_parser, hdf5, vars_in_chunk, kept_fields=None,
                       ignored_fields=None):
     chunker = _ChunkGenerator(vars_parser, hdf5, vars_in_chunk,
@@ -624,6 +732,26 @@ def _put_vars_in_mats(vars_parser, hdf5, vars_in_chunk, kept_fields=None,
     return chunker.log
 
 
+def iterate_parser_chunks(vars_parser, chunk_size=SNPS_PER_CHUNK,
+                          kept_fields=None, ignored_fields=None):
+    '''It yields the variations read by the parser in VariationsArrays chunks
+
+    The parser is consumed, so the chunks can be iterated only once.
+    '''
+    if kept_fields is not None and ignored_fields is not None:
+        msg = 'kept_fields and ignored_fields can not be set at the same time'
+        raise ValueError(msg)
+    if chunk_size is None:
+        chunk_size = SNPS_PER_CHUNK
+    chunker = _ChunkGenerator(vars_parser, None, chunk_size)
+    for chunk in chunker.chunks:
+        for path in list(chunk.keys()):
+            if ((kept_fields is not None and path not in kept_fields) or
+                    (ignored_fields is not None and path in ignored_fields)):
+                del chunk[path]
+        yield chunk
+
+
 class _VariationMatrices():
 
     def __init__(self, vars_in_chunk=SNPS_PER_CHUNK,
@@ -635,6 +763,7 @@ class _VariationMatrices():
         self.kept_fields = kept_fields
         self.ignored_fields = ignored_fields
         self._index = None
+        self._zone_maps = None
 
     @property
     def ploidy(self):
@@ -840,6 +969,8 @@ class _VariationMatrices():
             if return_copy:
                 matrix = matrix.copy()
             var_array[path] = matrix
+            if path == GT_FIELD:
+                register_row_subset(dset, matrix, index)
 
         if var_array is None:
             var_array = self.__class__()
@@ -849,10 +980,88 @@ class _VariationMatrices():
 
         return var_array
 
-    def get_genome_chunk(self, chrom, start, end):
-        # with index
-        # bisect
-        pass
+    def get_genome_chunk(self, chrom, start, end, kept_fields=None,
+                         ignored_fields=None, return_copy=False):
+        'It returns the variations in chrom with start <= pos < end'
+        row_starts, row_stops = self._get_regions_rows([(chrom, start, end)])
+        if row_starts.shape[0]:
+            index = slice(row_starts[0], row_stops[0])
+        else:
+            index = slice(0, 0)
+        return self.get_chunk(index, kept_fields=kept_fields,
+                              ignored_fields=ignored_fields,
+                              return_copy=return_copy)
+
+    def _get_regions_rows(self, regions):
+        pos_index = self.pos_index
+        chroms_in_index = set(pos_index.chroms)
+
+        regions_by_chrom = defaultdict(list)
+        for region in regions:
+            if len(region) not in (1, 3):
+                raise ValueError('Malformed region: ' + str(region))
+            if region[0] in chroms_in_index:
+                regions_by_chrom[region[0]].append(region)
+
+        row_starts, row_stops = [], []
+        for chrom, chrom_regions in regions_by_chrom.items():
+            if any(len(region) == 1 for region in chrom_regions):
+                # the whole chromosome
+                chrom_start, chrom_end = pos_index.get_chrom_range_index(chrom)
+                row_starts.append([chrom_start])
+                row_stops.append([chrom_end + 1])
+                continue
+            region_starts = numpy.array([region[1] for region in chrom_regions])
+            region_ends = numpy.array([region[2] for region in chrom_regions])
+            row_starts.append(pos_index.index_poss(chrom, region_starts))
+            row_stops.append(pos_index.index_poss(chrom, region_ends))
+
+        if not row_starts:
+            return numpy.array([], dtype=int), numpy.array([], dtype=int)
+        row_starts = numpy.concatenate(row_starts)
+        row_stops = numpy.concatenate(row_stops)
+        not_empty = row_starts < row_stops
+        row_starts = row_starts[not_empty]
+        row_stops = row_stops[not_empty]
+        sort_idx = numpy.argsort(row_starts, kind='mergesort')
+        return row_starts[sort_idx], row_stops[sort_idx]
+
+    def get_genome_regions(self, regions, kept_fields=None,
+                           ignored_fields=None, max_gap=None):
+        '''It returns the variations found in any of the given regions
+
+        The regions are (chrom,) or BED like (chrom, start, end) tuples.
+        Close regions are read together, the rows between regions are
+        discarded in memory if there are less than max_gap of them.
+        '''
+        if max_gap is None:
+            max_gap = self._vars_in_chunk
+
+        row_starts, row_stops = self._get_regions_rows(regions)
+        merged_ranges = [(ranges[0][0], max(stop for _, stop in ranges))
+                         for ranges in _merge_row_ranges(row_starts,
+                                                         row_stops)]
+
+        chunks = []
+        for row_ranges in _merge_row_ranges([start for start, _ in merged_ranges],
+                                            [stop for _, stop in merged_ranges],
+                                            max_gap=max_gap):
+            read_start, read_stop = row_ranges[0][0], row_ranges[-1][1]
+            chunk = self.get_chunk(slice(read_start, read_stop),
+                                   kept_fields=kept_fields,
+                                   ignored_fields=ignored_fields)
+            if len(row_ranges) > 1:
+                rows = numpy.concatenate([numpy.arange(start, stop)
+                                          for start, stop in row_ranges])
+                chunk = chunk.get_chunk(rows - read_start)
+            chunks.append(chunk)
+
+        if not chunks:
+            return self.get_chunk(slice(0, 0), kept_fields=kept_fields,
+                                  ignored_fields=ignored_fields)
+        if len(chunks) == 1:
+            return chunks[0]
+        return _concat_chunks(chunks)
 
     def _filter_fields(self, kept_fields, ignored_fields):
         if kept_fields is not None and ignored_fields is not None:
@@ -937,43 +1146,54 @@ class _VariationMatrices():
                                                            stop=stop,
                                                            return_copy=return_copy))
 
+    @property
+    def zone_maps(self):
+        return self._zone_maps
+
     @property
     def pos_index(self):
         if self._index is None:
             self._index = PosIndex(self)
         return self._index
 
-    def iterate_wins(self, win_size, win_step=None, kept_fields=None,
-                     ignored_fields=None, chroms=None, return_copy=False):
-        if win_step is None:
-            win_step = win_size
+    def _iterate_win_slices(self, win_size, win_step, chroms=None,
+                            stop_included=False):
+        '''It yields the chrom, the start and the rows of every window
+
+        The windows include their start position but not their stop, or the
+        other way around with stop_included.
+        '''
         index = self.pos_index
 
         if chroms is None:
             chroms = index.chroms
-        chrom_mat = self['/variations/chrom']
+        side = 'right' if stop_included else 'left'
         for chrom in chroms:
-            chrom_start, chrom_end = index.get_chrom_range_pos(chrom)
-            pos = chrom_start
-            while True:
-                if pos > chrom_end:
-                    break
-                try:
-                    index.get_chrom_range_pos(chrom)
-                except IndexError:
-                    # No snps for this chrom
-                    break
-                idx0 = index.index_pos(chrom, pos)
-                idx1 = index.index_pos(chrom, pos + win_size)
-                if chrom_mat[idx0] != chrom:
-                    msg = 'chroms do not match: ' + str(chrom_mat[idx0])
-                    msg += ', ' + str(chrom)
-                    raise RuntimeError(msg)
-                yield self.get_chunk(slice(idx0, idx1),
-                                     kept_fields=kept_fields,
-                                     ignored_fields=ignored_fields,
-                                     return_copy=return_copy)
-                pos += win_step
+            try:
+                chrom_start, chrom_end = index.get_chrom_range_pos(chrom)
+            except IndexError:
+                # No snps for this chrom
+                continue
+            # All window boundaries for the chromosome are calculated at once
+            last_start = chrom_end if stop_included else chrom_end + 1
+            win_starts = numpy.arange(chrom_start, last_start, win_step,
+                                      dtype=numpy.int64)
+            idxs0 = index.index_poss(chrom, win_starts, side=side)
+            idxs1 = index.index_poss(chrom, win_starts + win_size, side=side)
+            for win_start, idx0, idx1 in zip(win_starts, idxs0, idxs1):
+                yield chrom, win_start, int(idx0), int(idx1)
+
+    def iterate_wins(self, win_size, win_step=None, kept_fields=None,
+                     ignored_fields=None, chroms=None, return_copy=False):
+        if win_step is None:
+            win_step = win_size
+
+        win_buffer = _WindowBuffer(self, kept_fields=kept_fields,
+                                   ignored_fields=ignored_fields,
+                                   read_ahead=self._vars_in_chunk)
+        for _, _, idx0, idx1 in self._iterate_win_slices(win_size, win_step,
+                                                         chroms=chroms):
+            yield win_buffer.get_chunk(idx0, idx1, return_copy=return_copy)
 
     def iterate_chroms(self, kept_fields=None, ignored_fields=None,
                        chroms=None, return_copy=False):
@@ -996,19 +1216,31 @@ class _VariationMatrices():
     def iterate_chunk_pairs(self, max_dist, kept_fields=None,
                             ignored_fields=None, chunk_size=None,
                             return_copy=False):
-
-        for chunk1_slice, chunk1 in self._iterate_chunks(kept_fields=kept_fields,
-                                                         ignored_fields=ignored_fields,
-                                                         chunk_size=chunk_size,
-                                                         return_copy=return_copy):
+        # The chunks closer than max_dist are kept in a buffer, so every
+        # chunk is read only once
+        chunks = (chunk for _, chunk in self._iterate_chunks(kept_fields=kept_fields,
+                                                             ignored_fields=ignored_fields,
+                                                             chunk_size=chunk_size,
+                                                             return_copy=return_copy))
+        buffered_chunks = deque()
+        while True:
+            if not buffered_chunks:
+                try:
+                    buffered_chunks.append(next(chunks))
+                except StopIteration:
+                    break
+            chunk1 = buffered_chunks[0]
             chunk1_end_pos = chunk1[POS_FIELD][-1]
             chunk1_end_chrom = chunk1[CHROM_FIELD][-1]
 
-            for chunk2 in self.iterate_chunks(kept_fields=kept_fields,
-                                              ignored_fields=ignored_fields,
-                                              chunk_size=chunk_size,
-                                              start=chunk1_slice.start,
-                                              return_copy=return_copy):
+            chunk2_idx = 0
+            while True:
+                if chunk2_idx == len(buffered_chunks):
+                    try:
+                        buffered_chunks.append(next(chunks))
+                    except StopIteration:
+                        break
+                chunk2 = buffered_chunks[chunk2_idx]
                 chunk2_start_chrom = chunk2[CHROM_FIELD][0]
                 if chunk1_end_chrom != chunk2_start_chrom:
                     break
@@ -1016,6 +1248,8 @@ class _VariationMatrices():
                 if chunk2_start_pos - chunk1_end_pos > max_dist:
                     break
                 yield {'chunk1': chunk1, 'chunk2': chunk2}
+                chunk2_idx += 1
+            buffered_chunks.popleft()
 
     @property
     def chroms(self):
@@ -1064,18 +1298,7 @@ class _VariationMatrices():
     def gts_as_mat012(self):
         '''It transforms the GT matrix into 0 (major allele homo), 1 (het),
         2(other hom)'''
-        gts = self[GT_FIELD]
-        counts = counts_by_row(gts, missing_value=MISSING_INT)
-        if counts is None:
-            return numpy.full((gts.shape[0], gts.shape[1]),
-                              fill_value=MISSING_INT)
-
-        major_alleles = numpy.argmax(counts, axis=1)
-        if is_dataset(gts):
-            gts = gts[:]
-        gts012 = numpy.sum(gts != major_alleles[:, None, None], axis=2)
-        gts012[numpy.any(gts == MISSING_INT, axis=2)] = MISSING_INT
-        return gts012
+        return calc_gts012(self[GT_FIELD], _calc_gts012)
 
     def get_random_haploid_gts(self):
         gts = self[GT_FIELD]
@@ -1124,7 +1347,8 @@ class VariationsH5(_VariationMatrices):
 
     def __init__(self, fpath, mode, vars_in_chunk=SNPS_PER_CHUNK,
                  ignore_undefined_fields=False,
-                 kept_fields=None, ignored_fields=None):
+                 kept_fields=None, ignored_fields=None, n_threads=None,
+                 zone_map_fields=DEF_ZONE_MAP_FIELDS):
         super().__init__(vars_in_chunk=vars_in_chunk,
                          ignore_undefined_fields=ignore_undefined_fields,
                          kept_fields=kept_fields,
@@ -1138,7 +1362,22 @@ class VariationsH5(_VariationMatrices):
         self.mode = mode
         self._h5file = h5py.File(fpath, mode)
 
+        # With n_threads the chunks are compressed in a pool and written
+        # with direct chunk writes
+        self.n_threads = n_threads
+        self._chunk_writers = {}
+        self._compression_pool = None
+
+        # min and max values for every chunk of rows, they are updated by
+        # put_chunks and saved in the file by flush and close
+        self._zone_maps = ZoneMaps.load(self._h5file, self)
+        if self._zone_maps is None and not self.num_variations:
+            self._zone_maps = ZoneMaps(zone_len=vars_in_chunk,
+                                       fields=zone_map_fields)
+
     def __getitem__(self, path):
+        if self._chunk_writers:
+            self._flush_chunk_writers(path)
         try:
             return self._h5file[path]
         except KeyError:
@@ -1148,14 +1387,169 @@ class VariationsH5(_VariationMatrices):
     def keys(self):
         dsets = []
         _get_hdf5_dset_paths(dsets, self._h5file)
-        return dsets
+        zone_maps_prefix = ZONE_MAPS_GROUP + '/'
+        return [dset for dset in dsets
+                if not dset.startswith(zone_maps_prefix)]
 
     def flush(self):
+        self._flush_chunk_writers()
+        self._save_zone_maps()
         self._h5file.flush()
 
     def close(self):
+        self._flush_chunk_writers()
+        self._save_zone_maps()
+        if self._compression_pool is not None:
+            self._compression_pool.close()
+            self._compression_pool = None
         self._h5file.close()
 
+    def _flush_chunk_writers(self, path=None):
+        # with a path only the datasets in it are flushed, the padded last
+        # chunk is not rewritten every time that a dataset is accessed
+        if path is not None:
+            path = '/' + path.strip('/')
+        for dset_path, writer in self._chunk_writers.items():
+            if (path is None or path == '/' or dset_path == path or
+                    dset_path.startswith(path + '/')):
+                writer.flush()
+
+    def _drop_chunk_writers(self):
+        self._flush_chunk_writers()
+        self._chunk_writers = {}
+
+    def _get_chunk_writer(self, path):
+        try:
+            return self._chunk_writers[path]
+        except KeyError:
+            pass
+        writer = DirectChunkWriter(self._h5file[path])
+        self._chunk_writers[path] = writer
+        return writer
+
+    def _chunk_fits_in_dsets(self, chunk):
+        paths = self.keys()
+        if set(paths) != set(chunk.keys()):
+            return False
+        for path in paths:
+            dset = self._h5file[path]
+            mat = chunk[path]
+            if dset.chunks is None or mat.ndim != dset.ndim:
+                return False
+            if any(mat_len > dset_len for mat_len, dset_len in zip(mat.shape[1:],
+                                                                   dset.shape[1:])):
+                return False
+            if mat.dtype != dset.dtype:
+                if (mat.dtype.type != dset.dtype.type or
+                        mat.dtype.itemsize > dset.dtype.itemsize):
+                    return False
+        return True
+
+    def _put_chunk_direct(self, chunk):
+        # all writers are created, and their filters checked, before any
+        # dataset is resized
+        writers = {path: self._get_chunk_writer(path) for path in chunk.keys()}
+        writer_tasks = []
+        for path, writer in writers.items():
+            mat = chunk[path]
+            if is_dataset(mat):
+                mat = mat[:]
+            dset_shape = (mat.shape[0],) + writer.dset.shape[1:]
+            if mat.shape != dset_shape:
+                mat = resize_array(mat, dset_shape,
+                                   self._get_missing_value(path))
+            mat = mat.astype(writer.dset.dtype, copy=False)
+            writer_tasks.extend((writer, task) for task in writer.append(mat))
+        return writer_tasks
+
+    @property
+    def zone_maps(self):
+        zone_maps = self._zone_maps
+        if zone_maps is None or zone_maps.n_rows != self.num_variations:
+            return None
+        if not zone_maps.check_digests(self):
+            # the fields have been modified in place
+            self.create_zone_maps(zone_maps.fields)
+            zone_maps = self._zone_maps
+        return zone_maps
+
+    def create_zone_maps(self, fields=DEF_ZONE_MAP_FIELDS):
+        'It creates the zone maps for a file written without them'
+        zone_maps = ZoneMaps(zone_len=self._vars_in_chunk, fields=fields)
+        kept_fields = [field for field in fields if field in self.keys()]
+        dtypes = self._get_zone_map_dtypes(zone_maps)
+        for chunk in self.iterate_chunks(kept_fields=kept_fields):
+            zone_maps.add_chunk(chunk, dtypes=dtypes)
+        self._zone_maps = zone_maps
+        self._save_zone_maps()
+
+    def truncate(self, num_variations):
+        'It removes the variations after the first num_variations'
+        self._drop_chunk_writers()
+        self._index = None
+        for path in self.keys():
+            dset = self._h5file[path]
+            if dset.shape[0] > num_variations:
+                dset.resize(num_variations, axis=0)
+        if self._zone_maps is not None:
+            self.create_zone_maps(self._zone_maps.fields)
+
+    def _save_zone_maps(self):
+        if self.mode == 'r' or self._zone_maps is None:
+            return
+        self._zone_maps.save(self._h5file)
+
+    def _get_zone_map_dtypes(self, zone_maps):
+        return {field: self._h5file[field].dtype
+                for field in zone_maps.fields if field in self._h5file}
+
+    def _add_chunks_to_zone_maps(self, chunks):
+        for chunk in chunks:
+            zone_maps = self._zone_maps
+            if zone_maps is not None:
+                # the digests are for the values as stored in the datasets
+                zone_maps.add_chunk(chunk,
+                                    dtypes=self._get_zone_map_dtypes(zone_maps))
+            yield chunk
+
+    def put_chunks(self, chunks):
+        if chunks is None:
+            return
+        # the zone maps are kept in memory and written by flush and close
+        chunks = self._add_chunks_to_zone_maps(chunks)
+        self._put_chunks(chunks)
+
+    def _put_chunks(self, chunks):
+        if self.n_threads is None:
+            return super().put_chunks(chunks)
+
+        if self._compression_pool is None:
+            self._compression_pool = ThreadPool(self.n_threads)
+        pool = self._compression_pool
+        max_tasks_in_batch = self.n_threads * 4
+
+        writer_tasks = []
+        for chunk in chunks:
+            if chunk.num_variations == 0:
+                continue
+            try:
+                fits = self.keys() and self._chunk_fits_in_dsets(chunk)
+                if fits:
+                    writer_tasks.extend(self._put_chunk_direct(chunk))
+            except UnsupportedFilterError:
+                fits = False
+            if not fits:
+                # new datasets or datasets that have to be reshaped are
+                # written by the standard h5py machinery
+                write_chunk_tasks(writer_tasks, pool)
+                writer_tasks = []
+                self._drop_chunk_writers()
+                super().put_chunks([chunk])
+            if len(writer_tasks) >= max_tasks_in_batch:
+                write_chunk_tasks(writer_tasks, pool)
+                writer_tasks = []
+        write_chunk_tasks(writer_tasks, pool)
+
     @property
     def fpath(self):
         return self._h5file.filename
@@ -1267,21 +1661,30 @@ class VariationsH5(_VariationMatrices):
 
     def _replace_matrices(self, matrices):
         self._check_same_paths(matrices)
+        self._drop_chunk_writers()
         h5file = self._h5file
         for path in self.keys():
             del h5file[path]
             h5file[path] = matrices[path]
+            self._invalidate_zone_map_field(path)
 
         self._index = None
 
     def _replace_matrix(self, path, new_matrix):
         h5file = self._h5file
+        self._drop_chunk_writers()
 
         del h5file[path]
         h5file[path] = new_matrix
+        self._invalidate_zone_map_field(path)
 
         self._index = None
 
+    def _invalidate_zone_map_field(self, path):
+        # the zone maps are rebuilt the next time that they are used
+        if self._zone_maps is not None:
+            self._zone_maps.invalidate_field(path)
+
 
 def select_dset_from_chunks(chunks, dset_path):
     return (chunk[dset_path] for chunk in chunks)
@@ -1320,6 +1723,10 @@ class VariationsArrays(_VariationMatrices):
     def keys(self):
         return self._hArrays.keys()
 
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self._hArrays.values())
+
     @property
     def allele_count(self):
         gts = self['/calls/GT']
@@ -1356,3 +1763,96 @@ class VariationsArrays(_VariationMatrices):
         self._hArrays[path] = new_matrix
 
         self._index = None
+
+
+class LazyRowsVariations(VariationsArrays):
+    '''A view of some rows of a chunk that copies the fields only when used
+
+    get_chunk returns another view with the selected rows, so a chain of
+    filters only copies the fields that each filter uses, materialize
+    returns a VariationsArrays with all fields.
+    '''
+
+    def __init__(self, variations, rows=None):
+        super().__init__(vars_in_chunk=variations._vars_in_chunk,
+                         ignore_undefined_fields=variations.ignore_undefined_fields)
+        if rows is None:
+            rows = numpy.arange(variations.num_variations)
+        self._variations = variations
+        self._rows = rows
+        self._lazy_paths = list(variations.keys())
+        # the fields set in the view, not taken from variations
+        self._own_paths = set()
+        self._metadata = variations._metadata
+        self._samples = variations._samples
+
+    def __getitem__(self, path):
+        try:
+            return self._hArrays[path]
+        except KeyError:
+            pass
+        if path not in self._lazy_paths:
+            raise KeyError(path)
+        array = self._variations[path][self._rows]
+        if path == GT_FIELD:
+            register_row_subset(self._variations[path], array, self._rows)
+        self._hArrays[path] = array
+        return array
+
+    def __setitem__(self, path, array):
+        assert isinstance(array, numpy.ndarray)
+        assert self.num_variations == array.shape[0]
+        if path in self.keys():
+            raise ValueError('This path was already in the var_array', path)
+        self._hArrays[path] = array
+        self._own_paths.add(path)
+
+    def __delitem__(self, path):
+        if path not in self.keys():
+            raise KeyError('The path is not in the variation_array', path)
+        if path in self._hArrays:
+            del self._hArrays[path]
+        if path in self._lazy_paths:
+            self._lazy_paths.remove(path)
+        self._own_paths.discard(path)
+
+    def keys(self):
+        return self._lazy_paths + [path for path in self._hArrays
+                                   if path not in self._lazy_paths]
+
+    @property
+    def num_variations(self):
+        return self._rows.shape[0]
+
+    @property
+    def nbytes(self):
+        'The bytes that the fields would take once copied'
+        nbytes = sum(self._hArrays[path].nbytes for path in self._own_paths)
+        n_vars = self._variations.num_variations
+        if not n_vars:
+            return nbytes
+        for path in self._lazy_paths:
+            array = self._variations[path]
+            nbytes += array.nbytes * self.num_variations // n_vars
+        return nbytes
+
+    def get_chunk(self, index, kept_fields=None, ignored_fields=None,
+                  return_copy=False):
+        paths = self._filter_fields(kept_fields=kept_fields,
+                                    ignored_fields=ignored_fields)
+        chunk = self.__class__(self._variations, self._rows[index])
+        chunk._lazy_paths = [path for path in self._lazy_paths
+                             if path in paths]
+        for path in self._own_paths:
+            if path in paths:
+                chunk[path] = self._hArrays[path][index]
+        return chunk
+
+    def materialize(self):
+        chunk = VariationsArrays(vars_in_chunk=self._vars_in_chunk,
+                                 ignore_undefined_fields=self.ignore_undefined_fields)
+        for path in self.keys():
+            chunk[path] = self[path]
+        chunk._set_metadata(self._metadata)
+        chunk._set_samples(self._samples)
+        return chunk
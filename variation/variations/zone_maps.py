@@ -0,0 +1,239 @@
+# Missing docstring
+# pylint: disable=C0111
+
+import json
+import zlib
+
+import numpy
+
+from variation import (CHROM_FIELD, POS_FIELD, QUAL_FIELD, MISSING_VALUES,
+                       SNPS_PER_CHUNK)
+from variation.matrix.methods import is_dataset
+
+ZONE_MAPS_GROUP = '/zone_maps'
+DEF_ZONE_MAP_FIELDS = (CHROM_FIELD, POS_FIELD, QUAL_FIELD)
+
+MIN = 'min'
+MAX = 'max'
+N_MISSING = 'n_missing'
+N_ROWS = 'n_rows'
+
+# rows read at once to check the digests of the fields
+DIGEST_BLOCK_LEN = SNPS_PER_CHUNK * 100
+
+# What a filter could do with the rows of a zone
+ZONE_ALL = 'all'
+ZONE_NONE = 'none'
+ZONE_SOME = 'some'
+
+
+def _is_missing(values):
+    if numpy.issubdtype(values.dtype, numpy.floating):
+        return numpy.isnan(values)
+    return values == MISSING_VALUES[values.dtype]
+
+
+def _calc_zone_stats(values):
+    missing = _is_missing(values)
+    n_missing = int(numpy.count_nonzero(missing))
+    if n_missing == values.shape[0]:
+        missing_value = MISSING_VALUES[values.dtype]
+        return missing_value, missing_value, n_missing
+    if n_missing:
+        values = values[numpy.logical_not(missing)]
+    if values.dtype.kind in ('S', 'U'):
+        values = numpy.sort(values)
+        return values[0], values[-1], n_missing
+    return values.min(), values.max(), n_missing
+
+
+def _update_digest(digest, values):
+    if digest is None:
+        return None
+    return zlib.crc32(numpy.ascontiguousarray(values), digest)
+
+
+class ZoneMaps:
+    '''Summary stats (min, max and number of missing) for every zone of rows
+
+    The zones are blocks of zone_len rows, only the one dimensional fields
+    are summarized. A crc32 digest of the values of every field is kept to
+    know if the fields have been modified after the stats were calculated,
+    a None digest is unknown.
+    '''
+
+    def __init__(self, zone_len=SNPS_PER_CHUNK, fields=DEF_ZONE_MAP_FIELDS):
+        self.zone_len = zone_len
+        self.fields = list(fields)
+        self.n_rows = 0
+        self._stats = {field: {MIN: [], MAX: [], N_MISSING: []}
+                       for field in self.fields}
+        self.digests = {field: 0 for field in self.fields}
+        # values of the rows in the last zone, if it is incomplete
+        self._pending = {}
+
+    def _drop_field(self, field):
+        self.fields.remove(field)
+        del self._stats[field]
+        del self.digests[field]
+        if field in self._pending:
+            del self._pending[field]
+
+    def add_chunk(self, chunk, dtypes=None):
+        '''It adds the stats of the rows of the chunk
+
+        The digests are calculated for the values converted to the dtypes,
+        if given, the ones of the datasets in which they are stored.
+        '''
+        n_rows_in_chunk = chunk.num_variations
+        if not n_rows_in_chunk:
+            return
+        zone_len = self.zone_len
+        first_zone = self.n_rows // zone_len
+
+        for field in list(self.fields):
+            try:
+                values = chunk[field]
+            except KeyError:
+                values = None
+            if values is None or len(values.shape) != 1:
+                # we can not know the values for these rows
+                self._drop_field(field)
+                continue
+            if is_dataset(values):
+                values = values[:]
+            if dtypes is not None and field in dtypes:
+                digest_values = values.astype(dtypes[field], copy=False)
+            else:
+                digest_values = values
+            self.digests[field] = _update_digest(self.digests[field],
+                                                 digest_values)
+
+            if field in self._pending:
+                values = numpy.concatenate([self._pending[field], values])
+            field_stats = self._stats[field]
+            for stats in field_stats.values():
+                # the last zone, if incomplete, is recalculated
+                del stats[first_zone:]
+
+            for zone_start in range(0, values.shape[0], zone_len):
+                zone_values = values[zone_start:zone_start + zone_len]
+                min_, max_, n_missing = _calc_zone_stats(zone_values)
+                field_stats[MIN].append(min_)
+                field_stats[MAX].append(max_)
+                field_stats[N_MISSING].append(n_missing)
+            if zone_values.shape[0] < zone_len:
+                self._pending[field] = zone_values
+            elif field in self._pending:
+                del self._pending[field]
+        self.n_rows += n_rows_in_chunk
+
+    def invalidate_field(self, field):
+        'The field has been modified, its digest is no longer known'
+        if field in self.digests:
+            self.digests[field] = None
+
+    def check_digests(self, variations):
+        'It checks that the fields have not been modified since added'
+        for field in self.fields:
+            if self.digests[field] is None:
+                return False
+            dset = variations[field]
+            digest = 0
+            for start in range(0, dset.shape[0], DIGEST_BLOCK_LEN):
+                digest = _update_digest(digest,
+                                        dset[start:start + DIGEST_BLOCK_LEN])
+            if digest != self.digests[field]:
+                return False
+        return True
+
+    def get_zone_stats(self, start, stop):
+        'It returns the stats for the zones that include the rows given'
+        first_zone = start // self.zone_len
+        last_zone = (stop - 1) // self.zone_len + 1
+        n_rows = min(last_zone * self.zone_len, self.n_rows)
+        n_rows -= first_zone * self.zone_len
+
+        zone_stats = {}
+        for field in self.fields:
+            field_stats = self._stats[field]
+            mins, maxs = [], []
+            n_missing = 0
+            for zone in range(first_zone, last_zone):
+                zone_min = field_stats[MIN][zone]
+                zone_max = field_stats[MAX][zone]
+                zone_n_missing = field_stats[N_MISSING][zone]
+                n_missing += zone_n_missing
+                zone_n_rows = min(self.zone_len,
+                                  self.n_rows - zone * self.zone_len)
+                if zone_n_missing < zone_n_rows:
+                    mins.append(zone_min)
+                    maxs.append(zone_max)
+            zone_stats[field] = {MIN: min(mins) if mins else None,
+                                 MAX: max(maxs) if maxs else None,
+                                 N_MISSING: n_missing, N_ROWS: n_rows}
+        return zone_stats
+
+    def save(self, h5file):
+        if ZONE_MAPS_GROUP in h5file:
+            del h5file[ZONE_MAPS_GROUP]
+        group = h5file.create_group(ZONE_MAPS_GROUP)
+        group.attrs['zone_len'] = self.zone_len
+        group.attrs['n_rows'] = self.n_rows
+        group.attrs['fields'] = json.dumps(self.fields)
+        group.attrs['digests'] = json.dumps([self.digests[field]
+                                             for field in self.fields])
+        for idx, field in enumerate(self.fields):
+            field_group = group.create_group(str(idx))
+            for stat, values in self._stats[field].items():
+                field_group.create_dataset(stat, data=numpy.array(values))
+
+    @classmethod
+    def load(cls, h5file, variations):
+        if ZONE_MAPS_GROUP not in h5file:
+            return None
+        group = h5file[ZONE_MAPS_GROUP]
+        n_rows = int(group.attrs['n_rows'])
+        if n_rows != variations.num_variations:
+            # the file has been modified without updating the zone maps
+            return None
+
+        zone_maps = cls(zone_len=int(group.attrs['zone_len']),
+                        fields=json.loads(group.attrs['fields']))
+        zone_maps.n_rows = n_rows
+        if 'digests' in group.attrs:
+            digests = json.loads(group.attrs['digests'])
+        else:
+            digests = [None] * len(zone_maps.fields)
+        zone_maps.digests = dict(zip(zone_maps.fields, digests))
+        pending_start = (n_rows // zone_maps.zone_len) * zone_maps.zone_len
+        for idx, field in enumerate(zone_maps.fields):
+            field_group = group[str(idx)]
+            for stat in (MIN, MAX, N_MISSING):
+                zone_maps._stats[field][stat] = list(field_group[stat][:])
+            if pending_start < n_rows:
+                zone_maps._pending[field] = variations[field][pending_start:]
+        return zone_maps
+
+
+def select_zone_by_range(field_stats, min_=None, max_=None,
+                         keep_missing=False):
+    'It tells if all, none or some of the rows will be in the range'
+    if min_ is None and max_ is None:
+        return ZONE_ALL
+    n_missing = field_stats[N_MISSING]
+    zone_min, zone_max = field_stats[MIN], field_stats[MAX]
+
+    if zone_min is None:
+        # all values are missing
+        return ZONE_ALL if keep_missing else ZONE_NONE
+
+    if ((min_ is not None and zone_max < min_) or
+            (max_ is not None and zone_min > max_)):
+        if not n_missing or not keep_missing:
+            return ZONE_NONE
+    elif ((min_ is None or zone_min >= min_) and
+            (max_ is None or zone_max <= max_)):
+        if not n_missing or keep_missing:
+            return ZONE_ALL
+    return ZONE_SOME